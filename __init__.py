@@ -5,21 +5,31 @@
 Endicia integration
 """
 from trytond.pool import Pool
-from party import Address
+from party import Address, Party, ContactMechanism
 from stock import (
     ShipmentOut, EndiciaRefundRequestWizardView, EndiciaRefundRequestWizard,
     BuyPostageWizardView, BuyPostageWizard, ShippingEndicia,
-    GenerateShippingLabel
+    GenerateShippingLabel, GenerateEndiciaLabelsResult, GenerateEndiciaLabels,
+    PrintEndiciaLabelsStart, PrintEndiciaLabelsResult, PrintEndiciaLabels,
+    CheckEndiciaAddressesResult, CheckEndiciaAddresses
 )
 from shipment_bag import ShippingManifest
 from carrier import Carrier, CarrierService, BoxType
 from sale import Configuration, Sale
 from country import Country
+from product import Uom, Template, Product
+from label_job import LabelJob
+from location import Location
+from tracking import ShipmentTracking
+from label_journal import LabelRequest
+from postage_ledger import PostageLedger
 
 
 def register():
     Pool.register(
         Address,
+        Party,
+        ContactMechanism,
         Carrier,
         CarrierService,
         BoxType,
@@ -31,11 +41,26 @@ def register():
         BuyPostageWizardView,
         Country,
         ShippingEndicia,
+        GenerateEndiciaLabelsResult,
+        PrintEndiciaLabelsStart,
+        PrintEndiciaLabelsResult,
+        CheckEndiciaAddressesResult,
+        Uom,
+        Template,
+        Product,
+        LabelJob,
+        Location,
+        ShipmentTracking,
+        LabelRequest,
+        PostageLedger,
         module='shipping_endicia', type_='model'
     )
     Pool.register(
         EndiciaRefundRequestWizard,
         BuyPostageWizard,
         GenerateShippingLabel,
+        GenerateEndiciaLabels,
+        PrintEndiciaLabels,
+        CheckEndiciaAddresses,
         module='shipping_endicia', type_='wizard'
     )
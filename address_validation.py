@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+    address_validation
+
+    Checks addresses against the rules of Endicia before any request is
+    sent, so that labels do not fail after a full round-trip.
+
+    The US ZIP codes are checked against the data set in the `zip_data`
+    option of the `shipping_endicia` section of the configuration, a CSV
+    file of:
+
+        zip5,state,city
+
+    Without it only the format of the fields is checked.
+
+"""
+import csv
+import re
+import string
+import threading
+
+from trytond.config import config
+
+__all__ = ['ZipIndex', 'get_zip_index', 'COUNTRY_RULES', 'validate']
+
+
+class ZipIndex(object):
+    """
+    US ZIP5 codes indexed in memory. The state of each ZIP5 is stored in a
+    bytearray at twice its value and the accepted cities in a dictionary.
+    """
+
+    def __init__(self):
+        self.states = bytearray(2 * 100000)
+        self.cities = {}
+
+    @classmethod
+    def from_file(cls, path):
+        index = cls()
+        with open(path, 'rb') as zip_file:
+            index.add(
+                row for row in csv.reader(zip_file)
+                if row and row[0].isdigit()
+            )
+        return index
+
+    def add(self, rows):
+        """
+        :param rows: Iterable of (zip5, state, city)
+        """
+        for zip5, state, city in rows:
+            position = 2 * int(zip5)
+            self.states[position:position + 2] = state.upper()[:2]
+            self.cities.setdefault(int(zip5), set()).add(_normalize(city))
+
+    def get_state(self, zip5):
+        """
+        Returns the state of the ZIP5 or None if it is unknown
+        """
+        position = 2 * int(zip5)
+        state = self.states[position:position + 2]
+        return state[0] and str(state) or None
+
+    def is_city(self, zip5, city):
+        return _normalize(city) in self.cities.get(int(zip5), ())
+
+
+def _normalize(city):
+    return ' '.join((city or '').upper().replace('.', ' ').split())
+
+
+_zip_index = []
+_zip_index_lock = threading.Lock()
+
+
+def get_zip_index():
+    """
+    Returns the ZipIndex of the configured file, or None if no file is
+    configured
+    """
+    path = config.get('shipping_endicia', 'zip_data')
+    if not path:
+        return None
+    if not _zip_index:
+        with _zip_index_lock:
+            if not _zip_index:
+                _zip_index.append(ZipIndex.from_file(path))
+    return _zip_index[0]
+
+
+# Rules of the fields of the addresses of each country, the None key being
+# the default. Other countries have their ZIP code truncated and their state
+# kept as is.
+COUNTRY_RULES = {
+    'US': {
+        'zip': re.compile(r'^(\d{5})(\d{4})?$'),
+        'state': True,
+        'phone': (10, 10),
+    },
+    'CA': {
+        'zip': re.compile(r'^([A-Z]\d[A-Z]\d[A-Z]\d)$'),
+        'state': True,
+        'phone': (10, 30),
+    },
+    None: {
+        'zip': re.compile(r'^(.{0,15})'),
+        'state': False,
+        'phone': (0, 30),
+    },
+}
+
+# Extension at the end of a phone number, which Endicia does not accept
+PHONE_EXTENSION = re.compile(
+    r'\s*(?:;\s*ext=|extension|ext\.?|x|#|,)\s*\d+\s*$', re.IGNORECASE
+)
+
+
+def _validate_zip(values, rules, errors):
+    """
+    Normalize the ZIP code of values
+
+    :return: True if it is valid
+    """
+    country = values.get('country')
+    zip_code = values.get('zip') or ''
+    if country in ('US', 'CA'):
+        zip_code = ''.join(char for char in zip_code.upper() if char.isalnum())
+        if not zip_code:
+            errors.append('ZIP code is missing')
+            return False
+    match = rules['zip'].match(zip_code)
+    if not match:
+        errors.append('ZIP code "%s" is invalid' % values.get('zip'))
+        return False
+    values['zip'] = match.group(1)
+    return True
+
+
+def _validate_state(values, rules, errors, valid_zip):
+    """
+    Normalize the state of values, deducing US states from the ZIP code
+    """
+    state = values.get('state') or None
+    if rules['state']:
+        state = (state or '').upper()
+        if not (len(state) == 2 and state.isalpha()):
+            state = None
+    index = get_zip_index()
+    if values.get('country') == 'US' and valid_zip and index is not None:
+        zip_state = index.get_state(values['zip'])
+        if zip_state is None:
+            errors.append('ZIP code "%s" does not exist' % values['zip'])
+        else:
+            state = zip_state
+            city = values.get('city')
+            if city and not index.is_city(values['zip'], city):
+                errors.append('City "%s" does not match ZIP code "%s"' % (
+                    city, values['zip']
+                ))
+    if rules['state'] and not state:
+        errors.append('State is missing or invalid')
+    values['state'] = state
+
+
+def _validate_phone(values, rules, errors):
+    """
+    Keep only the digits of the phone of values, without its extension nor
+    the country code of US numbers
+    """
+    phone = PHONE_EXTENSION.sub('', values.get('phone') or '')
+    phone = ''.join(char for char in phone if char in string.digits)
+    if values.get('country') == 'US' and len(phone) == 11 \
+            and phone.startswith('1'):
+        phone = phone[1:]
+    minimum, maximum = rules['phone']
+    if phone and not minimum <= len(phone) <= maximum:
+        errors.append('Phone "%s" is invalid' % values.get('phone'))
+    values['phone'] = phone or None
+
+
+def validate(address):
+    """
+    Normalize the values of the address and check them
+
+    :param address: Dictionary with the name, street, city, zip, state,
+                    country (code) and phone of the address
+    :return: Tuple of the normalized values and the list of errors
+    """
+    values = dict(address)
+    errors = []
+    rules = COUNTRY_RULES.get(values.get('country'), COUNTRY_RULES[None])
+
+    if not values.get('country'):
+        errors.append('Country is missing')
+    for field in ('name', 'street', 'city'):
+        if not values.get(field):
+            errors.append('%s is missing' % field.capitalize())
+    valid_zip = _validate_zip(values, rules, errors)
+    _validate_state(values, rules, errors, valid_zip)
+    _validate_phone(values, rules, errors)
+    return values, errors
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    audit
+
+    Audit log of the requests sent to Endicia.
+
+    Calls are recorded to two sinks:
+
+    * the `trytond.modules.shipping_endicia.audit` logger, at DEBUG level
+    * a store of JSON lines rotated by size, in the directory set by the
+      `audit_path` option of the `shipping_endicia` section of the
+      configuration, which can be queried with `search`
+
+    Nothing is serialized unless one of them is enabled. Successful calls
+    are sampled at `audit_sample_rate`, failures are always recorded. Pass
+    phrases are redacted and label images truncated.
+
+"""
+import glob
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+from trytond.config import config
+
+__all__ = ['is_enabled', 'record', 'redact', 'search']
+
+logger = logging.getLogger(__name__)
+
+# Directory of the audit store, disabled if not set
+PATH = config.get('shipping_endicia', 'audit_path')
+# Share of the successful calls recorded, between 0 and 1
+SAMPLE_RATE = config.getfloat(
+    'shipping_endicia', 'audit_sample_rate', default=1
+)
+# Size in bytes of a store file before it is rotated
+MAX_BYTES = config.getint(
+    'shipping_endicia', 'audit_max_bytes', default=10 * 1024 * 1024
+)
+# Number of rotated store files kept
+BACKUP_COUNT = config.getint(
+    'shipping_endicia', 'audit_backup_count', default=10
+)
+# Number of characters of the images kept in the records
+IMAGE_LENGTH = 64
+
+FILENAME = 'endicia_audit.log'
+
+_PASSPHRASE = re.compile(
+    r'(<(\w*PassPhrase)>)[^<]*(</\2>)', re.IGNORECASE
+)
+_IMAGE = re.compile(
+    r'(<(Base64LabelImage|Image|SCANForm)\b[^>]*>)([^<]{%d})([^<]+)(</\2>)'
+    % IMAGE_LENGTH
+)
+_TRACKING_NUMBER = re.compile(r'<TrackingNumber>([^<]+)</TrackingNumber>')
+_TRANSACTION_ID = re.compile(
+    r'<PartnerTransactionID>([^<]+)</PartnerTransactionID>', re.IGNORECASE
+)
+
+_store = []
+_store_lock = threading.Lock()
+
+
+def _get_store():
+    """
+    Returns the logger writing to the store, or None if it is disabled
+    """
+    if not PATH:
+        return None
+    if not _store:
+        with _store_lock:
+            if not _store:
+                if not os.path.isdir(PATH):
+                    os.makedirs(PATH, 0770)
+                handler = RotatingFileHandler(
+                    os.path.join(PATH, FILENAME), maxBytes=MAX_BYTES,
+                    backupCount=BACKUP_COUNT
+                )
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                store = logging.getLogger(__name__ + '.store')
+                store.propagate = False
+                store.setLevel(logging.INFO)
+                store.handlers = [handler]
+                _store.append(store)
+    return _store[0]
+
+
+def is_enabled():
+    """
+    Returns True if a sink records the calls
+    """
+    return bool(PATH) or logger.isEnabledFor(logging.DEBUG)
+
+
+def redact(xml):
+    """
+    Remove the pass phrases and truncate the images of the XML
+    """
+    if not xml:
+        return xml
+    xml = _PASSPHRASE.sub(r'\1[REDACTED]\3', xml)
+    return _IMAGE.sub(
+        lambda match: '%s%s...[%d more]%s' % (
+            match.group(1), match.group(3), len(match.group(4)),
+            match.group(5)
+        ), xml
+    )
+
+
+def record(api_request, response=None, error=None, duration=None):
+    """
+    Record a call to Endicia
+
+    :param api_request: Instance of the endicia API class sent
+    :param response: Response XML
+    :param error: Exception raised by the call
+    :param duration: Seconds the call took
+    """
+    if not is_enabled():
+        return
+    if error is None and random.random() >= SAMPLE_RATE:
+        return
+
+    request = redact(api_request.to_xml())
+    tracking_number = _TRACKING_NUMBER.search(response or '')
+    transaction_id = _TRANSACTION_ID.search(request)
+    entry = {
+        'time': time.time(),
+        'api': api_request.__class__.__name__,
+        'url': api_request.url,
+        'duration': duration,
+        'request': request,
+        'response': redact(response),
+        'error': error is not None and unicode(error) or None,
+        'tracking_number': tracking_number and tracking_number.group(1),
+        'transaction_id': transaction_id and transaction_id.group(1),
+    }
+    logger.debug('Endicia %(api)s call: %(request)s -> %(response)s', entry)
+    store = _get_store()
+    if store is not None:
+        store.info(json.dumps(entry))
+
+
+def search(**criteria):
+    """
+    Yield the records of the store, most recent file first, whose values
+    are equal to the criteria. For example:
+
+        search(tracking_number='9400111899223197428490')
+    """
+    if not PATH:
+        return
+    filenames = glob.glob(os.path.join(PATH, FILENAME + '*'))
+    filenames.sort(key=os.path.getmtime, reverse=True)
+    for filename in filenames:
+        with open(filename, 'rb') as store_file:
+            for line in store_file:
+                entry = json.loads(line)
+                if all(
+                        entry.get(key) == value
+                        for key, value in criteria.iteritems()):
+                    yield entry
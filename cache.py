@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+    cache
+
+    In-process caches used to avoid repeated round-trips to Endicia.
+
+"""
+import time
+import threading
+from collections import OrderedDict
+
+__all__ = ['TTLCache', 'SingleFlight']
+
+
+class TTLCache(object):
+    """
+    A thread safe LRU cache bounded in size, whose entries expire `ttl`
+    seconds after they were stored.
+
+    A cache with a `size_limit` or `ttl` of 0 stores nothing.
+    """
+
+    def __init__(self, size_limit=1024, ttl=600):
+        self.size_limit = size_limit
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None, stale=False):
+        """
+        Returns the value stored for key or default if it is missing or
+        expired. Expired values are kept until evicted and are returned if
+        stale is True.
+        """
+        with self._lock:
+            try:
+                expire, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expire < time.time() and not stale:
+                self._data[key] = (expire, value)
+                self.misses += 1
+                return default
+            # Re-insert to mark the key as the most recently used
+            self._data[key] = (expire, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Stores value for key, evicting the least recently used entries
+        when the cache is full
+        """
+        if self.size_limit <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.size_limit:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Drops all the entries and resets the counters
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dictionary with the hit/miss counters and current size
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+        }
+
+
+class _Call(object):
+    "A call in flight"
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical concurrent calls: while a call for a key is in
+    flight, the other callers with the same key wait for it and share its
+    result (or exception) instead of calling the function themselves.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Call function with args and kwargs unless a call for key is already
+        in flight, and return its result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception, error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
@@ -1,8 +1,19 @@
+from decimal import Decimal
+
+from endicia import AccountStatusAPI
+from endicia.tools import objectify_response
+from endicia.exceptions import RequestError
 from trytond.model import fields
 from trytond.pool import PoolMeta
 from trytond.pyson import Eval
 
-__all__ = ['Carrier', 'CarrierService', 'BoxType']
+from client import send_request
+from reference import clear_services
+
+__all__ = [
+    'Carrier', 'CarrierService', 'BoxType', 'ENDICIA_IMAGE_FORMATS',
+    'ENDICIA_IMAGE_RESOLUTIONS', 'get_endicia_label_size',
+]
 __metaclass__ = PoolMeta
 
 ENDICIA_STATES = {
@@ -10,6 +21,33 @@ ENDICIA_STATES = {
     'invisible': Eval('carrier_cost_method') != 'endicia',
 }
 
+ENDICIA_IMAGE_FORMATS = [
+    ('PNG', 'PNG'),
+    ('GIF', 'GIF'),
+    ('JPEG', 'JPEG'),
+    ('PDF', 'PDF'),
+    ('ZPLII', 'ZPL II'),
+    ('EPL2', 'EPL 2'),
+]
+ENDICIA_IMAGE_RESOLUTIONS = [
+    ('150', '150 dpi'),
+    ('203', '203 dpi'),
+    ('300', '300 dpi'),
+]
+# Formats of the thermal printers, which print 4x6 labels and not the
+# 6x4 ones of the laser printers
+ENDICIA_THERMAL_FORMATS = ['ZPLII', 'EPL2']
+
+
+def get_endicia_label_size(image_format, label_size):
+    """
+    Returns the size of the labels of image_format, 6x4 being printed as 4x6
+    on thermal printers
+    """
+    if image_format in ENDICIA_THERMAL_FORMATS and label_size == '6x4':
+        return '4x6'
+    return label_size
+
 
 class Carrier:
     __name__ = 'carrier'
@@ -20,6 +58,43 @@ class Carrier:
     endicia_is_test = fields.Boolean('Is Test', states={
         'invisible': Eval('carrier_cost_method') != 'endicia',
     })
+    endicia_local_rates = fields.Boolean('Use Local Rate Tables', states={
+        'invisible': Eval('carrier_cost_method') != 'endicia',
+    }, help='Compute domestic rates from the USPS rate tables configured '
+        'on the server instead of requesting them from Endicia')
+    endicia_image_format = fields.Selection(
+        ENDICIA_IMAGE_FORMATS, 'Label Format', states=ENDICIA_STATES,
+        help='ZPL II and EPL 2 labels are several times smaller than images '
+        'and can be sent to thermal printers as is'
+    )
+    endicia_label_size = fields.Selection([
+        ('4x6', '4x6'),
+        ('6x4', '6x4'),
+        ('4x5', '4x5'),
+        ('4x4.5', '4x4.5'),
+        ('DocTab', 'DocTab'),
+    ], 'Label Size', states=ENDICIA_STATES)
+    endicia_image_resolution = fields.Selection(
+        ENDICIA_IMAGE_RESOLUTIONS, 'Label Resolution', states=ENDICIA_STATES
+    )
+    endicia_image_rotation = fields.Selection([
+        ('None', 'None'),
+        ('Rotate90', 'Rotate 90'),
+        ('Rotate180', 'Rotate 180'),
+        ('Rotate270', 'Rotate 270'),
+    ], 'Label Rotation', states=ENDICIA_STATES)
+
+    endicia_postage_threshold = fields.Numeric(
+        'Postage Threshold', digits=(16, 2), states={
+            'invisible': Eval('carrier_cost_method') != 'endicia',
+        }, help='Postage balance under which the account is recredited'
+    )
+    endicia_recredit_amount = fields.Numeric(
+        'Recredit Amount', digits=(16, 2), states={
+            'invisible': Eval('carrier_cost_method') != 'endicia',
+        }, help='Minimum postage bought when the account is recredited, '
+        'leave empty to never recredit automatically'
+    )
 
     @classmethod
     def __setup__(cls):
@@ -28,6 +103,32 @@ class Carrier:
         if selection not in cls.carrier_cost_method.selection:
             cls.carrier_cost_method.selection.append(selection)
 
+    @staticmethod
+    def default_endicia_image_format():
+        return 'PNG'
+
+    @staticmethod
+    def default_endicia_label_size():
+        return '6x4'
+
+    @staticmethod
+    def default_endicia_image_resolution():
+        return '203'
+
+    @staticmethod
+    def default_endicia_image_rotation():
+        return 'Rotate270'
+
+    @classmethod
+    def write(cls, *args):
+        super(Carrier, cls).write(*args)
+        clear_services()
+
+    @classmethod
+    def delete(cls, carriers):
+        super(Carrier, cls).delete(carriers)
+        clear_services()
+
     @classmethod
     def view_attributes(cls):
         return super(Carrier, cls).view_attributes() + [
@@ -38,6 +139,34 @@ class Carrier:
             )
         ]
 
+    @staticmethod
+    def _parse_endicia_postage_balance(response_xml):
+        result = objectify_response(response_xml)
+        return Decimal(result.CertifiedIntermediary.PostageBalance.text)
+
+    def get_endicia_postage_balance(self):
+        """
+        Query the postage balance of the Endicia account.
+
+        Identical queries in flight share the same response.
+
+        :return: The balance in USD as a Decimal
+        """
+        account_status_request = AccountStatusAPI(
+            request_id=self.id,
+            accountid=self.endicia_account_id,
+            requesterid=self.endicia_requester_id,
+            passphrase=self.endicia_passphrase,
+            test=self.endicia_is_test,
+        )
+        try:
+            return send_request(
+                account_status_request,
+                parse=self._parse_endicia_postage_balance, coalesce=True
+            )
+        except RequestError, error:
+            self.raise_user_error(unicode(error))
+
 
 class CarrierService:
     __name__ = 'carrier.service'
@@ -56,6 +185,22 @@ class CarrierService:
             if selection not in cls.carrier_cost_method.selection:
                 cls.carrier_cost_method.selection.append(selection)
 
+    @classmethod
+    def create(cls, vlist):
+        services = super(CarrierService, cls).create(vlist)
+        clear_services()
+        return services
+
+    @classmethod
+    def write(cls, *args):
+        super(CarrierService, cls).write(*args)
+        clear_services()
+
+    @classmethod
+    def delete(cls, services):
+        super(CarrierService, cls).delete(services)
+        clear_services()
+
 
 class BoxType:
     __name__ = "carrier.box_type"
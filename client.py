@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    client
+
+    Sends requests built with the endicia API classes, through the timeouts,
+    retries and circuit breakers of the resilience module.
+
+"""
+import time
+import urllib
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from trytond.config import config
+
+from cache import SingleFlight
+from audit import record
+from resilience import call
+from transport import get_transport
+
+__all__ = ['send_request', 'send_requests', 'iter_requests']
+
+# Number of requests sent at the same time by send_requests
+WORKERS = config.getint('shipping_endicia', 'workers', default=8)
+
+# Requests in flight, keyed on their URL and XML payload
+IN_FLIGHT = SingleFlight()
+
+
+def _is_streaming(parse):
+    """
+    Returns True if parse is a streaming parser: an object with a `stream`
+    method called with the response XML and the flags of the request, which
+    it sets from the same pass as the parse
+    """
+    return hasattr(parse, 'stream')
+
+
+def _request(api_request, values, timeout=None, parse=None):
+    """
+    Replacement of APIBaseClass.request which sends the request on a pooled
+    connection and does not wait for the response longer than timeout
+
+    The response of a streaming parser is parsed once by the parser, instead
+    of into the tree of api_request.response first.
+    """
+    data = urllib.urlencode(values)
+    start, response = time.time(), None
+    try:
+        response = get_transport().post(api_request.url, data, timeout)
+        if _is_streaming(parse):
+            result = parse.stream(response, api_request.flags)
+        else:
+            result = api_request._set_flags(response)
+    except Exception, error:
+        record(api_request, response, error, time.time() - start)
+        raise
+    record(api_request, response, duration=time.time() - start)
+    return result
+
+
+def _send_request(api_request, timeout, parse=None):
+    api_request.request = partial(
+        _request, api_request, timeout=timeout, parse=parse
+    )
+    return api_request.send_request()
+
+
+def send_request(api_request, timeout=None, parse=None, coalesce=False):
+    """
+    Send the request and return the response XML.
+
+    :param api_request: Instance of one of the endicia API classes
+    :param timeout: Seconds to wait for the response, by default the
+                    timeout of the endpoint
+    :param parse: Function called with the response XML, whose result is
+                  returned instead of the response, or a streaming parser
+    :param coalesce: If True and an identical request is already in flight,
+                     wait for it and share its (parsed) response instead of
+                     sending the request again. Only use for requests which
+                     have no side effect.
+    """
+    if coalesce:
+        key = (api_request.url, api_request.to_xml(), parse)
+        return IN_FLIGHT.do(key, send_request, api_request, timeout, parse)
+
+    response = call(
+        api_request, partial(_send_request, api_request, parse=parse),
+        timeout=timeout
+    )
+    if parse is not None and not _is_streaming(parse):
+        return parse(response)
+    return response
+
+
+def send_requests(api_requests, workers=WORKERS, timeout=None, parse=None,
+        coalesce=False):
+    """
+    Send the requests concurrently, at most `workers` at a time.
+
+    :param api_requests: List of instances of the endicia API classes
+    :param workers: Maximum number of requests in flight
+    :param timeout: Seconds to wait for the response of each request
+    :param parse: Same as for send_request, or a list of functions to parse
+                  the response of each request
+    :param coalesce: Same as for send_request
+    :return: List of (response, exception) tuples in the order of the
+             requests, exception being None for successful requests
+    """
+    if not api_requests:
+        return []
+
+    if not isinstance(parse, list):
+        parse = [parse] * len(api_requests)
+
+    pool = ThreadPool(max(1, min(workers, len(api_requests))))
+    try:
+        async_results = [
+            pool.apply_async(
+                send_request, (api_request, timeout, parse_, coalesce)
+            )
+            for api_request, parse_ in zip(api_requests, parse)
+        ]
+        results = []
+        for async_result in async_results:
+            try:
+                results.append((async_result.get(), None))
+            except Exception, error:
+                results.append((None, error))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def _send_indexed_request(args):
+    index, api_request, timeout, parse = args
+    try:
+        return index, send_request(api_request, timeout, parse), None
+    except Exception, error:
+        return index, None, error
+
+
+def iter_requests(api_requests, workers=WORKERS, timeout=None, parse=None):
+    """
+    Send the requests concurrently like send_requests, but yield the
+    result of each request as soon as it is received, so that it can be
+    processed and released while the other requests are in flight.
+
+    :return: Iterator of (index of the request, response, exception) in the
+             order the responses are received
+    """
+    if not api_requests:
+        return
+
+    if not isinstance(parse, list):
+        parse = [parse] * len(api_requests)
+
+    arguments = [
+        (index, api_request, timeout, parse[index])
+        for index, api_request in enumerate(api_requests)
+    ]
+    pool = ThreadPool(max(1, min(workers, len(api_requests))))
+    try:
+        for result in pool.imap_unordered(_send_indexed_request, arguments):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
@@ -6,6 +6,10 @@
 from trytond.pool import PoolMeta
 from trytond.model import fields
 
+from reference import get_endicia_country_name_column, \
+    get_endicia_country_names, clear_endicia_country_names, \
+    clear_address_payloads
+
 __metaclass__ = PoolMeta
 __all__ = ['Country']
 
@@ -14,14 +18,54 @@ class Country:
     'Country'
     __name__ = 'country.country'
 
-    endicia_country_name = fields.Char('Endicia Country Name')
+    endicia_country_name = fields.Char('Endicia Country Name', select=True)
     endicia_name = fields.Function(
-        fields.Char('Endicia Name'), 'get_endicia_name'
+        fields.Char('Endicia Name'), 'get_endicia_name',
+        searcher='search_endicia_name'
     )
 
-    def get_endicia_name(self, name):
+    @classmethod
+    def get_endicia_name(cls, countries, name):
         """
-        Checks if there is some name defined in endicia_country_name
-        and returns it, else returns the name of country
+        Returns the name defined in endicia_country_name if any, else the
+        untranslated name of the country, from the map of all the countries
         """
-        return self.endicia_country_name or self.name
+        names = get_endicia_country_names()
+        return dict(
+            (country.id, names.get(country.code)) for country in countries
+        )
+
+    @classmethod
+    def search_endicia_name(cls, name, clause):
+        table = cls.__table__()
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        query = table.select(
+            table.id,
+            where=Operator(get_endicia_country_name_column(table), value)
+        )
+        return [('id', 'in', query)]
+
+    @staticmethod
+    def order_endicia_name(tables):
+        table, _ = tables[None]
+        return [get_endicia_country_name_column(table)]
+
+    @classmethod
+    def create(cls, vlist):
+        countries = super(Country, cls).create(vlist)
+        clear_endicia_country_names()
+        clear_address_payloads()
+        return countries
+
+    @classmethod
+    def write(cls, *args):
+        super(Country, cls).write(*args)
+        clear_endicia_country_names()
+        clear_address_payloads()
+
+    @classmethod
+    def delete(cls, countries):
+        super(Country, cls).delete(countries)
+        clear_endicia_country_names()
+        clear_address_payloads()
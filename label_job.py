@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+    label_job
+
+    Queue of shipments waiting for their Endicia label, processed in the
+    background by a cron.
+
+"""
+import logging
+from datetime import datetime, timedelta
+
+from endicia.exceptions import RequestError
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.config import config
+
+__all__ = ['LabelJob']
+
+logger = logging.getLogger(__name__)
+
+# Number of jobs claimed by a worker at a time
+BATCH_SIZE = config.getint('shipping_endicia', 'label_job_batch', default=50)
+# Number of attempts before a job is dead-lettered
+MAX_ATTEMPTS = config.getint(
+    'shipping_endicia', 'label_job_attempts', default=5
+)
+# Seconds to wait before the first retry, doubled on each new attempt
+BACKOFF = config.getint('shipping_endicia', 'label_job_backoff', default=60)
+# Seconds after which a job still processing is deemed abandoned by its
+# worker and is queued again
+CLAIM_TIMEOUT = config.getint(
+    'shipping_endicia', 'label_job_timeout', default=3600
+)
+
+
+class LabelJob(ModelSQL, ModelView):
+    'Endicia Label Job'
+    __name__ = 'endicia.label.job'
+
+    shipment = fields.Many2One(
+        'stock.shipment.out', 'Shipment', required=True, readonly=True,
+        select=True, ondelete='CASCADE'
+    )
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True)
+    claimed_at = fields.DateTime('Claimed At', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(LabelJob, cls).__setup__()
+        cls._buttons.update({
+            'retry': {
+                'invisible': ~Eval('state').in_(['failed']),
+            },
+        })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def enqueue(cls, shipments):
+        """
+        Create a pending job for the shipments which do not have one yet
+
+        :return: List of the created jobs
+        """
+        queued = set(job.shipment.id for job in cls.search([
+            ('shipment', 'in', map(int, shipments)),
+            ('state', 'in', ['pending', 'processing']),
+        ]))
+        return cls.create([{
+            'shipment': shipment.id,
+        } for shipment in shipments if shipment.id not in queued])
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, jobs):
+        """
+        Put failed jobs back in the queue
+        """
+        cls.write(jobs, {
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': None,
+            'error': None,
+        })
+
+    @classmethod
+    def _claim(cls, limit):
+        """
+        Mark due pending jobs as processing and commit, so that other workers
+        do not pick them up.
+
+        :return: List of the claimed job ids
+        """
+        with Transaction().new_transaction() as transaction:
+            transaction.database.lock(transaction.connection, cls._table)
+            now = datetime.utcnow()
+            jobs = cls.search([
+                ('state', '=', 'pending'),
+                ['OR',
+                    ('next_attempt', '=', None),
+                    ('next_attempt', '<=', now),
+                ],
+            ], limit=limit, order=[('id', 'ASC')])
+            cls.write(jobs, {
+                'state': 'processing',
+                'claimed_at': now,
+            })
+            return map(int, jobs)
+
+    @classmethod
+    def _reclaim(cls):
+        """
+        Record a failed attempt for the jobs claimed more than CLAIM_TIMEOUT
+        seconds ago and still processing, as their worker stopped before
+        saving their result, so that they are tried again.
+
+        :return: List of the reclaimed job ids
+        """
+        with Transaction().new_transaction() as transaction:
+            transaction.database.lock(transaction.connection, cls._table)
+            jobs = cls.search([
+                ('state', '=', 'processing'),
+                ['OR',
+                    ('claimed_at', '=', None),
+                    ('claimed_at', '<', datetime.utcnow() - timedelta(
+                        seconds=CLAIM_TIMEOUT)),
+                ],
+            ])
+            for job in jobs:
+                logger.warning('Endicia label job %s was abandoned', job.id)
+                cls.write([job], job._get_fail_values(
+                    'Abandoned by its worker'
+                ))
+            return map(int, jobs)
+
+    @classmethod
+    def _get_requests(cls, job_ids):
+        """
+        Build the ShippingLabelAPI requests of the packages of the jobs
+
+        :return: Tuple of a list of (job id, list of (package id, request))
+                 and a dictionary mapping the id of the jobs whose requests
+                 could not be built to a (error, permanent) tuple
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        to_send, errors = [], {}
+        with Transaction().new_transaction(readonly=True):
+            jobs = cls.browse(job_ids)
+            shipments = [job.shipment for job in jobs]
+            Shipment._load_endicia_customs_profiles(shipments)
+            Shipment._load_endicia_addresses(shipments)
+            for job in jobs:
+                shipment = job.shipment
+                try:
+                    shipment.allow_label_generation()
+                    to_send.append((job.id, [
+                        (package.id, request) for package, request
+                        in shipment._get_endicia_label_requests()
+                    ]))
+                except UserError, error:
+                    errors[job.id] = (error, True)
+        return to_send, errors
+
+    @classmethod
+    def _save_labels(cls, job_id, labels):
+        """
+        Save the labels of the job in its own transaction
+
+        :param labels: List of (package id, response XML)
+        """
+        Package = Pool().get('stock.package')
+
+        with Transaction().new_transaction():
+            job = cls(job_id)
+            job.shipment._save_endicia_labels([
+                (Package(package_id), response)
+                for package_id, response in labels
+            ])
+            cls.write([job], {
+                'state': 'done',
+                'attempts': job.attempts + 1,
+                'error': None,
+            })
+
+    def _get_fail_values(self, error, permanent=False):
+        """
+        Returns the values recording the error of the job. The job is tried
+        again later unless the error is permanent or it has run out of
+        attempts.
+        """
+        attempts = self.attempts + 1
+        values = {
+            'attempts': attempts,
+            'error': getattr(error, 'message', None) or unicode(error),
+        }
+        if permanent or attempts >= MAX_ATTEMPTS:
+            values['state'] = 'failed'
+        else:
+            values['state'] = 'pending'
+            values['next_attempt'] = datetime.utcnow() + timedelta(
+                seconds=BACKOFF * 2 ** (attempts - 1)
+            )
+        return values
+
+    @classmethod
+    def _fail(cls, job_id, error, permanent=False):
+        """
+        Record the error of the job in its own transaction
+        """
+        with Transaction().new_transaction():
+            job = cls(job_id)
+            cls.write([job], job._get_fail_values(error, permanent))
+
+    @classmethod
+    def process(cls, limit=BATCH_SIZE):
+        """
+        Claim due jobs, send their label requests concurrently and save the
+        result of each job independently.
+
+        Meant to be called by the cron. Several workers can run it at the
+        same time as each claims different jobs. The jobs abandoned by a
+        worker are queued again first.
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        cls._reclaim()
+        job_ids = cls._claim(limit)
+        if not job_ids:
+            return
+
+        to_send, errors = cls._get_requests(job_ids)
+        all_results = Shipment._send_endicia_label_requests([
+            label_requests for _, label_requests in to_send
+        ])
+        for (job_id, _), results in zip(to_send, all_results):
+            failed = [error for _, _, error in results if error is not None]
+            if failed:
+                # Errors returned by Endicia are permanent, network errors
+                # are retried
+                errors[job_id] = (failed[0], any(
+                    isinstance(error, RequestError) for error in failed
+                ))
+                continue
+            try:
+                cls._save_labels(job_id, [
+                    (package_id, response)
+                    for package_id, response, _ in results
+                ])
+            except Exception, error:
+                # The label is paid for, so it must not be bought again
+                errors[job_id] = (error, True)
+
+        for job_id, (error, permanent) in errors.iteritems():
+            logger.warning('Endicia label job %s failed: %s', job_id, error)
+            cls._fail(job_id, error, permanent)
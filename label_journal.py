@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+    label_journal
+
+    Journal of the label requests sent to Endicia, which makes buying a
+    label idempotent.
+
+    Each request is recorded, and committed, before it is sent under a
+    unique partner transaction id, and its response is committed as soon
+    as it is received. A label whose response was received but not saved
+    is recovered from the journal instead of being bought again, and a
+    request whose outcome is unknown blocks new purchases until it is
+    reviewed.
+
+"""
+import logging
+from datetime import datetime, timedelta
+
+from endicia.exceptions import RequestError
+
+from trytond.model import ModelSQL, ModelView, fields, Unique
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.config import config
+
+from resilience import was_sent
+from locking import wait_locks
+
+__all__ = ['LabelRequest']
+
+logger = logging.getLogger(__name__)
+
+# States of the requests which prevent a new purchase for the package
+ACTIVE_STATES = ['sent', 'received', 'unknown']
+# Seconds after which a request still sent is deemed abandoned by its
+# worker, its outcome being unknown
+SENT_TIMEOUT = config.getint(
+    'shipping_endicia', 'label_request_timeout', default=600
+)
+
+
+class LabelRequest(ModelSQL, ModelView):
+    'Endicia Label Request'
+    __name__ = 'endicia.label.request'
+
+    package = fields.Reference(
+        'Package', selection=[('stock.package', 'Package')],
+        required=True, readonly=True, select=True
+    )
+    transaction_id = fields.Char(
+        'Partner Transaction ID', required=True, readonly=True
+    )
+    state = fields.Selection([
+        ('sent', 'Sent'),
+        ('received', 'Received'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('unknown', 'Unknown'),
+    ], 'State', required=True, readonly=True, select=True)
+    sent_at = fields.DateTime('Sent At', readonly=True)
+    response = fields.Text('Response', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(LabelRequest, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_constraints += [
+            ('transaction_id_uniq', Unique(table, table.transaction_id),
+                'The partner transaction id must be unique.'),
+        ]
+        cls._error_messages.update({
+            'request_in_progress': 'A label was already requested for '
+                'package "%s" (transaction %s) and its outcome is not known '
+                'yet. Release the request once you have checked it was not '
+                'charged.',
+        })
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._buttons.update({
+            'release': {
+                'invisible': ~Eval('state').in_(['sent', 'unknown']),
+            },
+        })
+
+    @classmethod
+    @ModelView.button
+    def release(cls, requests):
+        """
+        Allow a new label to be bought for the packages of requests whose
+        outcome is not known
+        """
+        cls.write(requests, {
+            'state': 'failed',
+            'response': None,
+        })
+
+    @classmethod
+    def begin(cls, package_ids):
+        """
+        Record a request for each package and commit them before anything
+        is sent.
+
+        :param package_ids: List of the ids of the packages
+        :return: List of (request id, transaction id, response, error) for
+                 each package. The transaction id is set only if a request
+                 must be sent, otherwise either the response received earlier
+                 or an error is returned.
+        """
+        Package = Pool().get('stock.package')
+
+        references = ['stock.package,%d' % i for i in package_ids]
+        results = []
+        # Workers requesting labels for the same packages wait for each other
+        # instead of failing
+        with wait_locks(cls.__name__, package_ids), \
+                Transaction().new_transaction():
+            previous = {}
+            requests = cls.search([
+                ('package', 'in', references),
+            ], order=[('id', 'ASC')])
+            for request in requests:
+                previous.setdefault(str(request.package), []).append(request)
+            cls._expire([r for r in requests if r.state == 'sent'])
+
+            to_create = []
+            for reference in references:
+                requests = previous.get(reference, [])
+                active = [r for r in requests if r.state in ACTIVE_STATES]
+                if not active:
+                    to_create.append({
+                        'package': reference,
+                        'transaction_id': '%s-%d' % (
+                            reference.split(',')[1], len(requests) + 1
+                        ),
+                        'state': 'sent',
+                        'sent_at': datetime.utcnow(),
+                    })
+                    results.append(None)
+                elif active[-1].state == 'received':
+                    results.append(
+                        (active[-1].id, None, active[-1].response, None)
+                    )
+                else:
+                    message = cls.raise_user_error(
+                        'request_in_progress', error_args=(
+                            Package(int(reference.split(',')[1])).rec_name,
+                            active[-1].transaction_id,
+                        ), raise_exception=False
+                    )
+                    results.append(
+                        (active[-1].id, None, None, UserError(message))
+                    )
+
+            created = iter(cls.create(to_create))
+            for index, result in enumerate(results):
+                if result is None:
+                    request = next(created)
+                    results[index] = (
+                        request.id, request.transaction_id, None, None
+                    )
+        return results
+
+    @classmethod
+    def _expire(cls, requests):
+        """
+        Mark the requests sent more than SENT_TIMEOUT seconds ago as unknown,
+        as their worker stopped before recording their outcome
+        """
+        limit = datetime.utcnow() - timedelta(seconds=SENT_TIMEOUT)
+        expired = [
+            r for r in requests if r.sent_at is None or r.sent_at < limit
+        ]
+        for request in expired:
+            logger.warning(
+                'Endicia label request %s was abandoned',
+                request.transaction_id
+            )
+        if expired:
+            cls.write(expired, {
+                'state': 'unknown',
+                'error': 'No outcome was recorded by the worker',
+            })
+
+    @classmethod
+    def record(cls, results):
+        """
+        Commit the outcome of the requests sent
+
+        :param results: List of (request id, response, exception)
+        """
+        with Transaction().new_transaction():
+            for request_id, response, error in results:
+                if error is None:
+                    values = {'state': 'received', 'response': response}
+                elif isinstance(error, RequestError) or not was_sent(error):
+                    # Endicia refused the request or never received it,
+                    # nothing was charged
+                    values = {'state': 'failed', 'error': unicode(error)}
+                else:
+                    # The label may have been bought
+                    values = {
+                        'state': 'unknown',
+                        'error': getattr(error, 'message', None),
+                    }
+                    values['error'] = values['error'] or unicode(error)
+                cls.write([cls(request_id)], values)
+
+    @classmethod
+    def done(cls, packages):
+        """
+        Mark the received requests of the packages as done once the current
+        transaction, which saves their labels, is committed. They stay
+        recoverable if it is rolled back.
+        """
+        datamanager = Transaction().join(LabelRequestDataManager())
+        datamanager.package_ids.update(package.id for package in packages)
+
+
+class LabelRequestDataManager(object):
+    """
+    Mark the received requests of packages as done after the commit of the
+    transaction it joined, in a transaction of its own which sees the
+    requests committed by the journal.
+    """
+
+    def __init__(self):
+        self.package_ids = set()
+
+    def __eq__(self, other):
+        if not isinstance(other, LabelRequestDataManager):
+            return NotImplemented
+        return True
+
+    def abort(self, trans):
+        self.package_ids.clear()
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        LabelRequest = Pool().get('endicia.label.request')
+
+        package_ids, self.package_ids = self.package_ids, set()
+        if not package_ids:
+            return
+        with trans.new_transaction():
+            requests = LabelRequest.search([
+                ('package', 'in', [
+                    'stock.package,%d' % i for i in package_ids
+                ]),
+                ('state', '=', 'received'),
+            ])
+            LabelRequest.write(requests, {
+                'state': 'done',
+                # The label is saved, its images are not needed anymore
+                'response': None,
+            })
+
+    def tpc_abort(self, trans):
+        self.package_ids.clear()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+    label_store
+
+    Storage of the label images and SCAN forms returned by Endicia outside
+    of the attachments.
+
+    The store is set by the `label_store` option of the `shipping_endicia`
+    section of the configuration, as an URL whose scheme selects the store:
+
+        [shipping_endicia]
+        label_store = file:///var/lib/trytond/labels
+
+    Without it, images are kept in the data of the attachments.
+
+"""
+import abc
+import base64
+import errno
+import hashlib
+import os
+import string
+import tempfile
+import threading
+import urllib
+import urllib2
+from contextlib import closing
+from StringIO import StringIO
+from urlparse import urlparse
+
+from trytond.config import config
+from trytond.pool import Pool
+
+__all__ = [
+    'LabelStore', 'FileLabelStore', 'STORES', 'get_label_store',
+    'decode_base64', 'decoded_size', 'save_label', 'open_label',
+    'read_label',
+]
+
+# Size of the base64 chunks decoded at a time, a multiple of 4
+CHUNK_SIZE = 64 * 1024
+
+
+class LabelStore(object):
+    """
+    Base class of the label stores
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, url):
+        self.url = url
+
+    @abc.abstractmethod
+    def put(self, chunks):
+        """
+        Store the image made of chunks
+
+        :param chunks: Iterable of strings
+        :return: URL of the stored image
+        """
+
+    def contains(self, url):
+        """
+        Returns True if url is the one of an image of the store
+        """
+        return url.startswith(self.url.rstrip('/') + '/')
+
+    def open(self, url):
+        """
+        Returns a file object reading the image stored at url
+        """
+        if not self.contains(url):
+            raise ValueError('"%s" is not in the label store' % url)
+        return urllib2.urlopen(url)
+
+
+class FileLabelStore(LabelStore):
+    """
+    Content addressed store on the filesystem. Images are named after the
+    SHA-256 of their content, in directories sharded on its first 4 digits,
+    so identical images are stored once.
+    """
+
+    def __init__(self, url):
+        super(FileLabelStore, self).__init__(url)
+        self.path = urllib.url2pathname(urlparse(url).path)
+
+    def _get_filename(self, digest):
+        return os.path.join(self.path, digest[0:2], digest[2:4], digest)
+
+    def put(self, chunks):
+        if not os.path.isdir(self.path):
+            self._makedirs(self.path)
+        digest = hashlib.sha256()
+        fd, temp_name = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+            filename = self._get_filename(digest.hexdigest())
+            self._makedirs(os.path.dirname(filename))
+            os.rename(temp_name, filename)
+        except Exception:
+            os.remove(temp_name)
+            raise
+        return 'file://' + urllib.pathname2url(filename)
+
+    def _get_path(self, url):
+        """
+        Returns the real path of the file of url, or None if it is not under
+        the directory of the store
+        """
+        parsed = urlparse(url)
+        if parsed.scheme != 'file':
+            return None
+        path = os.path.realpath(urllib.url2pathname(parsed.path))
+        if not path.startswith(os.path.join(os.path.realpath(self.path), '')):
+            return None
+        return path
+
+    def contains(self, url):
+        return self._get_path(url) is not None
+
+    def open(self, url):
+        path = self._get_path(url)
+        if path is None:
+            raise ValueError('"%s" is not in the label store' % url)
+        return open(path, 'rb')
+
+    @staticmethod
+    def _makedirs(path):
+        try:
+            os.makedirs(path, 0770)
+        except OSError, error:
+            if error.errno != errno.EEXIST:
+                raise
+
+
+# Classes of the label stores by URL scheme
+STORES = {
+    'file': FileLabelStore,
+}
+
+_label_store = []
+_label_store_lock = threading.Lock()
+
+
+def get_label_store():
+    """
+    Returns the configured LabelStore or None if images are kept in the
+    attachments
+    """
+    url = config.get('shipping_endicia', 'label_store')
+    if not url:
+        return None
+    if not _label_store:
+        with _label_store_lock:
+            if not _label_store:
+                _label_store.append(
+                    STORES[urlparse(url).scheme or 'file'](url)
+                )
+    return _label_store[0]
+
+
+def decode_base64(data, chunk_size=CHUNK_SIZE):
+    """
+    Decode the base64 data by chunks, without building the whole decoded
+    image in memory
+    """
+    if isinstance(data, unicode):
+        data = data.encode('ascii')
+    data = data.translate(None, string.whitespace)
+    for index in xrange(0, len(data), chunk_size):
+        yield base64.b64decode(data[index:index + chunk_size])
+
+
+def decoded_size(data):
+    """
+    Returns the size in bytes of the base64 data once decoded, without
+    decoding it
+    """
+    if isinstance(data, unicode):
+        data = data.encode('ascii')
+    length = len(data) - sum(data.count(c) for c in string.whitespace)
+    return length // 4 * 3 - data.rstrip()[-2:].count('=')
+
+
+def save_label(name, data, resource):
+    """
+    Save the image as an attachment of resource
+
+    :param name: Name of the attachment
+    :param data: Base64 encoded image
+    :param resource: Record the image is attached to
+    :return: The attachment
+    """
+    Attachment = Pool().get('ir.attachment')
+
+    values = {
+        'name': name,
+        'resource': '%s,%d' % (resource.__name__, resource.id),
+    }
+    store = get_label_store()
+    if store is None:
+        values['data'] = buffer(base64.decodestring(data))
+    else:
+        # The attachment only keeps the URL of the image
+        values['type'] = 'link'
+        values['link'] = store.put(decode_base64(data))
+    attachment, = Attachment.create([values])
+    return attachment
+
+
+def open_label(attachment):
+    """
+    Returns a file object reading the image of the attachment, streamed
+    from the store if it is stored there
+    """
+    if attachment.type == 'link':
+        # Links can be edited by users, so only the images of the store are
+        # read and not any URL the server can reach
+        store = get_label_store()
+        if store is None or not store.contains(attachment.link):
+            raise ValueError(
+                '"%s" is not in the label store' % attachment.link
+            )
+        return store.open(attachment.link)
+    return StringIO(attachment.data or '')
+
+
+def read_label(attachment):
+    """
+    Returns the image of the attachment
+    """
+    with closing(open_label(attachment)) as label:
+        return label.read()
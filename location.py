@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+    location.py
+
+"""
+from trytond.pool import PoolMeta
+from trytond.model import fields
+from trytond.pyson import Eval
+
+from carrier import ENDICIA_IMAGE_FORMATS, ENDICIA_IMAGE_RESOLUTIONS
+
+__metaclass__ = PoolMeta
+__all__ = ['Location']
+
+STATES = {
+    'invisible': Eval('type') != 'warehouse',
+}
+DEPENDS = ['type']
+
+
+class Location:
+    __name__ = 'stock.location'
+
+    endicia_image_format = fields.Selection(
+        [(None, '')] + ENDICIA_IMAGE_FORMATS, 'Endicia Label Format',
+        states=STATES, depends=DEPENDS,
+        help='Format of the Endicia labels printed at this warehouse, '
+        'overrides the one of the carrier'
+    )
+    endicia_image_resolution = fields.Selection(
+        [(None, '')] + ENDICIA_IMAGE_RESOLUTIONS, 'Endicia Label Resolution',
+        states=STATES, depends=DEPENDS,
+        help='Resolution of the printers of this warehouse, overrides the '
+        'one of the carrier'
+    )
+    endicia_manifest_cutoff = fields.Time(
+        'Endicia Manifest Cutoff', states=STATES, depends=DEPENDS,
+        help='Time of the day (UTC) at which the open Endicia manifests of '
+        'this warehouse are closed'
+    )
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+    locking
+
+    Locks serializing the workers which decide on the same records.
+
+"""
+import zlib
+from contextlib import contextmanager
+
+from trytond import backend
+from trytond.transaction import Transaction
+
+__all__ = ['wait_locks']
+
+
+@contextmanager
+def wait_locks(name, ids):
+    """
+    Hold a lock on each of the ids of name until the block is left, waiting
+    for the other workers holding one of them.
+
+    The locks are held by a transaction of their own, so the transactions
+    started in the block take their snapshot once the locks are acquired
+    and see what the previous holders committed. SQLite serializes the
+    transactions, so nothing is locked.
+    """
+    if backend.name() == 'sqlite':
+        yield
+        return
+    key = zlib.crc32(name)
+    with Transaction().new_transaction() as transaction:
+        cursor = transaction.connection.cursor()
+        # Sorted to prevent deadlocks between workers locking many ids
+        for id_ in sorted(set(ids)):
+            cursor.execute(
+                'SELECT pg_advisory_xact_lock(%s, %s)', (key, id_)
+            )
+        yield
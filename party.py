@@ -8,61 +8,110 @@ Customizes party address to have address in correct format for Endicia API .
 import string
 
 from endicia import FromAddress, ToAddress
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
 
-__all__ = ['Address']
+from reference import get_endicia_country_names, get_address_payloads, \
+    invalidate_address_payloads
+from address_validation import validate
+
+__all__ = ['Address', 'Party', 'ContactMechanism']
 __metaclass__ = PoolMeta
 
 
+def invalidate_party_payloads(party_ids):
+    """
+    Forget the Endicia payloads of all the addresses of the parties
+    """
+    Address = Pool().get('party.address')
+
+    with Transaction().set_context(active_test=False):
+        addresses = Address.search([('party', 'in', list(party_ids))])
+    invalidate_address_payloads(map(int, addresses))
+
+
 class Address:
     '''
     Address
     '''
     __name__ = "party.address"
 
-    def address_to_endicia_from_address(self):
-        '''
-        Converts party address to Endicia From Address.
+    @classmethod
+    def __setup__(cls):
+        super(Address, cls).__setup__()
+        cls._error_messages.update({
+            'invalid_endicia_address':
+                'Address "%s" would be rejected by Endicia:\n%s',
+        })
 
-        :param return: Returns instance of FromAddress
-        '''
-        if getattr(self, 'phone'):
-            phone = getattr(self, 'phone')
-        else:
-            phone = self.party.phone
+    @classmethod
+    def write(cls, *args):
+        super(Address, cls).write(*args)
+        invalidate_address_payloads(
+            [address.id for addresses in args[::2] for address in addresses]
+        )
 
+    @classmethod
+    def delete(cls, addresses):
+        invalidate_address_payloads(map(int, addresses))
+        super(Address, cls).delete(addresses)
+
+    def _get_endicia_phone(self):
+        '''
+        Returns the digits of the phone of the address or of its party
+        '''
+        phone = getattr(self, 'phone', None) or self.party.phone
         if phone:
             # Remove the special characters in the phone if any
             phone = "".join([char for char in phone if char in string.digits])
-        return FromAddress(
-            FromName=self.name or self.party.name,
-            # FromCompany = user_rec.company.name or None,
-            ReturnAddress1=self.street,
-            ReturnAddress2=self.streetbis,
-            ReturnAddress3=None,
-            ReturnAddress4=None,
-            FromCity=self.city,
-            FromState=self.subdivision and self.subdivision.code[3:],
-            FromPostalCode=self.zip and self.zip[:5],
-            FromPhone=phone and phone[-10:],
-            FromEMail=self.party.email,
-        )
+        return phone
 
-    def address_to_endicia_to_address(self):
+    def _get_endicia_address_values(self):
         '''
-        Converts party address to Endicia To Address.
+        Returns the normalized values of the address and the list of the
+        problems Endicia would reject it for
+        '''
+        return validate({
+            'name': self.name or self.party.name,
+            'street': self.street,
+            'city': self.city,
+            'zip': self.zip,
+            'state': self.subdivision and self.subdivision.code[3:],
+            'country': self.country and self.country.code,
+            'phone': getattr(self, 'phone', None) or self.party.phone,
+        })
 
-        :param return: Returns instance of ToAddress
+    def _get_endicia_from_values(self):
+        '''
+        Returns the values of the Endicia From Address of the address
+        '''
+        phone = self._get_endicia_phone()
+        return {
+            'FromName': self.name or self.party.name,
+            'ReturnAddress1': self.street,
+            'ReturnAddress2': self.streetbis,
+            'ReturnAddress3': None,
+            'ReturnAddress4': None,
+            'FromCity': self.city,
+            'FromState': self.subdivision and self.subdivision.code[3:],
+            'FromPostalCode': self.zip and self.zip[:5],
+            'FromPhone': phone and phone[-10:],
+            'FromEMail': self.party.email,
+        }
+
+    def _get_endicia_to_values(self, values, errors):
+        '''
+        Returns the values of the Endicia To Address of the address
+
+        :param values, errors: Result of _get_endicia_address_values
         '''
-        if getattr(self, 'phone'):
-            phone = getattr(self, 'phone')
-        else:
-            phone = self.party.phone
+        phone = self._get_endicia_phone()
         zip = self.zip
+        if not errors and values['country'] in ('US', 'CA'):
+            # Use the ZIP code cleaned up and the state deduced from it
+            zip = values['zip']
 
         if phone:
-            # Remove the special characters in the phone if any
-            phone = "".join([char for char in phone if char in string.digits])
             if self.country and self.country.code != 'US':
                 # International
                 phone = phone[-30:]
@@ -72,18 +121,116 @@ class Address:
                 phone = phone[-10:]
                 zip = zip and zip[:5]
 
-        return ToAddress(
-            ToName=self.name or self.party.name,
-            ToCompany=self.name or self.party.name,
-            ToAddress1=self.street,
-            ToAddress2=self.streetbis,
-            ToAddress3=None,
-            ToAddress4=None,
-            ToCity=self.city,
-            ToState=self.subdivision and self.subdivision.code[3:],
-            ToPostalCode=zip,
-            ToCountry=self.country and self.country.endicia_name,
-            ToCountryCode=self.country and self.country.code,
-            ToPhone=phone,
-            ToEMail=self.party.email,
+        return {
+            'ToName': self.name or self.party.name,
+            'ToCompany': self.name or self.party.name,
+            'ToAddress1': self.street,
+            'ToAddress2': self.streetbis,
+            'ToAddress3': None,
+            'ToAddress4': None,
+            'ToCity': self.city,
+            'ToState': values['state'],
+            'ToPostalCode': zip,
+            'ToCountry': self.country and (
+                get_endicia_country_names().get(self.country.code)
+            ),
+            'ToCountryCode': self.country and self.country.code,
+            'ToPhone': phone,
+            'ToEMail': self.party.email,
+        }
+
+    def _get_endicia_payload(self):
+        '''
+        Returns a dictionary with the values of the From and To Addresses
+        and the result of the validation of the address, cached by
+        get_address_payloads
+        '''
+        values, errors = self._get_endicia_address_values()
+        return {
+            'from': self._get_endicia_from_values(),
+            'to': self._get_endicia_to_values(values, errors),
+            'errors': errors,
+        }
+
+    def get_endicia_address_errors(self):
+        '''
+        Returns the list of the problems Endicia would reject the address for
+        '''
+        return get_address_payloads([self])[self.id]['errors']
+
+    def check_endicia_address(self):
+        '''
+        Raise an error if Endicia would reject the address
+        '''
+        errors = self.get_endicia_address_errors()
+        if errors:
+            self.raise_user_error('invalid_endicia_address', error_args=(
+                self.full_address.replace('\n', ', '), '\n'.join(errors)
+            ))
+
+    @classmethod
+    def addresses_to_endicia(cls, addresses, kind='to'):
+        '''
+        Converts many party addresses at once to Endicia addresses, reading
+        them together and reusing the cached conversions.
+
+        :param kind: 'from' or 'to'
+        :param return: List of the FromAddress or ToAddress instances in the
+                       order of addresses
+        '''
+        payloads = get_address_payloads(addresses)
+        Struct = FromAddress if kind == 'from' else ToAddress
+        return [
+            Struct(**payloads[int(address)][kind]) for address in addresses
+        ]
+
+    def address_to_endicia_from_address(self):
+        '''
+        Converts party address to Endicia From Address.
+
+        :param return: Returns instance of FromAddress
+        '''
+        return self.addresses_to_endicia([self], 'from')[0]
+
+    def address_to_endicia_to_address(self):
+        '''
+        Converts party address to Endicia To Address.
+
+        :param return: Returns instance of ToAddress
+        '''
+        return self.addresses_to_endicia([self], 'to')[0]
+
+
+class Party:
+    __name__ = 'party.party'
+
+    @classmethod
+    def write(cls, *args):
+        super(Party, cls).write(*args)
+        invalidate_party_payloads(
+            [party.id for parties in args[::2] for party in parties]
         )
+
+
+class ContactMechanism:
+    __name__ = 'party.contact_mechanism'
+
+    @classmethod
+    def create(cls, vlist):
+        mechanisms = super(ContactMechanism, cls).create(vlist)
+        invalidate_party_payloads(set(m.party.id for m in mechanisms))
+        return mechanisms
+
+    @classmethod
+    def write(cls, *args):
+        mechanisms = [m for mechanisms in args[::2] for m in mechanisms]
+        # The mechanisms may move to another party
+        party_ids = set(m.party.id for m in mechanisms)
+        super(ContactMechanism, cls).write(*args)
+        party_ids.update(m.party.id for m in cls.browse(mechanisms))
+        invalidate_party_payloads(party_ids)
+
+    @classmethod
+    def delete(cls, mechanisms):
+        invalidate_party_payloads(set(m.party.id for m in mechanisms))
+        super(ContactMechanism, cls).delete(mechanisms)
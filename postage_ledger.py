@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+    postage_ledger
+
+    Local ledger of the postage balance of the Endicia accounts, so that
+    labels do not stall when an account runs out of postage.
+
+    Each label charge and recredit is recorded with its amount. The balance
+    is the one of the last entry whose balance is known (a label response,
+    a recredit or a reconciliation with the account) plus the amounts
+    recorded since, so no balance is queried per label.
+
+    Before labels are sent, the spend of the label queue is forecast and
+    the account is recredited if the forecast balance would fall below the
+    threshold of the carrier. The recredit is recorded as pending, and
+    committed, before the postage is bought, so that other workers count it
+    instead of buying postage again while it is in flight. The ledger is
+    reconciled periodically with the balance of the account by a cron.
+
+"""
+import logging
+from decimal import Decimal, ROUND_UP
+
+from sql.aggregate import Sum, Count
+
+from endicia import BuyingPostageAPI
+from endicia.tools import objectify_response
+from endicia.exceptions import RequestError
+
+from trytond import backend
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from client import send_request
+from resilience import was_sent
+from locking import wait_locks
+
+__all__ = ['PostageLedger']
+
+logger = logging.getLogger(__name__)
+
+# Number of the last charges averaged to forecast the cost of a label
+FORECAST_CHARGES = 100
+
+
+def _get_balance(result):
+    """
+    Returns the PostageBalance of an Endicia response, or None if it is
+    missing
+    """
+    for element in result.iter('{*}PostageBalance'):
+        return Decimal(element.text)
+    return None
+
+
+class PostageLedger(ModelSQL, ModelView):
+    'Endicia Postage Ledger'
+    __name__ = 'endicia.postage.ledger'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, readonly=True, select=True,
+        ondelete='CASCADE'
+    )
+    kind = fields.Selection([
+        ('charge', 'Charge'),
+        ('recredit', 'Recredit'),
+        ('reconcile', 'Reconcile'),
+    ], 'Kind', required=True, readonly=True)
+    amount = fields.Numeric(
+        'Amount', digits=(16, 2), required=True, readonly=True
+    )
+    balance = fields.Numeric(
+        'Balance', digits=(16, 2), readonly=True,
+        help='Balance of the account reported by Endicia with this entry'
+    )
+    reference = fields.Char('Reference', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True,
+        help='Pending recredits are counted until they fail')
+
+    @classmethod
+    def __setup__(cls):
+        super(PostageLedger, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'done'
+
+    @classmethod
+    def record(cls, carrier, kind, amount, balance=None, reference=None):
+        """
+        Record a movement of the postage of the account of carrier
+
+        :param amount: Signed amount, negative for charges
+        :param balance: Balance of the account after the movement, if known
+        """
+        entry, = cls.create([{
+            'carrier': carrier.id,
+            'kind': kind,
+            'amount': amount,
+            'balance': balance,
+            'reference': reference,
+        }])
+        return entry
+
+    @classmethod
+    def record_charge(cls, carrier, response, reference=None):
+        """
+        Record the FinalPostage charged by a ShippingLabelAPI response, and
+        the PostageBalance it reports
+        """
+        result = objectify_response(response)
+        return cls.record(
+            carrier, 'charge', -Decimal(str(result.FinalPostage.pyval)),
+            _get_balance(result), reference
+        )
+
+    @classmethod
+    def get_balance(cls, carrier):
+        """
+        Returns the balance of the account of carrier according to the
+        ledger, or None if it was never reconciled
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        known = cls.search([
+            ('carrier', '=', carrier.id),
+            ('balance', '!=', None),
+        ], order=[('id', 'DESC')], limit=1)
+        if not known:
+            return None
+        known, = known
+        # Failed recredits did not change the balance
+        since = (table.carrier == carrier.id) & (table.id > known.id)
+        cursor.execute(*table.select(
+            Sum(table.amount), where=since & (table.state != 'failed')
+        ))
+        amount, = cursor.fetchone()
+        return known.balance + Decimal(str(amount or 0))
+
+    @classmethod
+    def get_average_charge(cls, carrier):
+        """
+        Returns the average postage of the last labels of carrier
+        """
+        charges = cls.search([
+            ('carrier', '=', carrier.id),
+            ('kind', '=', 'charge'),
+        ], order=[('id', 'DESC')], limit=FORECAST_CHARGES)
+        if not charges:
+            return Decimal('0')
+        return -sum(charge.amount for charge in charges) / len(charges)
+
+    @classmethod
+    def get_forecast(cls, carrier):
+        """
+        Returns the postage the labels waiting in the queue of carrier are
+        expected to cost
+        """
+        LabelJob = Pool().get('endicia.label.job')
+        Shipment = Pool().get('stock.shipment.out')
+        job = LabelJob.__table__()
+        shipment = Shipment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        queued = job.state.in_(['pending', 'processing'])
+        cursor.execute(*job.join(
+            shipment, condition=job.shipment == shipment.id
+        ).select(
+            Count(job.id),
+            where=queued & (shipment.carrier == carrier.id)
+        ))
+        queued, = cursor.fetchone()
+        return cls.get_average_charge(carrier) * (queued or 0)
+
+    @classmethod
+    def recredit(cls, carrier, amount, entry_id):
+        """
+        Buy the postage of a pending recredit of the ledger and commit its
+        outcome. A recredit whose outcome is unknown stays pending, and
+        counted, until the ledger is reconciled.
+
+        :param entry_id: Id of the pending recredit entry
+        """
+        buy_postage_api = BuyingPostageAPI(
+            request_id=Transaction().user,
+            recredit_amount=amount,
+            requesterid=carrier.endicia_requester_id,
+            accountid=carrier.endicia_account_id,
+            passphrase=carrier.endicia_passphrase,
+            test=carrier.endicia_is_test,
+        )
+        try:
+            response = send_request(buy_postage_api)
+        except Exception, error:
+            if was_sent(error) and not isinstance(error, RequestError):
+                # The postage may have been bought
+                raise
+            logger.warning(
+                'Recredit of carrier %s failed: %s', carrier.id, error
+            )
+            response = None
+        with Transaction().new_transaction():
+            state = 'failed'
+            if response is not None:
+                result = objectify_response(response)
+                if hasattr(result, 'ErrorMessage'):
+                    logger.warning(
+                        'Recredit of carrier %s failed: %s', carrier.id,
+                        result.ErrorMessage
+                    )
+                else:
+                    state = 'done'
+            cls.write([cls(entry_id)], {'state': state})
+
+    @classmethod
+    def record_recredit(cls, carrier, amount, response):
+        """
+        Record the postage bought by a BuyingPostageAPI response, unless it
+        reports an error
+
+        :return: The ledger entry or None
+        """
+        result = objectify_response(response)
+        if hasattr(result, 'ErrorMessage'):
+            logger.warning(
+                'Recredit of carrier %s failed: %s', carrier.id,
+                result.ErrorMessage
+            )
+            return None
+        return cls.record(
+            carrier, 'recredit', Decimal(str(amount)), _get_balance(result)
+        )
+
+    @classmethod
+    def reconcile(cls, carriers=None):
+        """
+        Record the balance of the accounts of carriers queried from Endicia,
+        with the difference with the ledger as amount
+
+        Meant to be called by the cron.
+        """
+        Carrier = Pool().get('carrier')
+
+        if carriers is None:
+            carriers = Carrier.search([
+                ('carrier_cost_method', '=', 'endicia'),
+            ])
+        for carrier in carriers:
+            try:
+                balance = carrier.get_endicia_postage_balance()
+            except Exception:
+                logger.exception(
+                    'Postage balance of carrier %s failed', carrier.id
+                )
+                continue
+            with Transaction().new_transaction():
+                expected = cls.get_balance(carrier)
+                cls.record(
+                    carrier, 'reconcile',
+                    balance - (balance if expected is None else expected),
+                    balance
+                )
+            if expected is not None and expected != balance:
+                logger.info(
+                    'Postage ledger of carrier %s reconciled: %s instead '
+                    'of %s', carrier.id, balance, expected
+                )
+        cls.replenish(carriers)
+
+    @classmethod
+    def replenish(cls, carriers):
+        """
+        Recredit the accounts of carriers whose forecast balance falls below
+        their threshold. Errors are logged so that labels are not stopped.
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        for carrier in carriers:
+            if not carrier.endicia_recredit_amount:
+                continue
+            try:
+                # Other workers wait for the pending recredit to be committed
+                # and count it, so that the account is recredited only once.
+                # The postage is bought once the lock is released.
+                with wait_locks(cls.__name__, [carrier.id]):
+                    with Transaction().new_transaction():
+                        planned = cls._plan_recredit(carrier)
+            except DatabaseOperationalError:
+                logger.error(
+                    'Postage ledger of carrier %s could not be locked, it '
+                    'was not replenished', carrier.id, exc_info=True
+                )
+                continue
+            if planned is None:
+                continue
+            entry_id, amount = planned
+            try:
+                cls.recredit(carrier, amount, entry_id)
+            except Exception:
+                logger.exception(
+                    'Recredit of the postage of carrier %s failed', carrier.id
+                )
+
+    @classmethod
+    def _plan_recredit(cls, carrier):
+        """
+        Create a pending recredit entry for carrier if its forecast balance
+        falls below its threshold
+
+        :return: Tuple of the id and amount of the entry or None
+        """
+        balance = cls.get_balance(carrier)
+        if balance is None:
+            return None
+        forecast = balance - cls.get_forecast(carrier)
+        threshold = carrier.endicia_postage_threshold or 0
+        if forecast >= threshold:
+            return None
+        amount = max(
+            carrier.endicia_recredit_amount,
+            (threshold - forecast).quantize(Decimal('1'), rounding=ROUND_UP)
+        )
+        entry, = cls.create([{
+            'carrier': carrier.id,
+            'kind': 'recredit',
+            'amount': amount,
+            'state': 'pending',
+        }])
+        return entry.id, amount
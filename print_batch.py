@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""
+    print_batch
+
+    Turns many label images into a single print job, either a multi-page
+    PDF or concatenated ZPL for thermal printers.
+
+    The job is written page by page, so a whole wave of labels never has to
+    be held in memory. Converting an image to ZPL decodes all its pixels, so
+    those are converted by a pool of processes, a window of images at a
+    time, while PDF pages embed the compressed images as they are.
+
+"""
+import struct
+import zlib
+from itertools import imap, islice
+from multiprocessing import Pool as ProcessPool
+
+from trytond.config import config
+
+__all__ = [
+    'UnsupportedLabelError', 'get_label_format', 'read_png', 'png_to_zpl',
+    'PDFWriter', 'export_pdf', 'export_zpl', 'iter_job', 'export_labels',
+]
+
+# Number of processes converting the images to ZPL, 1 converts them in the
+# process writing the job
+WORKERS = config.getint('shipping_endicia', 'print_workers', default=4)
+# Resolution of the label images in dots per inch
+DPI = 203
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Number of channels of each PNG color type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Signatures of the binary formats of the labels
+LABEL_SIGNATURES = [
+    (PNG_SIGNATURE, 'PNG'),
+    ('GIF8', 'GIF'),
+    ('\xff\xd8\xff', 'JPEG'),
+    ('%PDF', 'PDF'),
+]
+
+
+class UnsupportedLabelError(ValueError):
+    "Label whose format can not be written in the print job"
+
+    def __init__(self, label_format, job_format):
+        # Both are arguments, so that the error is rebuilt when it is
+        # returned by a worker process
+        super(UnsupportedLabelError, self).__init__(label_format, job_format)
+        self.label_format = label_format
+        self.job_format = job_format
+
+    def __str__(self):
+        return '%s labels can not be exported as %s' % self.args
+
+
+def get_label_format(data):
+    """
+    Returns the format of the label: PNG, GIF, JPEG, PDF, ZPLII or EPL2
+    """
+    for signature, label_format in LABEL_SIGNATURES:
+        if data.startswith(signature):
+            return label_format
+    # ZPL commands start with a caret or a tilde
+    if data.lstrip()[:1] in ('^', '~'):
+        return 'ZPLII'
+    return 'EPL2'
+
+
+class PNGImage(object):
+    "Header and compressed data of a PNG image"
+
+    def __init__(self, width, height, bit_depth, color_type, palette, data):
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.color_type = color_type
+        self.palette = palette
+        self.data = data
+
+
+def read_png(data):
+    """
+    Parse the chunks of the PNG image without decompressing it
+
+    :return: PNGImage
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError('Not a PNG image')
+    position = len(PNG_SIGNATURE)
+    header, palette, idat = None, '', []
+    while position < len(data):
+        length, type_ = struct.unpack('>I4s', data[position:position + 8])
+        chunk = data[position + 8:position + 8 + length]
+        position += 12 + length
+        if type_ == 'IHDR':
+            header = struct.unpack('>IIBBBBB', chunk)
+        elif type_ == 'PLTE':
+            palette = chunk
+        elif type_ == 'IDAT':
+            idat.append(chunk)
+        elif type_ == 'IEND':
+            break
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if interlace or bit_depth not in (1, 8) or (
+            bit_depth == 1 and color_type not in (0, 3)):
+        raise ValueError('Unsupported PNG image')
+    return PNGImage(
+        width, height, bit_depth, color_type, palette, ''.join(idat)
+    )
+
+
+def _paeth(left, up, up_left):
+    estimate = left + up - up_left
+    distance_left = abs(estimate - left)
+    distance_up = abs(estimate - up)
+    distance_up_left = abs(estimate - up_left)
+    if distance_left <= distance_up and distance_left <= distance_up_left:
+        return left
+    if distance_up <= distance_up_left:
+        return up
+    return up_left
+
+
+def _iter_rows(image):
+    """
+    Yield the unfiltered rows of the image as bytearrays
+    """
+    channels = PNG_CHANNELS[image.color_type]
+    row_size = (image.width * channels * image.bit_depth + 7) // 8
+    step = max(1, channels * image.bit_depth // 8)
+    raw = zlib.decompress(image.data)
+    previous = bytearray(row_size)
+    for y in xrange(image.height):
+        start = y * (row_size + 1)
+        filter_type = ord(raw[start])
+        row = bytearray(raw[start + 1:start + 1 + row_size])
+        if filter_type == 1:
+            for i in xrange(step, row_size):
+                row[i] = (row[i] + row[i - step]) & 0xff
+        elif filter_type == 2:
+            for i in xrange(row_size):
+                row[i] = (row[i] + previous[i]) & 0xff
+        elif filter_type == 3:
+            for i in xrange(row_size):
+                left = row[i - step] if i >= step else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+        elif filter_type == 4:
+            for i in xrange(row_size):
+                left = row[i - step] if i >= step else 0
+                up_left = previous[i - step] if i >= step else 0
+                row[i] = (
+                    row[i] + _paeth(left, previous[i], up_left)
+                ) & 0xff
+        yield row
+        previous = row
+
+
+def _luminance(red, green, blue):
+    return (red * 299 + green * 587 + blue * 114) // 1000
+
+
+def _iter_black_rows(image):
+    """
+    Yield the rows of the image as 1 bit per pixel bytearrays, a set bit
+    being a black dot
+    """
+    channels = PNG_CHANNELS[image.color_type]
+    palette = bytearray(image.palette)
+    if image.color_type == 3:
+        # Luminance of the palette entries
+        levels = [
+            _luminance(*palette[i:i + 3])
+            for i in xrange(0, len(palette), 3)
+        ]
+    for row in _iter_rows(image):
+        if image.bit_depth == 1 and image.color_type == 0:
+            black = bytearray(~byte & 0xff for byte in row)
+            if image.width % 8:
+                # Keep the padding bits of the row white
+                black[-1] &= (0xff << (8 - image.width % 8)) & 0xff
+            yield black
+            continue
+        if image.bit_depth == 1:
+            values = [
+                (row[x >> 3] >> (7 - (x & 7))) & 1
+                for x in xrange(image.width)
+            ]
+        else:
+            values = [
+                row[x * channels:(x + 1) * channels]
+                for x in xrange(image.width)
+            ]
+        black = bytearray((image.width + 7) // 8)
+        for x, value in enumerate(values):
+            if image.color_type == 3:
+                level = levels[value if image.bit_depth == 1 else value[0]]
+            elif image.color_type in (2, 6):
+                level = _luminance(*value[:3])
+            else:
+                level = value[0]
+            if image.color_type in (4, 6) and value[-1] < 128:
+                # Transparent dots are printed white
+                continue
+            if level < 128:
+                black[x >> 3] |= 0x80 >> (x & 7)
+        yield black
+
+
+def png_to_zpl(data):
+    """
+    Convert a label to a ZPL graphic field. Labels which are already in ZPL
+    are returned unchanged, other formats than PNG are refused.
+    """
+    label_format = get_label_format(data)
+    if label_format == 'ZPLII':
+        return data
+    elif label_format != 'PNG':
+        raise UnsupportedLabelError(label_format, 'ZPL')
+    image = read_png(data)
+    rows = [str(row).encode('hex').upper() for row in _iter_black_rows(image)]
+    row_size = (image.width + 7) // 8
+    total = row_size * image.height
+    return '^XA^FO0,0^GFA,%d,%d,%d,%s^FS^XZ\n' % (
+        total, total, row_size, ''.join(rows)
+    )
+
+
+def png_to_pdf_image(data):
+    """
+    Returns the dictionary entries and the stream of a PDF image XObject
+    embedding the compressed data of the PNG image as is
+    """
+    label_format = get_label_format(data)
+    if label_format != 'PNG':
+        raise UnsupportedLabelError(label_format, 'PDF')
+    image = read_png(data)
+    if image.color_type in (4, 6):
+        raise ValueError('PNG images with alpha are not supported')
+    if image.color_type == 0:
+        color_space = '/DeviceGray'
+    elif image.color_type == 2:
+        color_space = '/DeviceRGB'
+    else:
+        color_space = '[/Indexed /DeviceRGB %d <%s>]' % (
+            len(image.palette) // 3 - 1, image.palette.encode('hex')
+        )
+    entries = (
+        '/Type /XObject /Subtype /Image /Width %d /Height %d '
+        '/ColorSpace %s /BitsPerComponent %d /Filter /FlateDecode '
+        '/DecodeParms << /Predictor 15 /Colors %d /BitsPerComponent %d '
+        '/Columns %d >>' % (
+            image.width, image.height, color_space, image.bit_depth,
+            PNG_CHANNELS[image.color_type], image.bit_depth, image.width,
+        )
+    )
+    return image.width, image.height, entries, image.data
+
+
+class PDFWriter(object):
+    """
+    Writes a PDF with one image per page, one page at a time.
+
+    Objects 1 and 2 are the catalog and the page tree, which is written
+    last once all the pages are known.
+    """
+
+    def __init__(self, dpi=DPI):
+        self.dpi = dpi
+        self.offset = 0
+        self.offsets = {}
+        self.pages = []
+
+    def _write(self, data):
+        self.offset += len(data)
+        return data
+
+    def _object(self, object_id, entries, stream=None):
+        self.offsets[object_id] = self.offset
+        if stream is None:
+            return self._write('%d 0 obj\n<< %s >>\nendobj\n' % (
+                object_id, entries
+            ))
+        return self._write('%d 0 obj\n<< %s/Length %d >>\nstream\n' % (
+            object_id, entries and entries + ' ', len(stream)
+        ) + stream + '\nendstream\nendobj\n')
+
+    def start(self):
+        return self._write('%PDF-1.4\n%\xe2\xe3\xcf\xd3\n') + self._object(
+            1, '/Type /Catalog /Pages 2 0 R'
+        )
+
+    def add_page(self, image):
+        """
+        :param image: Result of png_to_pdf_image
+        """
+        width, height, entries, data = image
+        # Page size in points
+        page_width = width * 72.0 / self.dpi
+        page_height = height * 72.0 / self.dpi
+        # Object 2 is kept for the page tree
+        image_id = len(self.offsets) + 2
+        content = 'q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q' % (
+            page_width, page_height
+        )
+        self.pages.append(image_id + 2)
+        return ''.join([
+            self._object(image_id, entries, data),
+            self._object(image_id + 1, '', content),
+            self._object(
+                image_id + 2,
+                '/Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] '
+                '/Resources << /XObject << /Im0 %d 0 R >> >> '
+                '/Contents %d 0 R' % (
+                    page_width, page_height, image_id, image_id + 1
+                )
+            ),
+        ])
+
+    def finish(self):
+        pages = self._object(2, '/Type /Pages /Kids [%s] /Count %d' % (
+            ' '.join('%d 0 R' % page for page in self.pages), len(self.pages)
+        ))
+        xref_offset = self.offset
+        size = len(self.offsets) + 1
+        xref = ['xref\n0 %d\n' % size, '0000000000 65535 f \n']
+        xref.extend(
+            '%010d 00000 n \n' % self.offsets[object_id]
+            for object_id in xrange(1, size)
+        )
+        return pages + ''.join(xref) + (
+            'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+            % (size, xref_offset)
+        )
+
+
+def _convert(function, images, workers):
+    """
+    Yield the result of function for each image, converting a window of
+    images at a time in a pool of processes
+    """
+    if workers <= 1:
+        for result in imap(function, images):
+            yield result
+        return
+    images = iter(images)
+    pool = ProcessPool(workers)
+    try:
+        while True:
+            window = list(islice(images, workers * 4))
+            if not window:
+                break
+            for result in pool.imap(function, window):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def export_pdf(images, workers=WORKERS):
+    """
+    Yield the chunks of a PDF with one page per PNG image of images
+    """
+    writer = PDFWriter()
+    yield writer.start()
+    # The images are only parsed, which is not worth a pool of processes
+    for image in imap(png_to_pdf_image, images):
+        yield writer.add_page(image)
+    yield writer.finish()
+
+
+def export_zpl(images, workers=WORKERS):
+    """
+    Yield the ZPL of each image of images
+    """
+    return _convert(png_to_zpl, images, workers)
+
+
+def iter_job(images, format_, workers=WORKERS):
+    """
+    Yield the chunks of the print job of the images
+
+    :param images: Iterable of the label images
+    :param format_: 'pdf' or 'zpl'
+    :param workers: Number of processes converting the images
+    """
+    export = {
+        'pdf': export_pdf,
+        'zpl': export_zpl,
+    }[format_]
+    return export(images, workers)
+
+
+def export_labels(images, format_, fileobj, workers=WORKERS):
+    """
+    Write the print job of the images to fileobj
+
+    :param images: Iterable of the label images
+    :param format_: 'pdf' or 'zpl'
+    :param fileobj: File object the print job is written to
+    :param workers: Number of processes converting the images
+    """
+    for chunk in iter_job(images, format_, workers):
+        fileobj.write(chunk)
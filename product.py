@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+    product
+
+"""
+from trytond.pool import PoolMeta
+
+from reference import clear_uoms, clear_customs_profiles
+
+__metaclass__ = PoolMeta
+__all__ = ['Uom', 'Template', 'Product']
+
+
+class Uom:
+    __name__ = 'product.uom'
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(Uom, cls).create(vlist)
+        clear_uoms()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(Uom, cls).write(*args)
+        clear_uoms()
+        clear_customs_profiles()
+
+    @classmethod
+    def delete(cls, records):
+        super(Uom, cls).delete(records)
+        clear_uoms()
+        clear_customs_profiles()
+
+
+class Template:
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, *args):
+        super(Template, cls).write(*args)
+        clear_customs_profiles()
+
+    @classmethod
+    def delete(cls, templates):
+        super(Template, cls).delete(templates)
+        clear_customs_profiles()
+
+
+class Product:
+    __name__ = 'product.product'
+
+    @classmethod
+    def write(cls, *args):
+        super(Product, cls).write(*args)
+        clear_customs_profiles()
+
+    @classmethod
+    def delete(cls, products):
+        super(Product, cls).delete(products)
+        clear_customs_profiles()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+    rate_tables
+
+    Computes USPS postage locally from imported zone and price tables.
+
+    The tables are read from the directory set in the `rate_tables` option of
+    the `shipping_endicia` section of the configuration, which must contain:
+
+    zones.csv
+        origin_zip3,destination_zip3_start,destination_zip3_end,zone
+
+    prices.csv
+        mail_class,zone,max_weight_oz,price
+
+    The prices are those of parcels by weight, so other mailpiece shapes and
+    the parcels priced by their dimensions are left to Endicia.
+
+"""
+import csv
+import os
+import threading
+from array import array
+from bisect import bisect_left
+from decimal import Decimal
+
+from trytond.config import config
+
+__all__ = ['RateTables', 'get_rate_tables']
+
+# Mailpiece shapes priced by the tables
+SHAPES = ('Parcel',)
+
+
+class RateTables(object):
+    """
+    Zone chart and price tables held in memory.
+
+    The zone chart of each origin ZIP3 is a bytearray indexed by the
+    destination ZIP3. The weight breaks and prices (in cents) of each zone
+    and mail class are sorted arrays searched by bisection.
+    """
+
+    def __init__(self):
+        # origin zip3 -> bytearray of zones indexed by destination zip3
+        self.zones = {}
+        # zone -> mail class -> (weight breaks, prices in cents)
+        self.prices = {}
+
+    @classmethod
+    def from_directory(cls, path):
+        """
+        Load the tables from the zones.csv and prices.csv files in path
+        """
+        tables = cls()
+        with open(os.path.join(path, 'zones.csv'), 'rb') as zones_file:
+            tables.add_zones(
+                row for row in csv.reader(zones_file)
+                if row and row[0].isdigit()
+            )
+        with open(os.path.join(path, 'prices.csv'), 'rb') as prices_file:
+            tables.add_prices(
+                row for row in csv.reader(prices_file)
+                if len(row) > 1 and row[1].isdigit()
+            )
+        return tables
+
+    def add_zones(self, rows):
+        """
+        :param rows: Iterable of (origin zip3, destination zip3 start,
+                     destination zip3 end, zone)
+        """
+        for origin, start, end, zone in rows:
+            chart = self.zones.setdefault(int(origin), bytearray(1000))
+            for destination in xrange(int(start), int(end) + 1):
+                chart[destination] = int(zone)
+
+    def add_prices(self, rows):
+        """
+        :param rows: Iterable of (mail class, zone, max weight in oz, price)
+        """
+        breaks = {}
+        for mail_class, zone, max_weight, price in rows:
+            breaks.setdefault((int(zone), mail_class), []).append(
+                (float(max_weight), int(Decimal(price) * 100))
+            )
+        for (zone, mail_class), values in breaks.iteritems():
+            values.sort()
+            self.prices.setdefault(zone, {})[mail_class] = (
+                array('d', [weight for weight, _ in values]),
+                array('l', [cents for _, cents in values]),
+            )
+
+    def get_zone(self, from_zip, to_zip):
+        """
+        Returns the zone between the zip codes or None if unknown
+        """
+        chart = self.zones.get(int(from_zip[:3]))
+        if chart is None:
+            return None
+        return chart[int(to_zip[:3])] or None
+
+    def get_postage_prices(self, from_zip, to_zip, weight_oz, shape=None,
+            dimensions=None):
+        """
+        Returns the postage prices as the list of (mail class, total amount)
+        tuples returned by sale.PostagePriceParser, or None when the tables
+        do not cover the zip codes, the shape or the dimensions.
+
+        Mail classes for which weight_oz is over the last weight break are
+        left out.
+
+        :param shape: Mailpiece shape code, None for a parcel
+        :param dimensions: Dimensions of the mailpiece if it has any
+        """
+        if shape not in (None,) + SHAPES or dimensions:
+            return None
+        zip3s = (from_zip or '')[:3], (to_zip or '')[:3]
+        if not all(zip3.isdigit() for zip3 in zip3s):
+            return None
+        zone = self.get_zone(*zip3s)
+        if zone is None:
+            return None
+
+        weight_oz = float(weight_oz)
+        postage_prices = []
+        for mail_class, (weights, cents) in \
+                self.prices.get(zone, {}).iteritems():
+            index = bisect_left(weights, weight_oz)
+            if index < len(weights):
+                postage_prices.append(
+                    (mail_class, '%d.%02d' % divmod(cents[index], 100))
+                )
+        return postage_prices
+
+
+_rate_tables = []
+_rate_tables_lock = threading.Lock()
+
+
+def get_rate_tables():
+    """
+    Returns the RateTables loaded from the configured directory, or None if
+    no directory is configured
+    """
+    path = config.get('shipping_endicia', 'rate_tables')
+    if not path:
+        return None
+    if not _rate_tables:
+        with _rate_tables_lock:
+            if not _rate_tables:
+                _rate_tables.append(RateTables.from_directory(path))
+    return _rate_tables[0]
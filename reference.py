@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+    reference
+
+    Process-wide registry of the reference data used to build Endicia
+    requests. Entries are cleared when the underlying records are written.
+
+"""
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce, NullIf
+
+from trytond.cache import Cache
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids, grouped_slice
+
+__all__ = [
+    'get_uom', 'get_usd', 'get_services', 'get_endicia_country_name_column',
+    'get_endicia_country_names',
+    'get_customs_profiles', 'get_address_payloads', 'clear_uoms',
+    'clear_services', 'clear_endicia_country_names', 'clear_customs_profiles',
+    'clear_address_payloads', 'invalidate_address_payloads',
+]
+
+_uom_ids = Cache('shipping_endicia.reference.uom', context=False)
+_services = Cache('shipping_endicia.reference.services', context=False)
+_country_names = Cache(
+    'shipping_endicia.reference.country_names', context=False
+)
+_customs_profiles = Cache(
+    'shipping_endicia.reference.customs_profiles', context=False
+)
+_address_payloads = Cache(
+    'shipping_endicia.reference.address_payloads', context=False
+)
+
+
+def get_uom(symbol):
+    """
+    Returns the unit of measure with symbol
+    """
+    UOM = Pool().get('product.uom')
+
+    uom_id = _uom_ids.get(symbol)
+    if uom_id is None:
+        uom, = UOM.search([('symbol', '=', symbol)], limit=1)
+        uom_id = _uom_ids.set(symbol, uom.id)
+    return UOM(uom_id)
+
+
+def get_usd():
+    """
+    Returns the US Dollar currency in which Endicia charges postage
+    """
+    Currency = Pool().get('currency.currency')
+    ModelData = Pool().get('ir.model.data')
+
+    # ModelData.get_id is cached by trytond
+    return Currency(ModelData.get_id('currency', 'usd'))
+
+
+def get_services(carrier):
+    """
+    Returns a dictionary mapping the code of the services of carrier to a
+    (service id, service name) tuple, the names being in the language of the
+    transaction
+    """
+    key = (Transaction().language, carrier.id)
+    services = _services.get(key)
+    if services is None:
+        services = _services.set(key, dict(
+            (service.code, (service.id, service.name))
+            for service in carrier.services
+        ))
+    return services
+
+
+def get_endicia_country_name_column(table):
+    """
+    Returns the SQL expression of the name Endicia knows the countries of
+    table by: their Endicia name if any, else their untranslated name
+    """
+    return Coalesce(NullIf(table.endicia_country_name, ''), table.name)
+
+
+def get_endicia_country_names():
+    """
+    Returns a dictionary mapping the code of all the countries to the name
+    Endicia knows them by, which does not depend on the language
+    """
+    Country = Pool().get('country.country')
+    table = Country.__table__()
+
+    names = _country_names.get(None)
+    if names is None:
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(
+            table.code, get_endicia_country_name_column(table)
+        ))
+        names = _country_names.set(None, dict(cursor.fetchall()))
+    return names
+
+
+def get_customs_profiles(products):
+    """
+    Returns a dictionary mapping the id of the products to their customs
+    profile: a (customs value, description, weight in oz of a unit of the
+    default uom) tuple, the weight being None if the product has none
+
+    The description is the name of the product in the language of the
+    transaction, which is part of the cache key.
+    """
+    Product = Pool().get('product.product')
+    UOM = Pool().get('product.uom')
+
+    language = Transaction().language
+    profiles, missing = {}, set()
+    for product_id in set(map(int, products)):
+        profile = _customs_profiles.get((language, product_id))
+        if profile is None:
+            missing.add(product_id)
+        else:
+            profiles[product_id] = profile
+
+    uom_oz = get_uom('oz')
+    for product in Product.browse(list(missing)):
+        weight_oz = None
+        if product.weight:
+            weight_oz = UOM.compute_qty(
+                product.weight_uom, product.weight, uom_oz, round=False
+            )
+        profiles[product.id] = _customs_profiles.set((language, product.id), (
+            product.customs_value_used, product.name, weight_oz
+        ))
+    return profiles
+
+
+def _get_address_versions(address_ids):
+    """
+    Returns a dictionary mapping the id of the addresses to their version:
+    the last write of the address, of its party and of the contact
+    mechanisms of its party, and the number of those mechanisms
+    """
+    pool = Pool()
+    Address = pool.get('party.address')
+    Party = pool.get('party.party')
+    ContactMechanism = pool.get('party.contact_mechanism')
+    address = Address.__table__()
+    party = Party.__table__()
+    mechanism = ContactMechanism.__table__()
+    cursor = Transaction().connection.cursor()
+
+    address_date = Coalesce(address.write_date, address.create_date)
+    party_date = Coalesce(party.write_date, party.create_date)
+    versions = {}
+    for sub_ids in grouped_slice(address_ids):
+        cursor.execute(*address.join(
+            party, condition=address.party == party.id
+        ).join(
+            mechanism, 'LEFT', condition=mechanism.party == party.id
+        ).select(
+            address.id, address_date, party_date,
+            Max(Coalesce(mechanism.write_date, mechanism.create_date)),
+            Count(mechanism.id),
+            where=reduce_ids(address.id, sub_ids),
+            group_by=[address.id, address_date, party_date]
+        ))
+        versions.update((row[0], row[1:]) for row in cursor.fetchall())
+    return versions
+
+
+def get_address_payloads(addresses):
+    """
+    Returns a dictionary mapping the id of the addresses to their Endicia
+    payload as returned by Address._get_endicia_payload. The addresses
+    whose payload is missing are read together.
+
+    Payloads are cached with the version of the address returned by
+    _get_address_versions, which is read in a single query, so that a change
+    made by another process invalidates only the payloads of the addresses it
+    affects.
+    """
+    Address = Pool().get('party.address')
+
+    versions = _get_address_versions(list(set(map(int, addresses))))
+    payloads, missing = {}, []
+    for address_id, version in versions.iteritems():
+        cached = _address_payloads.get(address_id)
+        if cached is None or cached[0] != version:
+            missing.append(address_id)
+        else:
+            payloads[address_id] = cached[1]
+    for address in Address.browse(missing):
+        payloads[address.id] = _address_payloads.set(
+            address.id, (versions[address.id], address._get_endicia_payload())
+        )[1]
+    return payloads
+
+
+def invalidate_address_payloads(address_ids):
+    """
+    Forget the payloads of the addresses in the process, as the writes of a
+    transaction all have the same time and do not change their version
+    """
+    for address_id in address_ids:
+        _address_payloads.set(address_id, None)
+
+
+def clear_uoms():
+    _uom_ids.clear()
+
+
+def clear_services():
+    _services.clear()
+
+
+def clear_endicia_country_names():
+    _country_names.clear()
+
+
+def clear_customs_profiles():
+    _customs_profiles.clear()
+
+
+def clear_address_payloads():
+    _address_payloads.clear()
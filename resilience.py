@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+    resilience
+
+    Timeouts, retries and circuit breakers of the calls to Endicia, so that
+    workers fail fast instead of piling up when Endicia degrades.
+
+    Each endpoint (API class) has its own timeout and circuit breaker.
+    Calls to read-only endpoints are retried on transport errors after a
+    jittered exponential delay, other calls are never retried.
+
+    The options of the `shipping_endicia` section of the configuration are:
+
+    timeout_<endpoint>
+        Seconds to wait for the endpoint, the endpoint being the lower case
+        name of the API class without `API`, e.g. `timeout_postagerates`
+    retries
+        Number of retries of the calls to read-only endpoints
+    backoff_base, backoff_max
+        Initial and maximum delay in seconds between two attempts
+    breaker_threshold
+        Share of failed calls, between 0 and 1, which opens the circuit
+    breaker_window
+        Seconds over which the share of failed calls is computed
+    breaker_min_calls
+        Minimum number of calls in the window before the circuit can open
+    breaker_reset
+        Seconds the circuit stays open before a trial call is let through
+
+"""
+import errno
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib2
+from collections import deque
+
+from trytond.config import config
+
+__all__ = [
+    'CircuitOpenError', 'CircuitBreaker', 'ENDPOINTS', 'get_endpoint',
+    'get_breaker', 'is_available', 'is_transient', 'was_sent',
+    'backoff_delays', 'call',
+]
+
+# Default timeout and whether calls can be retried, by API class
+ENDPOINTS = {
+    'ShippingLabelAPI': (30, False),
+    'BuyingPostageAPI': (30, False),
+    'RefundRequestAPI': (30, False),
+    'SCANFormAPI': (60, False),
+    'ChangingPassPhraseAPI': (15, False),
+    'CalculatingPostageAPI': (10, True),
+    'PostageRatesAPI': (10, True),
+    'AccountStatusAPI': (10, True),
+}
+
+TIMEOUT = config.getfloat('shipping_endicia', 'timeout', default=30)
+RETRIES = config.getint('shipping_endicia', 'retries', default=2)
+BACKOFF_BASE = config.getfloat('shipping_endicia', 'backoff_base', default=0.2)
+BACKOFF_MAX = config.getfloat('shipping_endicia', 'backoff_max', default=5)
+BREAKER_THRESHOLD = config.getfloat(
+    'shipping_endicia', 'breaker_threshold', default=0.5
+)
+BREAKER_WINDOW = config.getfloat(
+    'shipping_endicia', 'breaker_window', default=60
+)
+BREAKER_MIN_CALLS = config.getint(
+    'shipping_endicia', 'breaker_min_calls', default=10
+)
+BREAKER_RESET = config.getfloat('shipping_endicia', 'breaker_reset', default=30)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an endpoint whose circuit is open
+    """
+
+    def __init__(self, name):
+        super(CircuitOpenError, self).__init__(
+            'Endicia %s is unavailable, try again later' % name
+        )
+        self.name = name
+
+
+class CircuitBreaker(object):
+    """
+    Thread safe circuit breaker.
+
+    The circuit is closed while the share of failed calls of the last
+    `window` seconds stays under `threshold`. Once open, calls are refused
+    for `reset` seconds, after which a single trial call is let through
+    (half open): its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, name, threshold=BREAKER_THRESHOLD,
+            window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+            reset=BREAKER_RESET):
+        self.name = name
+        self.threshold = threshold
+        self.window = window
+        self.min_calls = min_calls
+        self.reset = reset
+        self.opened = None
+        self._trial = False
+        # (time, failed) of the calls of the window
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """
+        'closed', 'open' or 'half_open'
+        """
+        if self.opened is None:
+            return 'closed'
+        if time.time() - self.opened < self.reset:
+            return 'open'
+        return 'half_open'
+
+    def allow(self):
+        """
+        Returns True if a call can be made
+        """
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def _prune(self, now):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def record(self, failed):
+        """
+        Record the outcome of a call
+        """
+        now = time.time()
+        with self._lock:
+            if self.opened is not None:
+                if self._trial:
+                    self._trial = False
+                    self.opened = now if failed else None
+                    self._calls.clear()
+                return
+            self._calls.append((now, failed))
+            self._prune(now)
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for _, failed_ in self._calls if failed_)
+            if failures >= self.threshold * len(self._calls):
+                self.opened = now
+
+    def stats(self):
+        """
+        Returns a dictionary with the state and the calls of the window
+        """
+        with self._lock:
+            self._prune(time.time())
+            return {
+                'state': self.state,
+                'calls': len(self._calls),
+                'failures': sum(1 for _, failed in self._calls if failed),
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_endpoint(api_request):
+    """
+    Returns the name, timeout and whether calls can be retried of the
+    endpoint of the request
+    """
+    name = api_request.__class__.__name__
+    timeout, idempotent = ENDPOINTS.get(name, (TIMEOUT, False))
+    option = 'timeout_%s' % name.lower().replace('api', '')
+    timeout = config.getfloat('shipping_endicia', option, default=timeout)
+    return name, timeout, idempotent
+
+
+def get_breaker(name):
+    """
+    Returns the CircuitBreaker of the endpoint
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def is_available(name):
+    """
+    Returns False if the circuit of the endpoint is open, so that callers
+    can fall back without waiting for Endicia
+
+    :param name: Name of the API class, e.g. 'PostageRatesAPI'
+    """
+    return get_breaker(name).state != 'open'
+
+
+def is_transient(error):
+    """
+    Returns True if the error is a failure of Endicia or of the network,
+    rather than the rejection of the request
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500
+    return isinstance(
+        error, (urllib2.URLError, socket.error, httplib.HTTPException)
+    )
+
+
+def was_sent(error):
+    """
+    Returns False if the call failed with error before the request reached
+    Endicia, so that it can not have been processed
+    """
+    if isinstance(error, urllib2.URLError) \
+            and not isinstance(error, urllib2.HTTPError):
+        error = error.reason
+    if isinstance(error, (CircuitOpenError, socket.gaierror)):
+        return False
+    if isinstance(error, socket.error):
+        return error.errno != errno.ECONNREFUSED
+    return True
+
+
+def backoff_delays(retries=RETRIES, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """
+    Yield the delays before each retry, exponential with full jitter
+    """
+    for attempt in xrange(retries):
+        yield random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def call(api_request, function, timeout=None):
+    """
+    Call function through the circuit breaker of the endpoint of
+    api_request, retrying read-only endpoints on transient errors
+
+    :param function: Function sending api_request, called with the timeout
+    :param timeout: Seconds to wait for the response, by default the
+                    timeout of the endpoint
+    """
+    name, default_timeout, idempotent = get_endpoint(api_request)
+    if timeout is None:
+        timeout = default_timeout
+    breaker = get_breaker(name)
+    delays = backoff_delays() if idempotent else iter([])
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(name)
+        try:
+            result = function(timeout)
+        except Exception, error:
+            transient = is_transient(error)
+            breaker.record(transient)
+            delay = next(delays, None) if transient else None
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        breaker.record(False)
+        return result
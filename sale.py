@@ -1,20 +1,94 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 from decimal import Decimal
+from io import BytesIO
 import logging
 
+from lxml import etree
 from endicia import PostageRatesAPI
-from endicia.tools import objectify_response
 from endicia.exceptions import RequestError
 from trytond.model import fields
 from trytond.pool import PoolMeta, Pool
+from trytond.config import config
 
+from cache import TTLCache
+from client import send_request, send_requests
+from rate_tables import get_rate_tables
+from resilience import is_available
+from reference import get_uom, get_usd, get_services
 
-__all__ = ['Configuration', 'Sale']
+
+__all__ = ['Configuration', 'Sale', 'PostagePriceParser']
 __metaclass__ = PoolMeta
 
 logger = logging.getLogger(__name__)
 
+# Postage prices returned by Endicia, keyed on the rated request
+RATE_CACHE = TTLCache(
+    size_limit=config.getint(
+        'shipping_endicia', 'rate_cache_size', default=1024
+    ),
+    ttl=config.getint('shipping_endicia', 'rate_cache_ttl', default=600),
+)
+
+
+class PostagePriceParser(object):
+    """
+    Parses the PostagePrice elements of a PostageRatesAPI response.
+
+    The response is parsed incrementally and each element is cleared once
+    read, so only the prices of the given mail classes are kept in memory.
+    The status of the response is read in the same pass, so the response is
+    never parsed into a full tree. Parsers with the same mail classes are
+    equal, so that identical requests can be coalesced.
+    """
+
+    def __init__(self, mail_classes=None):
+        self.mail_classes = mail_classes and frozenset(mail_classes)
+
+    def __eq__(self, other):
+        return isinstance(other, PostagePriceParser) and \
+            self.mail_classes == other.mail_classes
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.mail_classes)
+
+    def __call__(self, response_xml):
+        """
+        :return: List of (mail class, total amount) tuples
+        """
+        return self.stream(response_xml, {})
+
+    def stream(self, response_xml, flags):
+        """
+        Parse the response and set the Status and ErrorMessage of flags, as
+        APIBaseClass._set_flags does.
+
+        :return: List of (mail class, total amount) tuples
+        """
+        flags['Status'] = flags['ErrorMessage'] = None
+        postage_prices = []
+        for _, element in etree.iterparse(BytesIO(response_xml), tag=(
+                    '{*}PostagePrice', '{*}Status', '{*}ErrorMessage')):
+            tag = etree.QName(element).localname
+            if tag == 'PostagePrice':
+                mail_class = element.findtext('{*}MailClass')
+                if self.mail_classes is None or \
+                        mail_class in self.mail_classes:
+                    postage_prices.append(
+                        (mail_class, element.get('TotalAmount'))
+                    )
+                # Drop the element and the already read siblings
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            elif flags[tag] is None:
+                flags[tag] = element.text
+        return postage_prices
+
 
 class Configuration:
     'Sale Configuration'
@@ -29,19 +103,13 @@ class Sale:
     "Sale"
     __name__ = 'sale.sale'
 
-    def get_shipping_rate(self, carrier, carrier_service=None, silent=False):
+    def _get_endicia_rate_request(self, carrier):
         """
-        Call the rates service and get possible quotes for shipment for eligible
-        mail classes
+        Build the PostageRatesAPI request for the sale.
+
+        :return: Tuple of the request and the key its response is cached with
         """
-        Currency = Pool().get('currency.currency')
         UOM = Pool().get('product.uom')
-        ModelData = Pool().get('ir.model.data')
-
-        if carrier.carrier_cost_method != "endicia":
-            return super(Sale, self).get_shipping_rate(
-                carrier, carrier_service, silent
-            )
 
         from_address = self._get_ship_from_address()
         if self.shipment_address.country.code == "US":
@@ -49,11 +117,9 @@ class Sale:
         else:
             mailclass_type = "International"
 
-        uom_oz = UOM.search([('symbol', '=', 'oz')])[0]
-
         # Endicia only support 1 decimal place in weight
         weight_oz = "%.1f" % UOM.compute_qty(
-            self.weight_uom, self.weight, uom_oz
+            self.weight_uom, self.weight, get_uom('oz')
         )
         to_zip = self.shipment_address.zip
         if mailclass_type == 'Domestic':
@@ -72,59 +138,135 @@ class Sale:
             passphrase=carrier.endicia_passphrase,
             test=carrier.endicia_is_test,
         )
-
-        # Logging.
-        logger.debug(
-            'Making Postage Rates Request for shipping rates of'
-            'Sale ID: {0} and Carrier ID: {1}'
-            .format(self.id, carrier.id)
+        # An account id may be priced differently for another requester or
+        # in test mode
+        key = (
+            carrier.endicia_account_id, carrier.endicia_requester_id,
+            bool(carrier.endicia_is_test), mailclass_type,
+            from_address.zip[:5], to_zip, self.shipment_address.country.code,
+            weight_oz, frozenset(get_services(carrier)),
         )
-        logger.debug('--------POSTAGE RATES REQUEST--------')
-        logger.debug(str(postage_rates_request.to_xml()))
-        logger.debug('--------END REQUEST--------')
+        return postage_rates_request, key
 
-        try:
-            response_xml = postage_rates_request.send_request()
-            response = objectify_response(response_xml)
-        except RequestError, e:
-            self.raise_user_error(unicode(e))
-        except Exception, e:
-            if not silent:
-                raise
-            logger.debug('--------ENDICIA ERROR-----------')
-            logger.debug(unicode(e))
-            logger.debug('--------ENDICIA END ERROR-----------')
-            return []
-
-        # Logging.
-        logger.debug('--------POSTAGE RATES RESPONSE--------')
-        logger.debug(str(response_xml))
-        logger.debug('--------END RESPONSE--------')
-
-        allowed_services = {
-            service.code: service for service in carrier.services
-        }
+    def _get_endicia_rates(self, carrier, postage_prices):
+        """
+        Build the rate dictionaries for the postage prices of the mail classes
+        allowed on carrier
+        """
+        CarrierService = Pool().get('carrier.service')
+
+        allowed_services = get_services(carrier)
+        currency = get_usd()
         rates = []
-        for postage_price in response.PostagePrice:
-            service = allowed_services.get(postage_price.MailClass)
-            if not service:
+        for mail_class, total_amount in postage_prices:
+            if mail_class not in allowed_services:
                 continue
+            service_id, service_name = allowed_services[mail_class]
 
-            currency = Currency(ModelData.get_id('currency', 'usd'))
             rate = {
                 'carrier': carrier,
-                'carrier_service': service,
-                'cost': currency.round(
-                    Decimal(postage_price.get('TotalAmount'))
-                ),
+                'carrier_service': CarrierService(service_id),
+                'cost': currency.round(Decimal(total_amount)),
                 'cost_currency': currency
             }
 
             rate['display_name'] = "USPS %s" % (
-                service.name
+                service_name
             )
 
             rates.append(rate)
+        return rates
+
+    def _send_endicia_rate_request(self, carrier, postage_rates_request,
+            silent=False):
+        """
+        Send the PostageRatesAPI request and parse the prices of the carrier
+        services.
+
+        :return: List of (mail class, total amount) tuples, None if the request
+                 failed silently
+        """
+        logger.debug(
+            'Making Postage Rates Request for shipping rates of Sale ID: %s '
+            'and Carrier ID: %s', self.id, carrier.id
+        )
+
+        try:
+            # Identical requests in flight share the same response
+            postage_prices = send_request(
+                postage_rates_request,
+                parse=PostagePriceParser(get_services(carrier)),
+                coalesce=True
+            )
+        except RequestError, e:
+            self.raise_user_error(unicode(e))
+        except Exception, e:
+            if not silent:
+                raise
+            logger.debug('Endicia rate request failed: %s', e)
+            return None
+        return postage_prices
+
+    def _get_endicia_local_rates(self, carrier, key):
+        """
+        Compute the rates from the local rate tables.
+
+        Carriers which do not use the local tables fall back to them while
+        the circuit of the PostageRatesAPI endpoint is open.
+
+        :param key: Cache key returned by _get_endicia_rate_request
+        :return: List of rates, None if the carrier does not use the local
+                 tables or the tables do not cover the sale or its box type
+        """
+        SaleConfig = Pool().get('sale.configuration')
+
+        if not carrier.endicia_local_rates and is_available('PostageRatesAPI'):
+            return None
+        rate_tables = get_rate_tables()
+        _, _, _, mailclass_type, from_zip, to_zip, _, weight_oz, _ = key
+        if rate_tables is None or mailclass_type != 'Domestic':
+            return None
+        # Sales have no dimensions, only the shape of their box type
+        box_type = SaleConfig(1).usps_box_type
+        postage_prices = rate_tables.get_postage_prices(
+            from_zip, to_zip, weight_oz, shape=box_type and box_type.code
+        )
+        # Fallback to the API when none of the carrier services are priced
+        return postage_prices and \
+            self._get_endicia_rates(carrier, postage_prices) or None
+
+    def get_shipping_rate(self, carrier, carrier_service=None, silent=False):
+        """
+        Call the rates service and get possible quotes for shipment for eligible
+        mail classes
+
+        Carriers using local rates are priced from the rate tables when
+        they cover the sale. Otherwise postage prices are cached in
+        RATE_CACHE, so identical requests (same account, requester, test
+        mode, zip codes, country and weight) are not sent again until the
+        cached prices expire.
+        While Endicia is unavailable (its circuit is open), the local tables
+        or the expired cached prices are used instead.
+        """
+        if carrier.carrier_cost_method != "endicia":
+            return super(Sale, self).get_shipping_rate(
+                carrier, carrier_service, silent
+            )
+
+        postage_rates_request, key = self._get_endicia_rate_request(carrier)
+        rates = self._get_endicia_local_rates(carrier, key)
+        if rates is None:
+            postage_prices = RATE_CACHE.get(
+                key, stale=not is_available('PostageRatesAPI')
+            )
+            if postage_prices is None:
+                postage_prices = self._send_endicia_rate_request(
+                    carrier, postage_rates_request, silent
+                )
+                if postage_prices is None:
+                    return []
+                RATE_CACHE.set(key, postage_prices)
+            rates = self._get_endicia_rates(carrier, postage_prices)
 
         if carrier_service:
             return filter(
@@ -132,3 +274,88 @@ class Sale:
                 rates
             )
         return rates
+
+    @classmethod
+    def _send_endicia_rate_requests(cls, requests, silent=False):
+        """
+        Send the PostageRatesAPI requests concurrently and cache the prices.
+
+        :param requests: Dictionary mapping the cache key to the request
+        :return: Dictionary mapping the cache key to the postage prices of
+                 the successful requests
+        """
+        keys = requests.keys()
+        results = send_requests(
+            [requests[key] for key in keys],
+            # The last item of the key are the mail classes of the carrier
+            parse=[PostagePriceParser(key[-1]) for key in keys],
+            coalesce=True
+        )
+
+        postage_prices = {}
+        for key, (prices, error) in zip(keys, results):
+            if error is None:
+                RATE_CACHE.set(key, prices)
+                postage_prices[key] = prices
+                continue
+            if not silent:
+                if isinstance(error, RequestError):
+                    cls.raise_user_error(unicode(error))
+                raise error
+            logger.debug('Endicia rate request failed: %s', error)
+        return postage_prices
+
+    @classmethod
+    def get_shipping_rate_batch(cls, sales, carriers, silent=False):
+        """
+        Get the shipping rates of many sales at once.
+
+        The PostageRatesAPI requests of all the sales which are not cached
+        are sent concurrently, identical requests being sent only once. Rates
+        of other carriers are fetched with get_shipping_rate one by one.
+
+        :param sales: List of sales to rate
+        :param carriers: List of carriers to get the rates from
+        :param silent: Skip the sales for which rating failed instead of
+                       raising an error
+        :return: Dictionary mapping the sale id to the list of rates as
+                 returned by get_shipping_rate
+        """
+        rates = dict((sale.id, []) for sale in sales)
+
+        to_rate = []
+        postage_prices = {}
+        requests = {}
+        for sale in sales:
+            for carrier in carriers:
+                if carrier.carrier_cost_method != 'endicia':
+                    rates[sale.id].extend(
+                        sale.get_shipping_rate(carrier, silent=silent)
+                    )
+                    continue
+                request, key = sale._get_endicia_rate_request(carrier)
+                local_rates = sale._get_endicia_local_rates(carrier, key)
+                if local_rates is not None:
+                    rates[sale.id].extend(local_rates)
+                    continue
+                to_rate.append((sale, carrier, key))
+                if key in postage_prices or key in requests:
+                    continue
+                prices = RATE_CACHE.get(
+                    key, stale=not is_available('PostageRatesAPI')
+                )
+                if prices is None:
+                    requests[key] = request
+                else:
+                    postage_prices[key] = prices
+
+        postage_prices.update(
+            cls._send_endicia_rate_requests(requests, silent=silent)
+        )
+
+        for sale, carrier, key in to_rate:
+            if key in postage_prices:
+                rates[sale.id].extend(
+                    sale._get_endicia_rates(carrier, postage_prices[key])
+                )
+        return rates
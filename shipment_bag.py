@@ -3,67 +3,386 @@
     shipment_bag
 
 """
-import base64
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
 
-from trytond.model import Workflow, ModelView
+from trytond.model import Workflow, ModelView, fields
 from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval, Bool
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+from trytond.config import config
 
 from endicia import SCANFormAPI
 from endicia.tools import objectify_response
 
+from client import iter_requests
+from label_store import save_label
+
 __metaclass__ = PoolMeta
 __all__ = ['ShippingManifest']
 
+logger = logging.getLogger(__name__)
+
+# Number of PIC numbers sent in each SCANFormAPI request
+SCAN_CHUNK_SIZE = config.getint(
+    'shipping_endicia', 'scan_chunk_size', default=1000
+)
+# Number of manifests whose SCAN Forms are generated at a time
+SCAN_BATCH_SIZE = config.getint(
+    'shipping_endicia', 'scan_batch_size', default=10
+)
+# Seconds after which a manifest still processing is deemed abandoned by
+# its worker and is queued again
+SCAN_CLAIM_TIMEOUT = config.getint(
+    'shipping_endicia', 'scan_timeout', default=3600
+)
+
 
 class ShippingManifest:
     __name__ = 'shipping.manifest'
 
+    endicia_scan_state = fields.Selection([
+        (None, ''),
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'SCAN Form State', readonly=True, select=True)
+    endicia_scan_claimed_at = fields.DateTime(
+        'SCAN Form Claimed At', readonly=True
+    )
+    endicia_scan_failed_pics = fields.Text(
+        'SCAN Form Failed PIC Numbers', readonly=True
+    )
+    endicia_scan_error = fields.Text(
+        'SCAN Form Error', readonly=True, states={
+            'invisible': ~Bool(Eval('endicia_scan_error')),
+        }
+    )
+
     @classmethod
     def __setup__(cls):
         super(ShippingManifest, cls).__setup__()
 
         cls._error_messages.update({
             'error_scanform': 'Error in generating scanform "%s"',
+            'scan_form_in_progress': 'The SCAN Forms of manifest "%s" are '
+                'being generated.',
+        })
+        cls._buttons.update({
+            'retry_endicia_scan_forms': {
+                'invisible': ~Eval('endicia_scan_state').in_(
+                    ['failed', 'processing']
+                ),
+            },
         })
 
+    @classmethod
+    def _search_open_manifests(cls, keys):
+        """
+        Returns a dictionary of the open manifests of keys
+
+        :param keys: List of (carrier, warehouse)
+        """
+        manifests = cls.search([
+            ('state', '=', 'open'),
+            ('carrier', 'in', list(set(carrier.id for carrier, _ in keys))),
+            ('warehouse', 'in', list(set(
+                warehouse.id for _, warehouse in keys
+            ))),
+        ])
+        keys = set(keys)
+        return dict(
+            ((manifest.carrier, manifest.warehouse), manifest)
+            for manifest in manifests
+            if (manifest.carrier, manifest.warehouse) in keys
+        )
+
+    @classmethod
+    def get_manifests(cls, keys):
+        """
+        Returns the open manifest of each (carrier, warehouse) of keys,
+        opening the missing ones.
+
+        :param keys: List of (carrier, warehouse)
+        :return: Dictionary mapping each key to its manifest
+        """
+        manifests = cls._search_open_manifests(keys)
+        missing = [key for key in keys if key not in manifests]
+        if missing:
+            # Serialize the opening of manifests between transactions, so
+            # that a single one is open per carrier and warehouse
+            transaction = Transaction()
+            transaction.database.lock(transaction.connection, cls._table)
+            manifests.update(cls._search_open_manifests(missing))
+            missing = [key for key in missing if key not in manifests]
+            created = cls.create([{
+                'carrier': carrier.id,
+                'warehouse': warehouse.id,
+            } for carrier, warehouse in missing])
+            manifests.update(zip(missing, created))
+        return manifests
+
     @classmethod
     @ModelView.button
     @Workflow.transition('closed')
     def close(cls, manifests):
         """
-        Generate the SCAN Form for manifest
+        Close the manifests. Their SCAN Forms are generated in the background
+        by process_endicia_scan_forms, so that new shipments can be added to
+        the next manifests meanwhile.
         """
-        Attachment = Pool().get('ir.attachment')
-
         super(ShippingManifest, cls).close(manifests)
         for manifest in manifests:
             if not manifest.shipments:
                 manifest.raise_user_error('manifest_empty')
 
-            if manifest.carrier_cost_method != 'endicia':
-                continue
+        manifests = [
+            manifest for manifest in manifests
+            if manifest.carrier_cost_method == 'endicia'
+        ]
+        if manifests:
+            cls.write(manifests, {
+                'endicia_scan_state': 'pending',
+            })
 
-            pic_numbers = [
-                shipment.tracking_number.tracking_number
-                for shipment in manifest.shipments if shipment.tracking_number
-            ]
-            test = manifest.carrier.endicia_is_test and 'Y' or 'N'
-            scan_request = SCANFormAPI(
-                pic_numbers=pic_numbers,
-                accountid=manifest.carrier.endicia_account_id,
-                requesterid=manifest.carrier.endicia_requester_id,
-                passphrase=manifest.carrier.endicia_passphrase,
-                test=test,
+    @classmethod
+    @ModelView.button
+    def retry_endicia_scan_forms(cls, manifests):
+        """
+        Queue the manifests whose SCAN Forms failed or were abandoned by
+        their worker again
+        """
+        for manifest in manifests:
+            if manifest.endicia_scan_state == 'processing' \
+                    and not manifest._is_endicia_scan_abandoned():
+                cls.raise_user_error(
+                    'scan_form_in_progress', error_args=(manifest.rec_name,)
+                )
+        cls.write([
+            manifest for manifest in manifests
+            if manifest.endicia_scan_state in ('failed', 'processing')
+        ], {
+            'endicia_scan_state': 'pending',
+        })
+
+    @staticmethod
+    def _get_endicia_scan_claim_limit():
+        """
+        Returns the claim time before which a manifest still processing was
+        abandoned
+        """
+        return datetime.utcnow() - timedelta(seconds=SCAN_CLAIM_TIMEOUT)
+
+    def _is_endicia_scan_abandoned(self):
+        claimed_at = self.endicia_scan_claimed_at
+        limit = self._get_endicia_scan_claim_limit()
+        return claimed_at is None or claimed_at < limit
+
+    def _get_endicia_scan_pics(self):
+        """
+        Returns the PIC numbers to generate SCAN Forms for, the ones which
+        failed if any or else all those of the manifest
+        """
+        if self.endicia_scan_failed_pics:
+            return self.endicia_scan_failed_pics.split()
+        return [
+            shipment.tracking_number.tracking_number
+            for shipment in self.shipments if shipment.tracking_number
+        ]
+
+    @classmethod
+    def generate_endicia_scan_forms(cls, manifests):
+        """
+        Generate the SCAN Forms of manifests.
+
+        The PIC numbers are split into requests of SCAN_CHUNK_SIZE, all sent
+        concurrently, and each form is committed as soon as it is received,
+        with the PIC numbers of its manifest left, so that the forms accepted
+        by Endicia are kept whatever happens to the other requests. The PIC
+        numbers of the failed requests are kept on their manifest to be
+        retried.
+        """
+        chunks, requests = [], []
+        remaining = {}
+        for manifest in manifests:
+            carrier = manifest.carrier
+            pic_numbers = manifest._get_endicia_scan_pics()
+            remaining[manifest] = pic_numbers
+            for pics in grouped_slice(pic_numbers, SCAN_CHUNK_SIZE):
+                pics = list(pics)
+                chunks.append((manifest, pics))
+                requests.append(SCANFormAPI(
+                    pic_numbers=pics,
+                    accountid=carrier.endicia_account_id,
+                    requesterid=carrier.endicia_requester_id,
+                    passphrase=carrier.endicia_passphrase,
+                    test=carrier.endicia_is_test and 'Y' or 'N',
+                ))
+
+        errors = defaultdict(list)
+        for index, response, error in iter_requests(requests):
+            manifest, pics = chunks[index]
+            if error is None:
+                result = objectify_response(response)
+                if hasattr(result, 'SCANForm'):
+                    accepted = set(pics)
+                    remaining[manifest] = [
+                        pic for pic in remaining[manifest]
+                        if pic not in accepted
+                    ]
+                    with Transaction().new_transaction():
+                        save_label(
+                            'SCAN%s.png' % str(result.SubmissionID),
+                            result.SCANForm.pyval, manifest
+                        )
+                        values = {
+                            'endicia_scan_failed_pics': '\n'.join(
+                                remaining[manifest]
+                            ),
+                        }
+                        if not remaining[manifest]:
+                            values['endicia_scan_state'] = 'done'
+                        cls.write([cls(manifest.id)], values)
+                    continue
+                error = unicode(result.ErrorMsg)
+            logger.warning(
+                'SCAN Form of manifest %s failed: %s', manifest.id, error
+            )
+            errors[manifest].append(
+                getattr(error, 'message', None) or unicode(error)
             )
-            response = scan_request.send_request()
-            result = objectify_response(response)
-            if not hasattr(result, 'SCANForm'):
-                manifest.raise_user_error(
-                    'error_scanform', error_args=(result.ErrorMsg,)
+
+        to_write = []
+        for manifest in manifests:
+            to_write.extend([[cls(manifest.id)], {
+                'endicia_scan_state': (
+                    'failed' if remaining[manifest] else 'done'
+                ),
+                'endicia_scan_failed_pics': '\n'.join(remaining[manifest]),
+                'endicia_scan_error': '\n'.join(errors[manifest]),
+            }])
+        if to_write:
+            with Transaction().new_transaction():
+                cls.write(*to_write)
+
+    @classmethod
+    def _claim_endicia_scan_forms(cls, limit):
+        """
+        Mark pending manifests as processing and commit, so that other
+        workers do not pick them up.
+
+        :return: List of the claimed manifest ids
+        """
+        with Transaction().new_transaction() as transaction:
+            transaction.database.lock(transaction.connection, cls._table)
+            manifests = cls.search([
+                ('endicia_scan_state', '=', 'pending'),
+            ], limit=limit, order=[('id', 'ASC')])
+            cls.write(manifests, {
+                'endicia_scan_state': 'processing',
+                'endicia_scan_claimed_at': datetime.utcnow(),
+            })
+            return map(int, manifests)
+
+    @classmethod
+    def _reclaim_endicia_scan_forms(cls):
+        """
+        Queue again the manifests claimed more than SCAN_CLAIM_TIMEOUT seconds
+        ago and still processing, as their worker stopped before saving the
+        result of their SCAN Forms.
+
+        :return: List of the reclaimed manifest ids
+        """
+        with Transaction().new_transaction() as transaction:
+            transaction.database.lock(transaction.connection, cls._table)
+            manifests = cls.search([
+                ('endicia_scan_state', '=', 'processing'),
+                ['OR',
+                    ('endicia_scan_claimed_at', '=', None),
+                    ('endicia_scan_claimed_at', '<',
+                        cls._get_endicia_scan_claim_limit()),
+                ],
+            ])
+            for manifest in manifests:
+                logger.warning(
+                    'SCAN Forms of manifest %s were abandoned', manifest.id
                 )
-            else:
-                Attachment.create([{
-                    'name': 'SCAN%s.png' % str(result.SubmissionID),
-                    'data': buffer(base64.decodestring(result.SCANForm.pyval)),
-                    'resource': '%s,%s' % (manifest.__name__, manifest.id)
-                }])
+            cls.write(manifests, {
+                'endicia_scan_state': 'pending',
+                'endicia_scan_error': 'Abandoned by its worker',
+            })
+            return map(int, manifests)
+
+    @classmethod
+    def process_endicia_scan_forms(cls, limit=SCAN_BATCH_SIZE):
+        """
+        Claim pending manifests and generate their SCAN Forms, the manifests
+        abandoned by a worker being queued again first
+        """
+        cls._reclaim_endicia_scan_forms()
+        manifest_ids = cls._claim_endicia_scan_forms(limit)
+        if not manifest_ids:
+            return
+        try:
+            # The results are committed as they are received
+            cls.generate_endicia_scan_forms(cls.browse(manifest_ids))
+        except Exception, error:
+            logger.exception('SCAN Forms of manifests %s failed', manifest_ids)
+            with Transaction().new_transaction():
+                # The manifests whose forms were all committed are done
+                cls.write(cls.search([
+                    ('id', 'in', manifest_ids),
+                    ('endicia_scan_state', '=', 'processing'),
+                ]), {
+                    'endicia_scan_state': 'failed',
+                    'endicia_scan_error': cls.raise_user_error(
+                        'error_scanform', error_args=(
+                            getattr(error, 'message', None) or unicode(error),
+                        ), raise_exception=False
+                    ),
+                })
+
+    @classmethod
+    def close_endicia_manifests(cls):
+        """
+        Close the open Endicia manifests of the warehouses whose cutoff time
+        of the day has passed, if they were opened before it
+        """
+        Location = Pool().get('stock.location')
+
+        now = datetime.utcnow()
+        manifests = []
+        warehouses = Location.search([
+            ('type', '=', 'warehouse'),
+            ('endicia_manifest_cutoff', '!=', None),
+        ])
+        for warehouse in warehouses:
+            cutoff = datetime.combine(
+                now.date(), warehouse.endicia_manifest_cutoff
+            )
+            if cutoff > now:
+                continue
+            manifests.extend(cls.search([
+                ('state', '=', 'open'),
+                ('warehouse', '=', warehouse.id),
+                ('carrier.carrier_cost_method', '=', 'endicia'),
+                ('create_date', '<', cutoff),
+            ]))
+        manifests = [manifest for manifest in manifests if manifest.shipments]
+        if manifests:
+            cls.close(manifests)
+
+    @classmethod
+    def process_endicia_manifests(cls):
+        """
+        Close the manifests at their cutoff time and generate the pending
+        SCAN Forms.
+
+        Meant to be called by the cron.
+        """
+        with Transaction().new_transaction():
+            cls.close_endicia_manifests()
+        cls.process_endicia_scan_forms()
@@ -1,19 +1,34 @@
 # -*- encoding: utf-8 -*-
 from decimal import Decimal, ROUND_UP
-import base64
+import os
 import math
 import logging
+import tempfile
+import urllib
+from collections import defaultdict
+from contextlib import contextmanager
 
 from endicia import ShippingLabelAPI, LabelRequest, RefundRequestAPI, \
     BuyingPostageAPI, Element
 from endicia.tools import objectify_response, get_images
 from endicia.exceptions import RequestError
 
+from trytond import backend
 from trytond.model import Workflow, ModelView, fields
 from trytond.wizard import Wizard, StateView, Button, StateTransition
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Eval
+from trytond.pyson import Eval, Bool, Or
+from trytond.exceptions import UserError
+from trytond.tools import grouped_slice
+from trytond.config import config
+
+from client import send_request, send_requests
+from carrier import get_endicia_label_size
+from reference import get_uom, get_customs_profiles, get_address_payloads
+from label_store import save_label, read_label, decoded_size, \
+    get_label_store
+from print_batch import iter_job, UnsupportedLabelError
 
 ENDICIA_STATES = {
     'readonly': Eval('state') == 'done',
@@ -21,6 +36,13 @@ ENDICIA_STATES = {
 }
 ENDICIA_DEPENDS = ['state', 'carrier_cost_method']
 
+# Extension of the label files of each Endicia image format
+ENDICIA_IMAGE_EXTENSIONS = {
+    'JPEG': 'jpg',
+    'ZPLII': 'zpl',
+    'EPL2': 'epl',
+}
+
 ENDICIA_PACKAGE_TYPES = [
     ('Documents', 'Documents'),
     ('Gift', 'Gift'),
@@ -29,11 +51,25 @@ ENDICIA_PACKAGE_TYPES = [
     ('Sample', 'Sample')
 ]
 
+# Number of PIC numbers sent in each RefundRequestAPI request
+REFUND_CHUNK_SIZE = config.getint(
+    'shipping_endicia', 'refund_chunk_size', default=100
+)
+# Size in bytes up to which a print job is returned as the data of the file
+# when there is no label store, larger ones are left in a temporary file
+PRINT_DATA_SIZE = config.getint(
+    'shipping_endicia', 'print_data_size', default=10 * 1024 * 1024
+)
+
 __metaclass__ = PoolMeta
 __all__ = [
     'ShipmentOut', 'ShippingEndicia', 'GenerateShippingLabel',
     'EndiciaRefundRequestWizardView', 'EndiciaRefundRequestWizard',
     'BuyPostageWizardView', 'BuyPostageWizard',
+    'GenerateEndiciaLabelsResult', 'GenerateEndiciaLabels',
+    'PrintEndiciaLabelsStart', 'PrintEndiciaLabelsResult',
+    'PrintEndiciaLabels', 'CheckEndiciaAddressesResult',
+    'CheckEndiciaAddresses',
 ]
 
 logger = logging.getLogger(__name__)
@@ -43,6 +79,32 @@ def quantize_2_decimal(value):
     return Decimal("%f" % value).quantize(Decimal('.01'), rounding=ROUND_UP)
 
 
+@contextmanager
+def savepoint(name):
+    """
+    Roll back the changes of the block if it raises, without rolling back
+    the rest of the transaction.
+
+    The sqlite3 module of Python 2 commits before any SAVEPOINT statement,
+    so the block is not isolated on SQLite.
+    """
+    transaction = Transaction()
+    if backend.name() == 'sqlite':
+        yield
+        return
+    cursor = transaction.connection.cursor()
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        # The records cached by the transaction may be rolled back ones
+        for cache in transaction.cache.itervalues():
+            cache.clear()
+        raise
+    cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
 class ShipmentOut:
     __name__ = 'stock.shipment.out'
 
@@ -82,6 +144,19 @@ class ShipmentOut:
             'invalid_state': 'Labels can only be generated when the '
                 'shipment is in Packed or Done states only',
             'wrong_carrier': 'Carrier for selected shipment is not Endicia',
+            'no_packages': 'There should be at least one package to '
+                'generate USPS label',
+            'unpacked_moves': 'All the moves of the shipment "%s" must be '
+                'packed to declare the content of each of its packages.',
+        })
+        cls._buttons.update({
+            'queue_endicia_label': {
+                'invisible': Or(
+                    Eval('carrier_cost_method') != 'endicia',
+                    Bool(Eval('tracking_number')),
+                    ~Eval('state').in_(['packed', 'done']),
+                ),
+            },
         })
 
     @classmethod
@@ -100,53 +175,98 @@ class ShipmentOut:
     def done(cls, shipments):
         """
         Add endicia shipments to a open manifest
+
+        Shipments are grouped by carrier and warehouse, so that the manifest
+        of each group is resolved once and assigned with a single write.
         """
         ShippingManifest = Pool().get('shipping.manifest')
 
         super(ShipmentOut, cls).done(shipments)
 
+        groups = defaultdict(list)
         for shipment in shipments:
             if shipment.carrier and \
                     shipment.carrier.carrier_cost_method == 'endicia':
-                with Transaction().set_user(0):
-                    manifest = ShippingManifest.get_manifest(
-                        shipment.carrier, shipment.warehouse
+                groups[(shipment.carrier, shipment.warehouse)].append(
+                    shipment
+                )
+        if not groups:
+            return
+
+        with Transaction().set_user(0):
+            manifests = ShippingManifest.get_manifests(groups.keys())
+        to_write = []
+        for key, group in groups.iteritems():
+            to_write.extend([group, {'shipping_manifest': manifests[key].id}])
+        cls.write(*to_write)
+
+    @classmethod
+    @ModelView.button
+    def queue_endicia_label(cls, shipments):
+        """
+        Queue the shipments for their label to be generated in the
+        background
+        """
+        LabelJob = Pool().get('endicia.label.job')
+
+        for shipment in shipments:
+            if shipment.carrier_cost_method != 'endicia':
+                shipment.raise_user_error('wrong_carrier')
+            shipment.allow_label_generation()
+        LabelJob.enqueue(shipments)
+
+    def _get_endicia_customs(self, moves):
+        """
+        Build the customs declaration of the moves in a single pass, from
+        the cached customs profiles of their products
+
+        :return: Tuple of the CustomsItem elements, the total value and the
+                 description of the content
+        """
+        Uom = Pool().get('product.uom')
+
+        profiles = get_customs_profiles([move.product for move in moves])
+        items, total_value, names = [], 0, []
+        for move in moves:
+            value, name, unit_weight_oz = profiles[move.product.id]
+            names.append(name)
+            total_value += float(value) * move.quantity
+            if move.quantity <= 0:
+                continue
+            if unit_weight_oz is None:
+                # Raises the error of the product without weight
+                weight_oz = move.get_weight(get_uom('oz'))
+            else:
+                quantity = move.quantity
+                if move.uom != move.product.default_uom:
+                    quantity = Uom.compute_qty(
+                        move.uom, quantity, move.product.default_uom
                     )
-                shipment.manifest = manifest
-                shipment.save()
+                weight_oz = unit_weight_oz * quantity
+            items.append(Element('CustomsItem', [
+                Element('Description', name[0:50]),
+                Element('Quantity', int(math.ceil(move.quantity))),
+                Element('Weight', quantize_2_decimal(weight_oz)),
+                Element('Value', quantize_2_decimal(value)),
+            ]))
+        return items, total_value, ','.join(names)
 
-    def _update_endicia_item_details(self, request):
+    def _update_endicia_item_details(self, request, moves=None):
         '''
         Adding customs items/info and form descriptions to the request
 
         :param request: Shipping Label API request instance
+        :param moves: Moves to declare, defaults to all the moves of the
+                      shipment
         '''
         User = Pool().get('res.user')
-        UOM = Pool().get('product.uom')
 
+        if moves is None:
+            moves = self.carrier_cost_moves
         user = User(Transaction().user)
-        uom_oz, = UOM.search([('symbol', '=', 'oz')])
-        customsitems = []
-        value = 0
-
-        for move in self.carrier_cost_moves:
-            if move.quantity <= 0:
-                continue
-            weight_oz = quantize_2_decimal(move.get_weight(uom_oz))
-            new_item = [
-                Element('Description', move.product.name[0:50]),
-                Element('Quantity', int(math.ceil(move.quantity))),
-                Element('Weight', weight_oz),
-                Element('Value', quantize_2_decimal(
-                    move.product.customs_value_used
-                )),
-            ]
-            customsitems.append(Element('CustomsItem', new_item))
-            value += float(move.product.customs_value_used) * move.quantity
-
-        description = ','.join([
-            move.product.name for move in self.carrier_cost_moves
-        ])
+        customsitems, total_value, description = self._get_endicia_customs(
+            moves
+        )
         request.add_data({
             'customsinfo': [
                 Element('ContentsExplanation', description[:25]),
@@ -154,10 +274,6 @@ class ShipmentOut:
                 Element('ContentsType', self.endicia_package_type)
             ]
         })
-        total_value = sum(map(
-            lambda move: float(move.product.customs_value_used) * move.quantity,
-            self.carrier_cost_moves
-        ))
         request.add_data({
             'ContentsType': self.endicia_package_type,
             'Value': quantize_2_decimal(total_value),
@@ -166,43 +282,82 @@ class ShipmentOut:
             'CustomsSigner': user.name,
         })
 
-    def generate_shipping_labels(self, **kwargs):
+    @classmethod
+    def _load_endicia_customs_profiles(cls, shipments):
         """
-        Make labels for the given shipment
+        Load the customs profiles of the products of all the international
+        shipments at once
+        """
+        get_customs_profiles([
+            move.product for shipment in shipments
+            if getattr(shipment.delivery_address.country, 'code', 'US') != 'US'
+            for move in shipment.carrier_cost_moves
+        ])
 
-        :return: Tracking number as string
+    @classmethod
+    def _load_endicia_addresses(cls, shipments):
         """
-        Attachment = Pool().get('ir.attachment')
-        Tracking = Pool().get('shipment.tracking')
-        Uom = Pool().get('product.uom')
+        Convert the delivery and warehouse addresses of all the shipments
+        at once
+        """
+        get_address_payloads([
+            address for shipment in shipments
+            for address in (
+                shipment.delivery_address, shipment.warehouse.address
+            ) if address
+        ])
 
-        if self.carrier_cost_method != 'endicia':
-            return super(ShipmentOut, self).generate_shipping_labels(**kwargs)
+    def _get_endicia_label_format(self):
+        """
+        Returns the format of the labels, set on the carrier and overridden
+        by the warehouse the shipment leaves from
+
+        :return: Dictionary of the LabelRequest format attributes
+        """
+        carrier, warehouse = self.carrier, self.warehouse
+        # The first value set of each attribute is used
+        candidates = {
+            'ImageFormat': (
+                warehouse.endicia_image_format,
+                carrier.endicia_image_format, 'PNG',
+            ),
+            'LabelSize': (carrier.endicia_label_size, '6x4'),
+            'ImageResolution': (
+                warehouse.endicia_image_resolution,
+                carrier.endicia_image_resolution, '203',
+            ),
+            'ImageRotation': (carrier.endicia_image_rotation, 'Rotate270'),
+        }
+        label_format = dict(
+            (name, next(value for value in values if value))
+            for name, values in candidates.iteritems()
+        )
+        # The size of the carrier must fit the format of the warehouse
+        label_format['LabelSize'] = get_endicia_label_size(
+            label_format['ImageFormat'], label_format['LabelSize']
+        )
+        return label_format
+
+    def _get_endicia_label_request(self, package):
+        """
+        Build the ShippingLabelAPI request for the package of the shipment
+
+        :param package: Package of the shipment
+        :return: ShippingLabelAPI instance
+        """
+        Uom = Pool().get('product.uom')
 
         label_request = LabelRequest(
             Test=self.carrier.endicia_is_test and 'YES' or 'NO',
             LabelType=(
                 'International' in self.carrier_service.code
             ) and 'International' or 'Default',
-            # TODO: Probably the following have to be configurable
-            ImageFormat="PNG",
-            LabelSize="6x4",
-            ImageResolution="203",
-            ImageRotation="Rotate270",
+            **self._get_endicia_label_format()
         )
 
-        try:
-            package, = self.packages
-        except ValueError:
-            self.raise_user_error(
-                "There should be exactly one package to generate USPS label"
-                "\n Multi Piece shipment is not supported yet"
-            )
-
-        oz, = Uom.search([('symbol', '=', 'oz')])
         # Endicia only support 1 decimal place in weight
         weight_oz = "%.1f" % Uom.compute_qty(
-            package.weight_uom, package.weight, oz
+            package.weight_uom, package.weight, get_uom('oz')
         )
         shipping_label_request = ShippingLabelAPI(
             label_request=label_request,
@@ -221,10 +376,11 @@ class ShipmentOut:
 
         # Dimensions required for priority mail class and
         # all values must be in inches
-        to_uom, = Uom.search([('symbol', '=', 'in')])
-        from_uom, = Uom.search([('symbol', '=', package.distance_unit.symbol)])
+        to_uom = get_uom('in')
+        from_uom = package.distance_unit
         if (package.length and package.width and package.height):
-            length, width, height = package.length, package.width, package.height
+            length, width, height = \
+                package.length, package.width, package.height
             if from_uom != to_uom:
                 length = "%.1f" % Uom.compute_qty(
                     from_uom, package.length, to_uom
@@ -262,58 +418,408 @@ class ShipmentOut:
             })
 
         if self.delivery_address.country.code != 'US':
-            self._update_endicia_item_details(shipping_label_request)
+            # Each piece of a multi piece shipment declares its own content
+            self._update_endicia_item_details(
+                shipping_label_request,
+                self._get_endicia_package_moves(package)
+                if len(self.root_packages) > 1 else None
+            )
+
+        return shipping_label_request
+
+    def _get_endicia_package_moves(self, package):
+        """
+        Returns the moves of the package and of the packages it contains
+        """
+        moves = list(package.moves)
+        for child in package.children:
+            moves.extend(self._get_endicia_package_moves(child))
+        return moves
+
+    def _get_endicia_label_requests(self):
+        """
+        Build the ShippingLabelAPI requests of the outer packages of the
+        shipment, the packages they contain being shipped inside them
+
+        :return: List of (package, ShippingLabelAPI instance)
+        """
+        if not self.root_packages:
+            self.raise_user_error('no_packages')
+        # Catch the addresses Endicia would reject before paying for a
+        # round-trip
+        self.delivery_address.check_endicia_address()
+        if len(self.root_packages) > 1 and \
+                self.delivery_address.country.code != 'US':
+            packed = set(
+                move for package in self.root_packages
+                for move in self._get_endicia_package_moves(package)
+            )
+            if any(move not in packed for move in self.carrier_cost_moves):
+                self.raise_user_error('unpacked_moves', self.rec_name)
+        return [
+            (package, self._get_endicia_label_request(package))
+            for package in self.root_packages
+        ]
+
+    @staticmethod
+    def _send_endicia_label_requests(label_requests):
+        """
+        Send the label requests of the packages of many shipments
+        concurrently
+
+        :param label_requests: List of the (package, request) lists of each
+                               shipment
+        :return: List of the (package, response, exception) lists of each
+                 shipment, in the same order
+        """
+        LabelJournal = Pool().get('endicia.label.request')
+        PostageLedger = Pool().get('endicia.postage.ledger')
+
+        flat = [
+            (package, request) for requests in label_requests
+            for package, request in requests
+        ]
+        # Make sure the accounts can pay for the labels before sending, on
+        # the queue as on the labels generated at once
+        PostageLedger.replenish(
+            set(package.shipment.carrier for package, _ in flat)
+        )
+        # Journal the requests before sending them, so that a label which
+        # was paid for is never bought again
+        entries = LabelJournal.begin([int(package) for package, _ in flat])
+        to_send = []
+        for (package, request), entry in zip(flat, entries):
+            if entry[1] is not None:
+                request.partnertransactionid = entry[1]
+                to_send.append((entry[0], request))
+        sent = send_requests([request for _, request in to_send])
+        LabelJournal.record([
+            (entry_id, result[0], result[1])
+            for (entry_id, _), result in zip(to_send, sent)
+        ])
+
+        # Responses received earlier are reused instead of the ones sent
+        sent = iter(sent)
+        results = iter([
+            next(sent) if entry[1] is not None else entry[2:]
+            for entry in entries
+        ])
+        return [
+            [
+                (package,) + next(results)
+                for package, _ in requests
+            ] for requests in label_requests
+        ]
+
+    def _save_endicia_label(self, package, response, is_master=False):
+        """
+        Save the tracking number and label images of the ShippingLabelAPI
+        response of a package
+
+        :param package: Package the label was generated for
+        :param response: Response XML of the ShippingLabelAPI request
+        :param is_master: True for the tracking number of the shipment
+        :return: Tuple of the tracking record and the postage of the package
+        """
+        Tracking = Pool().get('shipment.tracking')
+        PostageLedger = Pool().get('endicia.postage.ledger')
+
+        result = objectify_response(response)
+        images = get_images(result)
+        image_format = self._get_endicia_label_format()['ImageFormat']
+
+        tracking_number = unicode(result.TrackingNumber.pyval)
+        tracking, = Tracking.create([{
+            'carrier': self.carrier,
+            'tracking_number': tracking_number,
+            'origin': '%s,%d' % (package.__name__, package.id),
+            'is_master': is_master,
+            'endicia_response_size': len(response),
+            'endicia_label_size': sum(
+                decoded_size(label) for _, label in images
+            ),
+        }])
+
+        # Save images as attachments
+        extension = ENDICIA_IMAGE_EXTENSIONS.get(
+            image_format, image_format.lower()
+        )
+        for (id, label) in images:
+            save_label(
+                "%s_%s_USPS-Endicia.%s" % (tracking_number, id, extension),
+                package._process_raw_label(label, image_format=image_format),
+                tracking
+            )
+        PostageLedger.record_charge(self.carrier, response, tracking_number)
+        return tracking, Decimal(str(result.FinalPostage.pyval))
+
+    def _save_endicia_labels(self, labels):
+        """
+        Save the labels of all the packages of the shipment. The tracking
+        number of the first package becomes the one of the shipment and the
+        cost of the shipment is the total postage of the packages.
+
+        :param labels: List of (package, ShippingLabelAPI response XML)
+        """
+        LabelJournal = Pool().get('endicia.label.request')
+
+        trackings, cost = [], Decimal('0')
+        for package, response in labels:
+            tracking, postage = self._save_endicia_label(
+                package, response, is_master=not trackings
+            )
+            trackings.append(tracking)
+            cost += postage
+        LabelJournal.done([package for package, _ in labels])
+
+        self.tracking_number = trackings[0].id
+        self.save()
+
+        self.__class__.write([self], {
+            'cost': cost,
+        })
+
+    def _get_endicia_label_error(self, results):
+        """
+        Returns the error message of the failed requests of results or None
+        if all the labels were generated
+
+        :param results: List of (package, response, exception)
+        """
+        messages = [
+            getattr(error, 'message', None) or unicode(error)
+            for _, _, error in results if error is not None
+        ]
+        if not messages:
+            return None
+        return self.raise_user_error(
+            'error_label', error_args=('\n'.join(messages),),
+            raise_exception=False
+        )
+
+    def generate_shipping_labels(self, **kwargs):
+        """
+        Make labels for the given shipment
+
+        :return: Tracking number as string
+        """
+        if self.carrier_cost_method != 'endicia':
+            return super(ShipmentOut, self).generate_shipping_labels(**kwargs)
+
+        label_requests = self._get_endicia_label_requests()
 
-        # Logging.
         logger.debug(
-            'Making Shipping Label Request for'
-            'Shipment ID: {0} and Carrier ID: {1}'
-            .format(self.id, self.carrier.id)
+            'Making Shipping Label Request for Shipment ID: %s and '
+            'Carrier ID: %s', self.id, self.carrier.id
         )
-        logger.debug('--------SHIPPING LABEL REQUEST--------')
-        logger.debug(str(shipping_label_request.to_xml()))
-        logger.debug('--------END REQUEST--------')
+        results, = self._send_endicia_label_requests([label_requests])
+        error = self._get_endicia_label_error(results)
+        if error is not None:
+            self.raise_user_error(error)
 
-        try:
-            response = shipping_label_request.send_request()
-        except RequestError, error:
-            self.raise_user_error('error_label', error_args=(error.message,))
-        else:
-            result = objectify_response(response)
-
-            # Logging.
-            logger.debug('--------SHIPPING LABEL RESPONSE--------')
-            logger.debug(str(response))
-            logger.debug('--------END RESPONSE--------')
-
-            tracking_number = unicode(result.TrackingNumber.pyval)
-            stock_package = self.packages[0]
-            tracking, = Tracking.create([{
-                'carrier': self.carrier,
-                'tracking_number': tracking_number,
-                'origin': '%s,%d' % (
-                    stock_package.__name__, stock_package.id
-                ),
-            }])
+        self._save_endicia_labels([
+            (package, response) for package, response, _ in results
+        ])
 
-            self.tracking_number = tracking.id
-            self.save()
+    @classmethod
+    def get_endicia_label_attachments(cls, shipments):
+        """
+        Returns the label images of the packages of the shipments, in the
+        order of the shipments and of their packages
+        """
+        Attachment = Pool().get('ir.attachment')
+        Tracking = Pool().get('shipment.tracking')
 
-            self.__class__.write([self], {
-                'cost': Decimal(str(result.FinalPostage.pyval)),
-            })
+        packages = [
+            package for shipment in shipments
+            for package in shipment.packages
+        ]
+        trackings = []
+        for sub_packages in grouped_slice(packages):
+            trackings.extend(Tracking.search([
+                ('origin', 'in', [
+                    '%s,%d' % (package.__name__, package.id)
+                    for package in sub_packages
+                ]),
+            ], order=[('id', 'ASC')]))
+        position = dict((package.id, i) for i, package in enumerate(packages))
+        trackings.sort(key=lambda tracking: position[tracking.origin.id])
+
+        attachments = {}
+        for sub_trackings in grouped_slice(trackings):
+            for attachment in Attachment.search([
+                ('resource', 'in', [
+                    '%s,%d' % (tracking.__name__, tracking.id)
+                    for tracking in sub_trackings
+                ]),
+                ('name', 'like', '%_USPS-Endicia.%'),
+            ], order=[('id', 'ASC')]):
+                attachments.setdefault(
+                    attachment.resource.id, []
+                ).append(attachment)
+        return [
+            attachment for tracking in trackings
+            for attachment in attachments.get(tracking.id, [])
+        ]
+
+    @classmethod
+    def check_endicia_addresses(cls, shipments=None):
+        """
+        Check the delivery addresses of the shipments against the rules of
+        Endicia, without sending any request
+
+        :param shipments: Shipments to check, defaults to all the packed
+                          Endicia shipments
+        :return: Dictionary mapping the shipments with an invalid address
+                 to the list of the problems
+        """
+        if shipments is None:
+            shipments = cls.search([
+                ('state', '=', 'packed'),
+                ('carrier.carrier_cost_method', '=', 'endicia'),
+            ])
+        errors = {}
+        cls._load_endicia_addresses(shipments)
+        for shipment in shipments:
+            address_errors = \
+                shipment.delivery_address.get_endicia_address_errors()
+            if address_errors:
+                errors[shipment] = address_errors
+        return errors
+
+    @classmethod
+    def generate_endicia_labels(cls, shipments):
+        """
+        Make the labels of many shipments at once.
+
+        The ShippingLabelAPI requests of all the packages are sent
+        concurrently. The labels of a shipment are saved once all its
+        packages have one, and a shipment which fails is rolled back to its
+        savepoint without preventing the labels of the others from being
+        saved.
+
+        :param shipments: List of shipments to make the labels of
+        :return: Dictionary mapping the id of the shipments to an error
+                 message, or None if the label was generated
+        """
+        errors = {}
+        to_send = []
+        cls._load_endicia_customs_profiles(shipments)
+        cls._load_endicia_addresses(shipments)
+        for shipment in shipments:
+            try:
+                if shipment.carrier_cost_method != 'endicia':
+                    shipment.raise_user_error('wrong_carrier')
+                shipment.allow_label_generation()
+                to_send.append(
+                    (shipment, shipment._get_endicia_label_requests())
+                )
+            except UserError, error:
+                errors[shipment.id] = error.message
 
-            # Save images as attachments
-            images = get_images(result)
-            for (id, label) in images:
-                label = stock_package._process_raw_label(label)
-                Attachment.create([{
-                    'name': "%s_%s_USPS-Endicia.png" % (tracking_number, id),
-                    'data': buffer(base64.decodestring(label)),
-                    'resource': '%s,%d' % (
-                        self.tracking_number.__name__, self.tracking_number.id
+        all_results = cls._send_endicia_label_requests([
+            label_requests for _, label_requests in to_send
+        ])
+        for (shipment, _), results in zip(to_send, all_results):
+            error = shipment._get_endicia_label_error(results)
+            if error is None:
+                try:
+                    # The records of a shipment which fails halfway are
+                    # rolled back, so that a retry does not duplicate them
+                    with savepoint('endicia_label'):
+                        shipment._save_endicia_labels([
+                            (package, response)
+                            for package, response, _ in results
+                        ])
+                except UserError, error:
+                    error = shipment.raise_user_error(
+                        'error_label', error_args=(error.message,),
+                        raise_exception=False
                     )
-                }])
+            if error is not None:
+                logger.warning(
+                    'Label of shipment %s failed: %s', shipment.id, error
+                )
+            errors[shipment.id] = error
+        return errors
+
+    @staticmethod
+    def _parse_endicia_refund(response):
+        """
+        Parse the result of every PICNumber of a RefundRequestAPI response
+
+        :return: Dictionary mapping the PIC number to a tuple of whether the
+                 refund is approved and the message of Endicia
+        """
+        result = objectify_response(response)
+        statuses = {}
+        for pic in result.RefundList.iterchildren('{*}PICNumber'):
+            approved = pic.find('{*}IsApproved')
+            message = pic.find('{*}ErrorMsg')
+            statuses[(pic.text or '').strip()] = (
+                approved is not None and approved.text == 'YES',
+                message is not None and message.text or u'',
+            )
+        return statuses
+
+    @classmethod
+    def refund_endicia_labels(cls, shipments):
+        """
+        Request the refund of the labels of the shipments.
+
+        The PIC numbers of each carrier are sent in chunks of
+        REFUND_CHUNK_SIZE, the chunks being sent concurrently, and all the
+        approved shipments are marked as refunded at once.
+
+        :return: Dictionary mapping each shipment to a tuple of whether its
+                 refund is approved and the message of Endicia
+        """
+        by_carrier = defaultdict(list)
+        statuses = {}
+        for shipment in shipments:
+            if shipment.carrier_cost_method != 'endicia':
+                cls.raise_user_error('wrong_carrier')
+            if shipment.tracking_number:
+                by_carrier[shipment.carrier].append(shipment)
+            else:
+                statuses[shipment] = (False, u'No tracking number')
+
+        chunks, requests = [], []
+        for carrier, carrier_shipments in by_carrier.iteritems():
+            for chunk in grouped_slice(carrier_shipments, REFUND_CHUNK_SIZE):
+                chunk = list(chunk)
+                chunks.append(chunk)
+                requests.append(RefundRequestAPI(
+                    pic_numbers=[
+                        shipment.tracking_number.tracking_number
+                        for shipment in chunk
+                    ],
+                    accountid=carrier.endicia_account_id,
+                    requesterid=carrier.endicia_requester_id,
+                    passphrase=carrier.endicia_passphrase,
+                    test=carrier.endicia_is_test and 'Y' or 'N',
+                ))
+
+        for chunk, (response, error) in zip(chunks, send_requests(requests)):
+            if error is None:
+                pic_statuses = cls._parse_endicia_refund(response)
+                message = u'No result'
+            else:
+                logger.warning('Endicia refund request failed: %s', error)
+                pic_statuses = {}
+                message = getattr(error, 'message', None) or unicode(error)
+            for shipment in chunk:
+                statuses[shipment] = pic_statuses.get(
+                    shipment.tracking_number.tracking_number, (False, message)
+                )
+
+        approved = [
+            shipment for shipment, (is_approved, _) in statuses.iteritems()
+            if is_approved
+        ]
+        if approved:
+            cls.write(approved, {'endicia_refunded': True})
+        return statuses
 
 
 class EndiciaRefundRequestWizardView(ModelView):
@@ -353,55 +859,30 @@ class EndiciaRefundRequestWizard(Wizard):
         })
 
     def default_request_refund(self, data):
-        """Requests the refund for the current shipment record
-        and returns the response.
+        """Requests the refund of the selected shipments and returns the
+        status of each of them.
         """
         Shipment = Pool().get('stock.shipment.out')
 
         shipments = Shipment.browse(Transaction().context['active_ids'])
-
-        # PICNumber is the argument name expected by endicia in API,
-        # so its better to use the same name here for better understanding
-        pic_numbers = []
         for shipment in shipments:
-            if not (
-                shipment.carrier and
-                shipment.carrier.carrier_cost_method == 'endicia'
-            ):
+            if shipment.carrier_cost_method != 'endicia':
                 self.raise_user_error('wrong_carrier')
 
-            if shipment.tracking_number:
-                pic_numbers.append(shipment.tracking_number.tracking_number)
-
-        test = shipment.carrier.endicia_is_test and 'Y' or 'N'
-
-        refund_request = RefundRequestAPI(
-            pic_numbers=pic_numbers,
-            accountid=shipment.carrier.endicia_account_id,
-            requesterid=shipment.carrier.endicia_requester_id,
-            passphrase=shipment.carrier.endicia_passphrase,
-            test=test,
-        )
-        try:
-            response = refund_request.send_request()
-        except RequestError, error:
-            self.raise_user_error('error_label', error_args=(error.message,))
-
-        result = objectify_response(response)
-        if str(result.RefundList.PICNumber.IsApproved) == 'YES':
-            refund_approved = True
-            # If refund is approved, then set the state of record
-            # as cancel/refund
-            shipment.__class__.write(
-                [shipment], {'endicia_refunded': True}
-            )
-        else:
-            refund_approved = False
-        default = {
-            'refund_status': unicode(result.RefundList.PICNumber.ErrorMsg),
-            'refund_approved': refund_approved
+        statuses = Shipment.refund_endicia_labels(shipments)
+        lines = []
+        for shipment in shipments:
+            approved, message = statuses[shipment]
+            lines.append(u'%s\t%s\t%s' % (
+                shipment.rec_name, approved and u'Approved' or u'Rejected',
+                message,
+            ))
+        return {
+            'refund_status': u'\n'.join(lines),
+            'refund_approved': all(
+                approved for approved, _ in statuses.itervalues()
+            ),
         }
-        return default
 
 
 class BuyPostageWizardView(ModelView):
@@ -441,6 +922,8 @@ class BuyPostageWizard(Wizard):
         """
         Generate the SCAN Form for the current shipment record
         """
+        PostageLedger = Pool().get('endicia.postage.ledger')
+
         default = {}
 
         buy_postage_api = BuyingPostageAPI(
@@ -452,10 +935,13 @@ class BuyPostageWizard(Wizard):
             test=self.start.carrier.endicia_is_test,
         )
         try:
-            response = buy_postage_api.send_request()
+            response = send_request(buy_postage_api)
         except RequestError, error:
             self.raise_user_error('error_label', error_args=(error.message,))
 
+        PostageLedger.record_recredit(
+            self.start.carrier, self.start.amount, response
+        )
         result = objectify_response(response)
         default['amount'] = self.start.amount
         default['carrier'] = self.start.carrier
@@ -530,3 +1016,232 @@ class GenerateShippingLabel(Wizard):
         shipment.save()
 
         return 'select_rate'
+
+
+class GenerateEndiciaLabelsResult(ModelView):
+    'Generate Endicia Labels Result'
+    __name__ = 'shipping.label.endicia.bulk.result'
+
+    result = fields.Text('Result', readonly=True)
+
+
+class GenerateEndiciaLabels(Wizard):
+    """
+    Generate the Endicia labels of all the selected shipments with the same
+    configuration
+    """
+    __name__ = 'shipping.label.endicia.bulk'
+
+    start = StateView(
+        'shipping.label.endicia',
+        'shipping_endicia.shipping_endicia_configuration_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button(
+                'Generate Labels', 'generate', 'tryton-ok', default=True
+            ),
+        ]
+    )
+    generate = StateView(
+        'shipping.label.endicia.bulk.result',
+        'shipping_endicia.endicia_bulk_label_result_view_form', [
+            Button('OK', 'end', 'tryton-ok', default=True),
+        ]
+    )
+
+    def default_start(self, data):
+        return {
+            'endicia_label_subtype': 'None',
+            'endicia_package_type': 'Other',
+        }
+
+    def default_generate(self, data):
+        Shipment = Pool().get('stock.shipment.out')
+
+        shipments = Shipment.browse(Transaction().context['active_ids'])
+        Shipment.write([
+            shipment for shipment in shipments
+            if shipment.carrier_cost_method == 'endicia'
+        ], {
+            'endicia_label_subtype': self.start.endicia_label_subtype,
+            'endicia_integrated_form_type':
+                self.start.endicia_integrated_form_type,
+            'endicia_package_type': self.start.endicia_package_type,
+            'endicia_include_postage': self.start.endicia_include_postage,
+        })
+
+        errors = Shipment.generate_endicia_labels(shipments)
+        return {
+            'result': '\n'.join(
+                '%s: %s' % (
+                    shipment.rec_name,
+                    errors[shipment.id] or 'Label generated',
+                ) for shipment in shipments
+            ),
+        }
+
+
+class PrintEndiciaLabelsStart(ModelView):
+    'Print Endicia Labels'
+    __name__ = 'shipping.label.endicia.print.start'
+
+    format = fields.Selection([
+        ('pdf', 'PDF'),
+        ('zpl', 'ZPL'),
+    ], 'Format', required=True)
+
+
+class PrintEndiciaLabelsResult(ModelView):
+    'Print Endicia Labels Result'
+    __name__ = 'shipping.label.endicia.print.result'
+
+    file = fields.Binary(
+        'File', filename='file_name', readonly=True, states={
+            'invisible': Bool(Eval('url')),
+        }, depends=['url']
+    )
+    file_name = fields.Char('File Name', readonly=True)
+    url = fields.Char(
+        'URL', readonly=True, states={
+            'invisible': ~Bool(Eval('url')),
+        }, help='Location of the print job on the server'
+    )
+
+
+class PrintEndiciaLabels(Wizard):
+    """
+    Export the labels of the selected shipments or manifests as a single
+    print job
+    """
+    __name__ = 'shipping.label.endicia.print'
+
+    start = StateView(
+        'shipping.label.endicia.print.start',
+        'shipping_endicia.endicia_print_labels_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'result', 'tryton-ok', default=True),
+        ]
+    )
+    result = StateView(
+        'shipping.label.endicia.print.result',
+        'shipping_endicia.endicia_print_labels_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+        ]
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(PrintEndiciaLabels, cls).__setup__()
+        cls._error_messages.update({
+            'unsupported_label': 'Labels in %s can not be exported as %s, '
+                'export them in a format the carrier labels can be '
+                'converted to.',
+        })
+
+    def default_start(self, data):
+        return {
+            'format': 'pdf',
+        }
+
+    def _get_shipments(self):
+        """
+        Returns the shipments selected directly or through their manifest
+        """
+        Shipment = Pool().get('stock.shipment.out')
+        Manifest = Pool().get('shipping.manifest')
+
+        context = Transaction().context
+        if context.get('active_model') == 'shipping.manifest':
+            return [
+                shipment
+                for manifest in Manifest.browse(context['active_ids'])
+                for shipment in manifest.shipments
+            ]
+        return Shipment.browse(context['active_ids'])
+
+    def default_result(self, data):
+        """
+        Export the print job to the label store if there is one, streaming
+        it page by page, and return its URL. Otherwise the job is streamed
+        to a temporary file, which is returned as the data of the file if it
+        is small enough and by its URL otherwise.
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        attachments = Shipment.get_endicia_label_attachments(
+            self._get_shipments()
+        )
+        job = iter_job(
+            (read_label(attachment) for attachment in attachments),
+            self.start.format
+        )
+        result = {
+            'file_name': 'labels.%s' % self.start.format,
+        }
+        store = get_label_store()
+        try:
+            if store is not None:
+                result['url'] = store.put(job)
+                return result
+            fd, job_name = tempfile.mkstemp(
+                prefix='labels-', suffix='.%s' % self.start.format
+            )
+            try:
+                with os.fdopen(fd, 'wb') as job_file:
+                    for chunk in job:
+                        job_file.write(chunk)
+            except Exception:
+                os.remove(job_name)
+                raise
+        except UnsupportedLabelError, error:
+            self.raise_user_error('unsupported_label', error.args)
+        if os.path.getsize(job_name) > PRINT_DATA_SIZE:
+            result['url'] = 'file://' + urllib.pathname2url(job_name)
+            return result
+        try:
+            with open(job_name, 'rb') as job_file:
+                result['file'] = buffer(job_file.read())
+        finally:
+            os.remove(job_name)
+        return result
+
+
+class CheckEndiciaAddressesResult(ModelView):
+    'Check Endicia Addresses Result'
+    __name__ = 'shipping.endicia.address.check.result'
+
+    result = fields.Text('Result', readonly=True)
+
+
+class CheckEndiciaAddresses(Wizard):
+    """
+    Check the delivery addresses of the selected shipments, or of all the
+    packed Endicia shipments, before the labels are generated
+    """
+    __name__ = 'shipping.endicia.address.check'
+
+    start_state = 'result'
+    result = StateView(
+        'shipping.endicia.address.check.result',
+        'shipping_endicia.endicia_address_check_result_view_form', [
+            Button('OK', 'end', 'tryton-ok', default=True),
+        ]
+    )
+
+    def default_result(self, data):
+        Shipment = Pool().get('stock.shipment.out')
+
+        context = Transaction().context
+        shipments = None
+        if context.get('active_model') == Shipment.__name__:
+            shipments = Shipment.browse(context['active_ids'])
+        errors = Shipment.check_endicia_addresses(shipments)
+        if not errors:
+            return {'result': 'All the addresses are valid'}
+        return {
+            'result': '\n\n'.join(
+                '%s:\n%s' % (shipment.rec_name, '\n'.join(shipment_errors))
+                for shipment, shipment_errors in sorted(
+                    errors.iteritems(), key=lambda item: item[0].id
+                )
+            ),
+        }
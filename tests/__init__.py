@@ -9,6 +9,20 @@ import trytond.tests.test_tryton
 from test_endicia import TestUSPSEndicia
 from test_carrier import CarrierTestCase
 from test_stock import ShipmentTestCase
+from test_cache import TTLCacheTestCase, SingleFlightTestCase
+from test_client import ClientTestCase
+from test_rate_tables import RateTablesTestCase
+from test_label_store import FileLabelStoreTestCase
+from test_print_batch import PrintBatchTestCase
+from test_audit import AuditTestCase
+from test_address_validation import AddressValidationTestCase
+from test_resilience import ResilienceTestCase
+from test_transport import TransportTestCase
+from test_sale import PostagePriceParserTestCase
+from test_label_job import LabelJobTestCase
+from test_reference import ReferenceTestCase
+from test_label_journal import LabelJournalTestCase
+from test_postage_ledger import PostageLedgerTestCase
 
 
 def suite():
@@ -19,7 +33,26 @@ def suite():
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestUSPSEndicia),
         unittest.TestLoader().loadTestsFromTestCase(ShipmentTestCase),
-        unittest.TestLoader().loadTestsFromTestCase(CarrierTestCase)
+        unittest.TestLoader().loadTestsFromTestCase(CarrierTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(TTLCacheTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(SingleFlightTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(ClientTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(RateTablesTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(FileLabelStoreTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(PrintBatchTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(AuditTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(
+            AddressValidationTestCase
+        ),
+        unittest.TestLoader().loadTestsFromTestCase(ResilienceTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(TransportTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(
+            PostagePriceParserTestCase
+        ),
+        unittest.TestLoader().loadTestsFromTestCase(LabelJobTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(ReferenceTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(LabelJournalTestCase),
+        unittest.TestLoader().loadTestsFromTestCase(PostageLedgerTestCase),
     ])
     return test_suite
 
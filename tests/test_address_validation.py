@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    test_address_validation
+
+    Test the local validation of addresses.
+
+"""
+import unittest
+
+from trytond.modules.shipping_endicia import address_validation
+from trytond.modules.shipping_endicia.address_validation import ZipIndex, \
+    validate
+
+
+class AddressValidationTestCase(unittest.TestCase):
+    """
+    Test the validation of addresses.
+    """
+
+    def setUp(self):
+        index = ZipIndex()
+        index.add([('94043', 'CA', 'Mountain View')])
+        self.get_zip_index = address_validation.get_zip_index
+        address_validation.get_zip_index = lambda: index
+        self.address = {
+            'name': 'John Doe',
+            'street': '1600 Amphitheatre Pkwy',
+            'city': 'Mountain View',
+            'zip': '94043-1351',
+            'state': None,
+            'country': 'US',
+            'phone': '+1 (650) 253-0000',
+        }
+
+    def tearDown(self):
+        address_validation.get_zip_index = self.get_zip_index
+
+    def test_0010_normalize(self):
+        """
+        Check the ZIP code and phone are cleaned and the state deduced
+        """
+        values, errors = validate(self.address)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(values['zip'], '94043')
+        self.assertEqual(values['state'], 'CA')
+        self.assertEqual(values['phone'], '6502530000')
+
+    def test_0020_reject(self):
+        """
+        Check the problems Endicia would reject the address for are listed
+        """
+        self.address.update({
+            'street': None,
+            'zip': '9404',
+            'state': 'CAL',
+            'phone': '253-0000',
+        })
+
+        values, errors = validate(self.address)
+
+        self.assertEqual(errors, [
+            'Street is missing',
+            'ZIP code "9404" is invalid',
+            'State is missing or invalid',
+            'Phone "253-0000" is invalid',
+        ])
+
+    def test_0030_international(self):
+        """
+        Check the state of other countries is kept and their ZIP truncated
+        """
+        self.address.update({
+            'city': 'Sydney',
+            'zip': '2000 - Sydney Central Business District',
+            'state': 'NSW',
+            'country': 'AU',
+            'phone': '+61 2 9265 9333',
+        })
+
+        values, errors = validate(self.address)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(values['zip'], '2000 - Sydney C')
+        self.assertEqual(values['state'], 'NSW')
+
+        self.address.update({'state': 'CMX', 'country': 'MX'})
+        values, errors = validate(self.address)
+        self.assertEqual(errors, [])
+        self.assertEqual(values['state'], 'CMX')
+
+    def test_0040_us_phone(self):
+        """
+        Check the country code and extension of US phones are removed
+        """
+        for phone in [
+                '1-650-253-0000', '(650) 253-0000 ext. 12',
+                '+1 650 253 0000 x12', '650.253.0000;ext=12']:
+            self.address['phone'] = phone
+            values, errors = validate(self.address)
+            self.assertEqual(errors, [], phone)
+            self.assertEqual(values['phone'], '6502530000')
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    test_audit
+
+    Test the audit log of the Endicia calls.
+
+"""
+import shutil
+import tempfile
+import unittest
+
+from trytond.modules.shipping_endicia import audit
+
+
+class DummyRequest(object):
+    "Stands for an endicia API request"
+
+    url = 'https://www.envmgr.com/LabelService/GetPostageLabelXML'
+
+    def __init__(self):
+        self.serialized = 0
+
+    def to_xml(self):
+        self.serialized += 1
+        return (
+            '<LabelRequest><PassPhrase>secret</PassPhrase>'
+            '<PartnerTransactionID>42</PartnerTransactionID></LabelRequest>'
+        )
+
+
+class AuditTestCase(unittest.TestCase):
+    """
+    Test the audit log.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.old_path = audit.PATH
+        self.old_sample_rate = audit.SAMPLE_RATE
+
+    def tearDown(self):
+        audit.PATH = self.old_path
+        audit.SAMPLE_RATE = self.old_sample_rate
+        del audit._store[:]
+        shutil.rmtree(self.path)
+
+    def test_0010_redact(self):
+        """
+        Check pass phrases are removed and images truncated
+        """
+        xml = (
+            '<X><PassPhrase>secret</PassPhrase>'
+            '<NewPassPhrase>other</NewPassPhrase>'
+            '<Base64LabelImage>%s</Base64LabelImage></X>'
+        ) % ('A' * 1000)
+
+        self.assertEqual(audit.redact(xml), (
+            '<X><PassPhrase>[REDACTED]</PassPhrase>'
+            '<NewPassPhrase>[REDACTED]</NewPassPhrase>'
+            '<Base64LabelImage>%s...[936 more]</Base64LabelImage></X>'
+        ) % ('A' * 64))
+
+    def test_0020_lazy_and_sampled(self):
+        """
+        Check nothing is serialized when no sink is enabled or the call is
+        not sampled, and failures are always recorded
+        """
+        request = DummyRequest()
+
+        audit.PATH = None
+        audit.record(request, '<Response/>')
+        self.assertEqual(request.serialized, 0)
+
+        audit.PATH = self.path
+        audit.SAMPLE_RATE = 0
+        audit.record(request, '<Response/>')
+        self.assertEqual(request.serialized, 0)
+
+        audit.record(request, error=Exception('Timeout'))
+        self.assertEqual(request.serialized, 1)
+
+    def test_0030_search(self):
+        """
+        Check records are found by tracking number
+        """
+        audit.PATH = self.path
+        audit.record(
+            DummyRequest(),
+            '<LabelRequestResponse><TrackingNumber>9400</TrackingNumber>'
+            '</LabelRequestResponse>', duration=0.5
+        )
+
+        entry, = audit.search(tracking_number='9400')
+        self.assertEqual(entry['api'], 'DummyRequest')
+        self.assertEqual(entry['transaction_id'], '42')
+        self.assertNotIn('secret', entry['request'])
+        self.assertEqual(list(audit.search(tracking_number='9401')), [])
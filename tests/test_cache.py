@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+    test_cache
+
+    Test the in-process caches.
+
+"""
+import time
+import threading
+import unittest
+
+from trytond.modules.shipping_endicia.cache import TTLCache, SingleFlight
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    """
+    Test TTLCache.
+    """
+
+    def test_0010_hit_and_miss(self):
+        """
+        Check stored values are returned and counted as hits
+        """
+        cache = TTLCache(size_limit=10, ttl=60)
+
+        self.assertEqual(cache.get('key'), None)
+        cache.set('key', [('First', '2.50')])
+        self.assertEqual(cache.get('key'), [('First', '2.50')])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_0020_lru_eviction(self):
+        """
+        Check the least recently used entry is evicted when the cache is full
+        """
+        cache = TTLCache(size_limit=2, ttl=60)
+
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_0030_expiry(self):
+        """
+        Check expired entries are not returned
+        """
+        cache = TTLCache(size_limit=10, ttl=0.01)
+
+        cache.set('key', 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('key'), None)
+        # Expired entries are still available as stale values
+        self.assertEqual(cache.get('key', stale=True), 1)
+
+        # A ttl of 0 disables the cache
+        cache = TTLCache(size_limit=10, ttl=0)
+        cache.set('key', 1)
+        self.assertEqual(len(cache), 0)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """
+    Test SingleFlight.
+    """
+
+    def test_0010_coalesce_concurrent_calls(self):
+        """
+        Check concurrent calls with the same key run the function once
+        """
+        single_flight = SingleFlight()
+        calls = []
+
+        def rate(zip_code):
+            calls.append(zip_code)
+            time.sleep(0.1)
+            return [('First', '2.61')]
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                single_flight.do('83702', rate, '83702')
+            ))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, ['83702'])
+        self.assertEqual(results, [[('First', '2.61')]] * 5)
+        self.assertEqual(single_flight.shared, 4)
+
+        # Once done, a new call runs the function again
+        single_flight.do('83702', rate, '83702')
+        self.assertEqual(len(calls), 2)
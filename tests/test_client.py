@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    test_client
+
+    Test sending of Endicia requests.
+
+"""
+import time
+import unittest
+
+from endicia.exceptions import RequestError
+
+from trytond.modules.shipping_endicia.client import send_requests, \
+    iter_requests
+
+
+class DummyRequest(object):
+    """
+    Request answering after `delay` seconds without any network access.
+    """
+
+    def __init__(self, response, delay=0, error=None):
+        self.response = response
+        self.delay = delay
+        self.error = error
+
+    def send_request(self):
+        time.sleep(self.delay)
+        if self.error:
+            raise RequestError(self.error)
+        return self.response
+
+
+class ClientTestCase(unittest.TestCase):
+    """
+    Test the client module.
+    """
+
+    def test_0010_send_requests(self):
+        """
+        Check responses keep the order of the requests and errors are
+        returned instead of raised
+        """
+        requests = [
+            DummyRequest('<first/>', delay=0.05),
+            DummyRequest(None, error='Invalid weight'),
+            DummyRequest('<third/>'),
+        ]
+
+        results = send_requests(requests, workers=3)
+
+        self.assertEqual(results[0], ('<first/>', None))
+        self.assertEqual(results[1][0], None)
+        self.assertTrue(isinstance(results[1][1], RequestError))
+        self.assertEqual(results[2], ('<third/>', None))
+
+    def test_0020_send_requests_concurrently(self):
+        """
+        Check wall time scales with the number of workers
+        """
+        requests = [DummyRequest('<ok/>', delay=0.1) for _ in range(8)]
+
+        start = time.time()
+        send_requests(requests, workers=8)
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_0030_iter_requests(self):
+        """
+        Check results are yielded as soon as they are received, with the
+        index of their request
+        """
+        requests = [
+            DummyRequest('<slow/>', delay=0.1),
+            DummyRequest(None, error='Invalid PIC'),
+            DummyRequest('<fast/>'),
+        ]
+
+        results = list(iter_requests(requests, workers=3))
+
+        self.assertEqual(results[-1], (0, '<slow/>', None))
+        self.assertEqual(
+            sorted(index for index, _, _ in results), [0, 1, 2]
+        )
+        error, = [error for _, _, error in results if error is not None]
+        self.assertTrue(isinstance(error, RequestError))
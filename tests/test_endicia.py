@@ -5,6 +5,7 @@
     Test USPS Integration via Endicia.
 
 """
+from contextlib import contextmanager
 from decimal import Decimal
 from time import time
 from datetime import datetime
@@ -19,6 +20,37 @@ from trytond.config import config
 config.set('database', 'path', '/tmp')
 
 
+@contextmanager
+def patch(obj, name, value):
+    """
+    Replace the attribute name of obj by value in the block
+    """
+    missing = name not in obj.__dict__
+    previous = obj.__dict__.get(name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        if missing:
+            delattr(obj, name)
+        else:
+            setattr(obj, name, previous)
+
+
+@contextmanager
+def shared_transactions():
+    """
+    Run the transactions started with new_transaction in the current one,
+    as the memory database can not commit them separately
+    """
+    @contextmanager
+    def new_transaction(transaction, autocommit=False, readonly=False):
+        yield transaction
+
+    with patch(Transaction, 'new_transaction', new_transaction):
+        yield
+
+
 class BaseTestCase(unittest.TestCase):
     """
     Base test case for trytond-endicia-integration.
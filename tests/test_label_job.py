@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+    test_label_job
+
+    Test the queue of Endicia label jobs.
+
+"""
+from datetime import datetime, timedelta
+
+from trytond.tests.test_tryton import with_transaction, POOL
+from tests.test_endicia import BaseTestCase, shared_transactions
+
+from trytond.modules.shipping_endicia.label_job import CLAIM_TIMEOUT, \
+    MAX_ATTEMPTS
+
+
+class LabelJobTestCase(BaseTestCase):
+    """
+    Test LabelJob.
+    """
+
+    def setUp(self):
+        super(LabelJobTestCase, self).setUp()
+        self.LabelJob = POOL.get('endicia.label.job')
+
+    @with_transaction()
+    def test_0010_reclaim_abandoned_jobs(self):
+        """
+        Check jobs left processing by a stopped worker are queued again
+        """
+        self.setup_defaults()
+        shipment, = self.StockShipmentOut.search([])
+        job, = self.LabelJob.enqueue([shipment])
+
+        with shared_transactions():
+            self.assertEqual(self.LabelJob._claim(10), [job.id])
+            job = self.LabelJob(job.id)
+            self.assertEqual(job.state, 'processing')
+            self.assertTrue(job.claimed_at)
+
+            # The worker may still be running
+            self.assertEqual(self.LabelJob._reclaim(), [])
+            self.assertEqual(self.LabelJob.enqueue([shipment]), [])
+
+            self.LabelJob.write([job], {
+                'claimed_at': datetime.utcnow() - timedelta(
+                    seconds=CLAIM_TIMEOUT + 60),
+            })
+            self.assertEqual(self.LabelJob._reclaim(), [job.id])
+
+        job = self.LabelJob(job.id)
+        self.assertEqual(job.state, 'pending')
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(job.next_attempt)
+        self.assertEqual(job.error, 'Abandoned by its worker')
+        # The shipment is still queued by its job
+        self.assertEqual(self.LabelJob.enqueue([shipment]), [])
+
+    @with_transaction()
+    def test_0020_reclaim_last_attempt(self):
+        """
+        Check a job abandoned on its last attempt fails and can be retried
+        """
+        self.setup_defaults()
+        shipment, = self.StockShipmentOut.search([])
+        job, = self.LabelJob.enqueue([shipment])
+        self.LabelJob.write([job], {
+            'state': 'processing',
+            'attempts': MAX_ATTEMPTS - 1,
+        })
+
+        with shared_transactions():
+            # Jobs claimed before the claim time was recorded are stale
+            self.assertEqual(self.LabelJob._reclaim(), [job.id])
+
+        job = self.LabelJob(job.id)
+        self.assertEqual(job.state, 'failed')
+
+        self.LabelJob.retry([job])
+        self.assertEqual(job.state, 'pending')
+        self.assertEqual(job.attempts, 0)
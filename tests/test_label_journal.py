@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    test_label_journal
+
+    Test the journal of the Endicia label requests.
+
+"""
+import errno
+import socket
+from datetime import datetime, timedelta
+
+from endicia.exceptions import RequestError
+
+from trytond.tests.test_tryton import with_transaction, POOL
+from trytond.transaction import Transaction
+from tests.test_endicia import BaseTestCase, shared_transactions
+
+from trytond.modules.shipping_endicia.label_journal import SENT_TIMEOUT
+from trytond.modules.shipping_endicia.resilience import CircuitOpenError
+
+
+class LabelJournalTestCase(BaseTestCase):
+    """
+    Test LabelRequest.
+    """
+
+    def setUp(self):
+        super(LabelJournalTestCase, self).setUp()
+        self.LabelRequest = POOL.get('endicia.label.request')
+        self.Package = POOL.get('stock.package')
+
+    def setup_packages(self, count=2):
+        """
+        Create count packages of the shipment of the sale
+        """
+        shipment, = self.StockShipmentOut.search([])
+        with Transaction().set_context(company=self.company.id):
+            return self.Package.create([{
+                'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+            } for _ in range(count)])
+
+    @with_transaction()
+    def test_0010_begin_record(self):
+        """
+        Check a label is bought only once per package
+        """
+        self.setup_defaults()
+        first, second = self.setup_packages()
+
+        with shared_transactions():
+            entries = self.LabelRequest.begin([first.id, second.id])
+            self.assertEqual(
+                [e[1] for e in entries],
+                ['%d-1' % first.id, '%d-1' % second.id]
+            )
+
+            # The outcome of the requests is not known yet
+            for entry in self.LabelRequest.begin([first.id, second.id]):
+                self.assertEqual(entry[1:3], (None, None))
+                self.assertTrue(entry[3])
+
+            self.LabelRequest.record([
+                (entries[0][0], '<response/>', None),
+                (entries[1][0], None, RequestError('Invalid address')),
+            ])
+            self.assertEqual(
+                [r.state for r in self.LabelRequest.browse(
+                    [e[0] for e in entries])],
+                ['received', 'failed']
+            )
+
+            # The response received is reused and the refused request sent
+            # again
+            recovered, retried = self.LabelRequest.begin(
+                [first.id, second.id]
+            )
+            self.assertEqual(
+                recovered, (entries[0][0], None, '<response/>', None)
+            )
+            self.assertEqual(retried[1], '%d-2' % second.id)
+
+    @with_transaction()
+    def test_0020_expire_release(self):
+        """
+        Check requests left sent become unknown and can be released
+        """
+        self.setup_defaults()
+        first, second = self.setup_packages()
+
+        with shared_transactions():
+            entries = self.LabelRequest.begin([first.id, second.id])
+            self.LabelRequest.write([self.LabelRequest(entries[0][0])], {
+                'sent_at': datetime.utcnow() - timedelta(
+                    seconds=SENT_TIMEOUT + 60),
+            })
+
+            for entry in self.LabelRequest.begin([first.id, second.id]):
+                self.assertTrue(entry[3])
+            expired, sent = self.LabelRequest.browse(
+                [e[0] for e in entries]
+            )
+            self.assertEqual(expired.state, 'unknown')
+            self.assertEqual(sent.state, 'sent')
+
+            self.LabelRequest.release([expired, sent])
+            self.assertEqual(
+                [e[1] for e in self.LabelRequest.begin(
+                    [first.id, second.id])],
+                ['%d-2' % first.id, '%d-2' % second.id]
+            )
+
+    @with_transaction()
+    def test_0030_record_unsent(self):
+        """
+        Check only the requests which may have reached Endicia are unknown
+        """
+        self.setup_defaults()
+        packages = self.setup_packages(3)
+
+        with shared_transactions():
+            entries = self.LabelRequest.begin(map(int, packages))
+            self.LabelRequest.record([
+                (entries[0][0], None, CircuitOpenError('ShippingLabelAPI')),
+                (entries[1][0], None, socket.error(
+                    errno.ECONNREFUSED, 'Connection refused')),
+                (entries[2][0], None, socket.timeout('timed out')),
+            ])
+            self.assertEqual(
+                [r.state for r in self.LabelRequest.browse(
+                    [e[0] for e in entries])],
+                ['failed', 'failed', 'unknown']
+            )
+
+    @with_transaction()
+    def test_0040_done_after_commit(self):
+        """
+        Check the requests are done only once the labels are committed
+        """
+        PackageType = POOL.get('stock.package.type')
+
+        # The journal commits, so everything is committed and removed after
+        package_type, = PackageType.create([{'name': 'Box'}])
+        package, = self.Package.create([{'type': package_type.id}])
+        Transaction().commit()
+        try:
+            entry, = self.LabelRequest.begin([package.id])
+            self.LabelRequest.record([(entry[0], '<response/>', None)])
+
+            self.LabelRequest.done([package])
+            Transaction().rollback()
+            self.assertEqual(self.LabelRequest(entry[0]).state, 'received')
+
+            self.LabelRequest.done([package])
+            Transaction().commit()
+            Transaction().cache.clear()
+            request = self.LabelRequest(entry[0])
+            self.assertEqual(request.state, 'done')
+            self.assertEqual(request.response, None)
+            entry, = self.LabelRequest.begin([package.id])
+            self.assertEqual(entry[1], '%d-2' % package.id)
+        finally:
+            Transaction().rollback()
+            self.LabelRequest.delete(self.LabelRequest.search([
+                ('package', '=', 'stock.package,%d' % package.id),
+            ]))
+            self.Package.delete([package])
+            PackageType.delete([package_type])
+            Transaction().commit()
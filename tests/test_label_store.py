@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+    test_label_store
+
+    Test the filesystem label store.
+
+"""
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from trytond.config import config
+from trytond.modules.shipping_endicia import label_store
+from trytond.modules.shipping_endicia.label_store import FileLabelStore, \
+    decode_base64, decoded_size, read_label
+
+
+class LinkAttachment(object):
+    "Attachment linking to an image"
+    type = 'link'
+
+    def __init__(self, link):
+        self.link = link
+
+
+class FileLabelStoreTestCase(unittest.TestCase):
+    """
+    Test FileLabelStore.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = FileLabelStore('file://' + self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_0010_put_and_open(self):
+        """
+        Check images are stored under their digest and read back
+        """
+        image = os.urandom(200000)
+        encoded = base64.encodestring(image)
+
+        url = self.store.put(decode_base64(encoded, chunk_size=1024))
+
+        digest = hashlib.sha256(image).hexdigest()
+        self.assertEqual(url, 'file://' + os.path.join(
+            self.path, digest[0:2], digest[2:4], digest
+        ))
+        with self.store.open(url) as image_file:
+            self.assertEqual(image_file.read(), image)
+
+    def test_0020_identical_images(self):
+        """
+        Check identical images are stored once
+        """
+        encoded = base64.b64encode('label')
+
+        first_url = self.store.put(decode_base64(encoded))
+        second_url = self.store.put(decode_base64(encoded))
+
+        self.assertEqual(first_url, second_url)
+        digest = hashlib.sha256('label').hexdigest()
+        self.assertEqual(
+            os.listdir(os.path.join(self.path, digest[0:2], digest[2:4])),
+            [digest]
+        )
+        # No temporary file is left behind
+        self.assertEqual(os.listdir(self.path), [digest[0:2]])
+
+    def test_0030_decoded_size(self):
+        """
+        Check the size of labels is computed without decoding them
+        """
+        for label in ['', 'Z', '^XA', '^XA^FO50', os.urandom(1000)]:
+            self.assertEqual(
+                decoded_size(base64.encodestring(label)), len(label)
+            )
+
+    def test_0040_open_outside_store(self):
+        """
+        Check files outside of the directory of the store are not read
+        """
+        url = self.store.put(decode_base64(base64.b64encode('label')))
+        outside = tempfile.NamedTemporaryFile()
+        os.symlink(outside.name, os.path.join(self.path, 'outside'))
+
+        for link in [
+                'file:///etc/passwd',
+                'file://' + self.path + '/../etc/passwd',
+                'file://' + os.path.join(self.path, 'outside'),
+                'http://example.com/label.png']:
+            self.assertFalse(self.store.contains(link))
+            self.assertRaises(ValueError, self.store.open, link)
+        self.assertTrue(self.store.contains(url))
+
+    def test_0050_read_label_links(self):
+        """
+        Check only the links of the store are read from attachments
+        """
+        url = self.store.put(decode_base64(base64.b64encode('label')))
+        with self.assertRaises(ValueError):
+            read_label(LinkAttachment(url))
+
+        if not config.has_section('shipping_endicia'):
+            config.add_section('shipping_endicia')
+        config.set('shipping_endicia', 'label_store', self.store.url)
+        label_store._label_store[:] = [self.store]
+        try:
+            self.assertEqual(read_label(LinkAttachment(url)), 'label')
+            with self.assertRaises(ValueError):
+                read_label(LinkAttachment('file:///etc/passwd'))
+        finally:
+            config.remove_option('shipping_endicia', 'label_store')
+            label_store._label_store[:] = []
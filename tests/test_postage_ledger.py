@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+    test_postage_ledger
+
+    Test the ledger of the postage of the Endicia accounts.
+
+"""
+import socket
+from decimal import Decimal
+
+from endicia.exceptions import RequestError
+
+from trytond.tests.test_tryton import with_transaction, POOL
+from tests.test_endicia import BaseTestCase, patch, shared_transactions
+from tests.test_stock import label_response
+
+from trytond.modules.shipping_endicia import postage_ledger
+
+RECREDIT_RESPONSE = '''<?xml version="1.0" encoding="utf-8"?>
+<RecreditRequestResponse xmlns="www.envmgr.com/LabelService">
+  <Status>0</Status>
+  <CertifiedIntermediary>
+    <PostageBalance>140.00</PostageBalance>
+  </CertifiedIntermediary>
+</RecreditRequestResponse>'''
+
+
+class PostageLedgerTestCase(BaseTestCase):
+    """
+    Test PostageLedger.
+    """
+
+    def setUp(self):
+        super(PostageLedgerTestCase, self).setUp()
+        self.PostageLedger = POOL.get('endicia.postage.ledger')
+
+    @with_transaction()
+    def test_0010_balance(self):
+        """
+        Check the balance is the last known one plus the amounts since
+        """
+        Ledger = self.PostageLedger
+
+        self.setup_defaults()
+        self.assertEqual(Ledger.get_balance(self.carrier), None)
+
+        Ledger.record(self.carrier, 'reconcile', Decimal('100'), Decimal('100'))
+        Ledger.record(self.carrier, 'charge', Decimal('-5'))
+        self.assertEqual(Ledger.get_balance(self.carrier), Decimal('95'))
+
+        Ledger.record_charge(self.carrier, label_response('94001'))
+        Ledger.record(self.carrier, 'charge', Decimal('-3.55'))
+        self.assertEqual(Ledger.get_balance(self.carrier), Decimal('90'))
+        self.assertEqual(
+            Ledger.get_average_charge(self.carrier), Decimal('5')
+        )
+
+        entry = Ledger.record(self.carrier, 'recredit', Decimal('50'))
+        self.assertEqual(Ledger.get_balance(self.carrier), Decimal('140'))
+        Ledger.write([entry], {'state': 'failed'})
+        self.assertEqual(Ledger.get_balance(self.carrier), Decimal('90'))
+
+    @with_transaction()
+    def test_0020_reconcile(self):
+        """
+        Check the ledger is reconciled with the balance of the account
+        """
+        Ledger = self.PostageLedger
+
+        self.setup_defaults()
+        Ledger.record(self.carrier, 'reconcile', Decimal('100'), Decimal('100'))
+        Ledger.record(self.carrier, 'charge', Decimal('-5'))
+
+        with shared_transactions(), \
+                patch(self.Carrier, 'get_endicia_postage_balance',
+                    lambda carrier: Decimal('80')):
+            Ledger.reconcile([self.carrier])
+
+        entry, = Ledger.search([], limit=1)
+        self.assertEqual(entry.kind, 'reconcile')
+        self.assertEqual(entry.amount, Decimal('-15'))
+        self.assertEqual(Ledger.get_balance(self.carrier), Decimal('80'))
+
+    @with_transaction()
+    def test_0030_replenish(self):
+        """
+        Check the account is recredited below its threshold, the recredit
+        being committed as pending before the postage is bought
+        """
+        Ledger = self.PostageLedger
+
+        self.setup_defaults()
+        self.Carrier.write([self.carrier], {
+            'endicia_postage_threshold': Decimal('50'),
+            'endicia_recredit_amount': Decimal('100'),
+        })
+        Ledger.record(self.carrier, 'reconcile', Decimal('40'), Decimal('40'))
+        pending = []
+
+        def send_request(api_request):
+            entry, = Ledger.search([], limit=1)
+            pending.append((entry.kind, entry.state, entry.amount))
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        with shared_transactions(), \
+                patch(postage_ledger, 'send_request', send_request):
+            response = RECREDIT_RESPONSE
+            Ledger.replenish([self.carrier])
+            self.assertEqual(
+                pending, [('recredit', 'pending', Decimal('100'))]
+            )
+            self.assertEqual(
+                Ledger.get_balance(self.carrier), Decimal('140')
+            )
+
+            # Above the threshold
+            Ledger.replenish([self.carrier])
+            self.assertEqual(len(pending), 1)
+
+            Ledger.record(self.carrier, 'charge', Decimal('-100'))
+            response = RequestError('Invalid passphrase')
+            Ledger.replenish([self.carrier])
+            entry, = Ledger.search([], limit=1)
+            self.assertEqual(entry.state, 'failed')
+            self.assertEqual(Ledger.get_balance(self.carrier), Decimal('40'))
+
+            # The postage may have been bought
+            response = socket.timeout('timed out')
+            Ledger.replenish([self.carrier])
+            entry, = Ledger.search([], limit=1)
+            self.assertEqual(entry.state, 'pending')
+            self.assertEqual(
+                Ledger.get_balance(self.carrier), Decimal('140')
+            )
+            Ledger.replenish([self.carrier])
+            self.assertEqual(len(pending), 3)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+    test_print_batch
+
+    Test the print job export.
+
+"""
+import struct
+import unittest
+import zlib
+from StringIO import StringIO
+
+from trytond.modules.shipping_endicia.print_batch import png_to_zpl, \
+    export_labels, get_label_format, UnsupportedLabelError
+
+
+def make_png(rows, width):
+    """
+    Returns a 1 bit grayscale PNG image of rows, a list of strings of 0
+    (black) and 1 (white) dots
+    """
+    def chunk(type_, data):
+        return struct.pack('>I', len(data)) + type_ + data + struct.pack(
+            '>I', zlib.crc32(type_ + data) & 0xffffffff
+        )
+
+    raw = ''.join(
+        '\x00' + ''.join(
+            chr(int(row[i:i + 8].ljust(8, '0'), 2))
+            for i in xrange(0, width, 8)
+        ) for row in rows
+    )
+    return '\x89PNG\r\n\x1a\n' + chunk(
+        'IHDR', struct.pack('>IIBBBBB', width, len(rows), 1, 0, 0, 0, 0)
+    ) + chunk('IDAT', zlib.compress(raw)) + chunk('IEND', '')
+
+
+class PrintBatchTestCase(unittest.TestCase):
+    """
+    Test the export of labels as print jobs.
+    """
+
+    def test_0010_png_to_zpl(self):
+        """
+        Check black dots become set bits of the graphic field
+        """
+        image = make_png(['0111111111', '1111111110'], 10)
+
+        self.assertEqual(
+            png_to_zpl(image), '^XA^FO0,0^GFA,4,4,2,80000040^FS^XZ\n'
+        )
+        # ZPL labels are kept as is
+        self.assertEqual(png_to_zpl('^XA^XZ\n'), '^XA^XZ\n')
+
+    def test_0020_export_pdf(self):
+        """
+        Check the PDF has a page per label and a valid cross reference
+        """
+        images = [make_png(['01', '10'], 2) for i in xrange(3)]
+        job = StringIO()
+
+        export_labels(images, 'pdf', job)
+
+        pdf = job.getvalue()
+        self.assertTrue(pdf.startswith('%PDF-1.4'))
+        self.assertTrue(pdf.endswith('%%EOF\n'))
+        self.assertIn('/Count 3', pdf)
+        startxref = int(pdf.rsplit('startxref\n', 1)[1].split()[0])
+        self.assertTrue(pdf[startxref:].startswith('xref\n0 12\n'))
+        # Each entry of the table points to its object
+        entries = pdf[startxref:].split('\n')[3:14]
+        for object_id, entry in enumerate(entries, 1):
+            offset = int(entry.split()[0])
+            self.assertTrue(
+                pdf[offset:].startswith('%d 0 obj' % object_id)
+            )
+
+    def test_0030_unsupported_formats(self):
+        """
+        Check labels which can not be converted are refused
+        """
+        zpl, epl = '^XA^FO50,50^XZ\n', 'N\nA50,0,0,1,1,1,N,"USPS"\nP1\n'
+        self.assertEqual(get_label_format(make_png(['1'], 1)), 'PNG')
+        self.assertEqual(get_label_format(zpl), 'ZPLII')
+        self.assertEqual(get_label_format(epl), 'EPL2')
+        self.assertEqual(get_label_format('GIF89a'), 'GIF')
+
+        for images, format_, label_format in [
+                ([zpl], 'pdf', 'ZPLII'),
+                ([make_png(['1'], 1), 'GIF89a'], 'pdf', 'GIF'),
+                ([zpl, epl], 'zpl', 'EPL2')]:
+            with self.assertRaises(UnsupportedLabelError) as context:
+                # The errors of the worker processes are raised as well
+                export_labels(images, format_, StringIO(), workers=2)
+            self.assertEqual(context.exception.args, (
+                label_format, format_.upper(),
+            ))
+
+    def test_0040_export_zpl(self):
+        """
+        Check the pool of processes converts the labels in order
+        """
+        images = [make_png(['0' * i + '1'], i + 1) for i in xrange(10)]
+        expected = ''.join(png_to_zpl(image) for image in images)
+
+        for workers in (1, 2):
+            job = StringIO()
+            export_labels(images, 'zpl', job, workers=workers)
+            self.assertEqual(job.getvalue(), expected)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+    test_rate_tables
+
+    Test the local rate tables.
+
+"""
+import unittest
+
+from trytond.modules.shipping_endicia.rate_tables import RateTables
+
+
+class RateTablesTestCase(unittest.TestCase):
+    """
+    Test RateTables.
+    """
+
+    def setUp(self):
+        self.rate_tables = RateTables()
+        self.rate_tables.add_zones([
+            ('843', '005', '799', '4'),
+            ('843', '800', '999', '2'),
+        ])
+        self.rate_tables.add_prices([
+            ('First', '2', '4', '2.61'),
+            ('First', '2', '13', '3.54'),
+            ('Priority', '2', '16', '6.80'),
+            ('Priority', '2', '1120', '54.10'),
+            ('Priority', '4', '16', '7.35'),
+        ])
+
+    def test_0010_get_zone(self):
+        """
+        Check zones are looked up by ZIP3
+        """
+        self.assertEqual(self.rate_tables.get_zone('84301', '83702'), 2)
+        self.assertEqual(self.rate_tables.get_zone('84301', '10001'), 4)
+        self.assertEqual(self.rate_tables.get_zone('84301', '00301'), None)
+        self.assertEqual(self.rate_tables.get_zone('10001', '83702'), None)
+
+    def test_0020_get_postage_prices(self):
+        """
+        Check prices are those of the first weight break not below weight
+        """
+        self.assertEqual(
+            sorted(self.rate_tables.get_postage_prices(
+                '84301', '83702', '4.0'
+            )),
+            [('First', '2.61'), ('Priority', '6.80')]
+        )
+        self.assertEqual(
+            sorted(self.rate_tables.get_postage_prices(
+                '84301', '83702', '12.1'
+            )),
+            [('First', '3.54'), ('Priority', '6.80')]
+        )
+        # First class is not priced over 13 oz
+        self.assertEqual(
+            self.rate_tables.get_postage_prices('84301', '83702', '20.0'),
+            [('Priority', '54.10')]
+        )
+        self.assertEqual(
+            self.rate_tables.get_postage_prices('84301', 'K1A 0B1', '4.0'),
+            None
+        )
+
+    def test_0030_uncovered_mailpieces(self):
+        """
+        Check only parcels priced by weight are priced by the tables
+        """
+        self.assertEqual(
+            sorted(self.rate_tables.get_postage_prices(
+                '84301', '83702', '4.0', shape='Parcel'
+            )),
+            [('First', '2.61'), ('Priority', '6.80')]
+        )
+        self.assertEqual(
+            self.rate_tables.get_postage_prices(
+                '84301', '83702', '4.0', shape='FlatRateEnvelope'
+            ), None
+        )
+        self.assertEqual(
+            self.rate_tables.get_postage_prices(
+                '84301', '83702', '4.0', dimensions={
+                    'Length': '20.0', 'Width': '12.0', 'Height': '10.0',
+                }
+            ), None
+        )
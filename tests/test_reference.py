@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    test_reference
+
+    Test the registry of the reference data of Endicia requests.
+
+"""
+from datetime import datetime
+
+from trytond.tests.test_tryton import with_transaction, POOL
+from trytond.transaction import Transaction
+from tests.test_endicia import BaseTestCase, patch
+
+from trytond.modules.shipping_endicia.reference import get_customs_profiles, \
+    get_address_payloads, get_endicia_country_names
+
+
+class ReferenceTestCase(BaseTestCase):
+    """
+    Test the reference data.
+    """
+
+    def setUp(self):
+        super(ReferenceTestCase, self).setUp()
+        self.Lang = POOL.get('ir.lang')
+
+    @with_transaction()
+    def test_0010_customs_profiles_language(self):
+        """
+        Check the customs profiles are cached per language
+        """
+        self.setup_defaults()
+        lang, = self.Lang.search([('code', '=', 'fr_FR')])
+        self.Lang.write([lang], {'translatable': True})
+        with Transaction().set_context(language='fr_FR'):
+            self.Template.write([self.product.template], {
+                'name': 'Produit de test',
+            })
+
+        profiles = get_customs_profiles([self.product])
+        self.assertEqual(profiles[self.product.id][1], 'Test Product')
+        with Transaction().set_context(language='fr_FR'):
+            profiles = get_customs_profiles([self.product])
+        self.assertEqual(profiles[self.product.id][1], 'Produit de test')
+        profiles = get_customs_profiles([self.product])
+        self.assertEqual(profiles[self.product.id][1], 'Test Product')
+
+    @with_transaction()
+    def test_0020_address_payloads(self):
+        """
+        Check the payloads of addresses are cached until they, their party
+        or its contact mechanisms change
+        """
+        Address = self.PartyAddress
+
+        self.setup_defaults()
+        boise, graz = self.sale_party.addresses[:2]
+        computed = []
+        get_payload = Address._get_endicia_payload
+
+        def count_payload(address):
+            computed.append(address.id)
+            return get_payload(address)
+
+        with patch(Address, '_get_endicia_payload', count_payload):
+            payloads = get_address_payloads([boise, graz, boise])
+            self.assertEqual(sorted(computed), sorted([boise.id, graz.id]))
+            self.assertEqual(
+                payloads[boise.id]['to']['ToAddress1'], '123 Main Street'
+            )
+            self.assertEqual(get_address_payloads([boise, graz]), payloads)
+            self.assertEqual(len(computed), 2)
+
+            # Only the payload of the address changed is computed again
+            Address.write([graz], {'street': 'Herrengasse 16'})
+            payloads = get_address_payloads([boise, graz])
+            self.assertEqual(computed[2:], [graz.id])
+            self.assertEqual(
+                payloads[graz.id]['to']['ToAddress1'], 'Herrengasse 16'
+            )
+
+            # Other parties do not change the payloads
+            self.Party.write([self.company.party], {'name': 'Other'})
+            get_address_payloads([boise, graz])
+            self.assertEqual(len(computed), 3)
+
+            self.PartyContact.create([{
+                'type': 'email',
+                'value': 'john@example.com',
+                'party': self.sale_party.id,
+            }])
+            payloads = get_address_payloads([boise, graz])
+            self.assertEqual(sorted(computed[3:]), sorted([boise.id, graz.id]))
+            self.assertEqual(
+                payloads[boise.id]['to']['ToEMail'], 'john@example.com'
+            )
+
+            # A write of another process changes the version of the address
+            table = Address.__table__()
+            Transaction().connection.cursor().execute(*table.update(
+                [table.write_date], [datetime(2016, 1, 1)],
+                where=table.id == boise.id
+            ))
+            Transaction().cache.clear()
+            get_address_payloads([boise, graz])
+            self.assertEqual(computed[5:], [boise.id])
+
+    @with_transaction()
+    def test_0030_endicia_country_names(self):
+        """
+        Check the Endicia name of the countries does not depend on the
+        language and is searched and ordered like it is read
+        """
+        Country = self.Country
+
+        self.setup_defaults()
+        lang, = self.Lang.search([('code', '=', 'fr_FR')])
+        self.Lang.write([lang], {'translatable': True})
+        us, = Country.search([('code', '=', 'US')])
+        austria, = Country.search([('code', '=', 'AT')])
+        Country.write([us], {'endicia_country_name': 'America'})
+        with Transaction().set_context(language='fr_FR'):
+            Country.write([austria], {'name': 'Autriche'})
+
+            self.assertEqual(Country(austria.id).name, 'Autriche')
+            self.assertEqual(get_endicia_country_names()['AT'], 'Austria')
+            self.assertEqual(
+                [c.endicia_name for c in Country.browse([us, austria])],
+                ['America', 'Austria']
+            )
+            self.assertEqual(
+                Country.search([('endicia_name', '=', 'Austria')]), [austria]
+            )
+            self.assertEqual(
+                Country.search([('endicia_name', '=', 'Autriche')]), []
+            )
+            self.assertEqual(
+                Country.search([('endicia_name', 'ilike', 'a%')], order=[
+                    ('endicia_name', 'ASC'),
+                ]), [us, austria]
+            )
+        self.assertEqual(get_endicia_country_names()['AT'], 'Austria')
+        self.assertEqual(get_endicia_country_names()['US'], 'America')
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    test_resilience
+
+    Test the timeouts, retries and circuit breakers of the Endicia calls.
+
+"""
+import errno
+import socket
+import time
+import unittest
+import urllib2
+
+from endicia.exceptions import RequestError
+
+from trytond.modules.shipping_endicia import resilience
+from trytond.modules.shipping_endicia.resilience import (
+    CircuitBreaker, CircuitOpenError, call, was_sent
+)
+
+
+class PostageRatesAPI(object):
+    "Request of a read-only endpoint"
+
+
+class ShippingLabelAPI(object):
+    "Request of an endpoint buying postage"
+
+
+class ResilienceTestCase(unittest.TestCase):
+    """
+    Test the resilience module.
+    """
+
+    def setUp(self):
+        resilience._breakers.clear()
+        self.delays = resilience.backoff_delays
+        resilience.backoff_delays = lambda: iter([0, 0])
+
+    def tearDown(self):
+        resilience.backoff_delays = self.delays
+        resilience._breakers.clear()
+
+    def test_0010_breaker_opens_and_recovers(self):
+        """
+        Check the circuit opens past the failure threshold, then lets a
+        single trial call through once reset
+        """
+        breaker = CircuitBreaker(
+            'PostageRatesAPI', threshold=0.5, window=60, min_calls=4,
+            reset=0.05
+        )
+        for failed in (False, True, False):
+            breaker.record(failed)
+        self.assertEqual(breaker.state, 'closed')
+        breaker.record(True)
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(False)
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_0020_retry_idempotent_calls(self):
+        """
+        Check only read-only endpoints are retried, and only on transient
+        errors
+        """
+        calls = []
+
+        def flaky(timeout):
+            calls.append(timeout)
+            if len(calls) < 3:
+                raise socket.timeout('timed out')
+            return '<ok/>'
+
+        self.assertEqual(call(PostageRatesAPI(), flaky), '<ok/>')
+        self.assertEqual(len(calls), 3)
+
+        del calls[:]
+        self.assertRaises(
+            socket.timeout, call, ShippingLabelAPI(), flaky
+        )
+        self.assertEqual(len(calls), 1)
+
+        def rejected(timeout):
+            calls.append(timeout)
+            raise RequestError('Invalid weight')
+
+        del calls[:]
+        self.assertRaises(RequestError, call, PostageRatesAPI(), rejected)
+        self.assertEqual(len(calls), 1)
+
+    def test_0030_fail_fast_when_open(self):
+        """
+        Check calls are refused without calling Endicia once open
+        """
+        breaker = resilience.get_breaker('ShippingLabelAPI')
+        breaker.opened = time.time()
+
+        self.assertFalse(resilience.is_available('ShippingLabelAPI'))
+        self.assertTrue(resilience.is_available('PostageRatesAPI'))
+        self.assertRaises(
+            CircuitOpenError, call, ShippingLabelAPI(), lambda timeout: None
+        )
+
+    def test_0040_was_sent(self):
+        """
+        Check only the errors raised before reaching Endicia are unsent
+        """
+        refused = socket.error(errno.ECONNREFUSED, 'Connection refused')
+        self.assertFalse(was_sent(CircuitOpenError('ShippingLabelAPI')))
+        self.assertFalse(was_sent(refused))
+        self.assertFalse(was_sent(urllib2.URLError(refused)))
+        self.assertFalse(was_sent(socket.gaierror(-2, 'Name not known')))
+
+        self.assertTrue(was_sent(socket.timeout('timed out')))
+        self.assertTrue(was_sent(
+            socket.error(errno.ECONNRESET, 'Connection reset by peer')
+        ))
+        self.assertTrue(was_sent(urllib2.HTTPError(
+            'https://labelserver.endicia.com', 503, 'Unavailable', {}, None
+        )))
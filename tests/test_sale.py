@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    test_sale
+
+    Test the parsing of Endicia postage rates.
+
+"""
+import unittest
+
+from endicia import PostageRatesAPI
+from endicia.exceptions import RequestError
+
+from trytond.modules.shipping_endicia.client import send_request
+from trytond.modules.shipping_endicia.sale import PostagePriceParser
+from trytond.modules.shipping_endicia.transport import set_transport
+
+RATES_RESPONSE = '''<?xml version="1.0" encoding="utf-8"?>
+<PostageRatesResponse xmlns="www.envmgr.com/LabelService">
+  <Status>0</Status>
+  <PostagePrice TotalAmount="6.45">
+    <Postage TotalAmount="6.45">
+      <MailService>Priority Mail</MailService>
+    </Postage>
+    <MailClass>Priority</MailClass>
+  </PostagePrice>
+  <PostagePrice TotalAmount="22.95">
+    <Postage TotalAmount="22.95">
+      <MailService>Priority Mail Express</MailService>
+    </Postage>
+    <MailClass>PriorityExpress</MailClass>
+  </PostagePrice>
+  <PostagePrice TotalAmount="2.61">
+    <Postage TotalAmount="2.61">
+      <MailService>First-Class Mail</MailService>
+    </Postage>
+    <MailClass>First</MailClass>
+  </PostagePrice>
+</PostageRatesResponse>'''
+
+ERROR_RESPONSE = '''<?xml version="1.0" encoding="utf-8"?>
+<PostageRatesResponse xmlns="www.envmgr.com/LabelService">
+  <Status>12503</Status>
+  <ErrorMessage>Invalid weight</ErrorMessage>
+</PostageRatesResponse>'''
+
+
+class StaticTransport(object):
+    "Transport answering every request with the same response"
+
+    def __init__(self, response):
+        self.response = response
+
+    def post(self, url, data, timeout=None):
+        return self.response
+
+
+class PostagePriceParserTestCase(unittest.TestCase):
+    """
+    Test PostagePriceParser.
+    """
+
+    def setUp(self):
+        self.previous_transport = None
+
+    def tearDown(self):
+        if self.previous_transport is not None:
+            set_transport(self.previous_transport)
+
+    def _send(self, response, parse):
+        self.previous_transport = set_transport(StaticTransport(response))
+        request = PostageRatesAPI(
+            mailclass='Domestic',
+            weightoz='10.0',
+            from_postal_code='83702',
+            to_postal_code='94703',
+            to_country_code='US',
+            accountid='123456',
+            requesterid='abcd',
+            passphrase='secret',
+            test=True,
+        )
+        return request, send_request(request, parse=parse)
+
+    def test_0010_parse_services(self):
+        """
+        Check the prices of all the services are read in order and filtered
+        on the mail classes
+        """
+        self.assertEqual(PostagePriceParser()(RATES_RESPONSE), [
+            ('Priority', '6.45'),
+            ('PriorityExpress', '22.95'),
+            ('First', '2.61'),
+        ])
+        self.assertEqual(
+            PostagePriceParser(['First', 'Priority'])(RATES_RESPONSE),
+            [('Priority', '6.45'), ('First', '2.61')]
+        )
+
+    def test_0020_stream_flags(self):
+        """
+        Check the status and error are set in the same pass
+        """
+        flags = {}
+        self.assertEqual(PostagePriceParser().stream(RATES_RESPONSE, flags), [
+            ('Priority', '6.45'),
+            ('PriorityExpress', '22.95'),
+            ('First', '2.61'),
+        ])
+        self.assertEqual(flags, {'Status': '0', 'ErrorMessage': None})
+
+        flags = {}
+        self.assertEqual(PostagePriceParser().stream(ERROR_RESPONSE, flags), [])
+        self.assertEqual(flags, {
+            'Status': '12503', 'ErrorMessage': 'Invalid weight',
+        })
+
+    def test_0030_send_request(self):
+        """
+        Check the response of a rate request is parsed only by the parser
+        """
+        request, postage_prices = self._send(
+            RATES_RESPONSE, PostagePriceParser(['PriorityExpress'])
+        )
+        self.assertEqual(postage_prices, [('PriorityExpress', '22.95')])
+        self.assertTrue(request.success)
+        # The response was not parsed into a tree by _set_flags
+        self.assertEqual(request.response, None)
+
+    def test_0040_send_request_error(self):
+        """
+        Check an error response raises its message
+        """
+        with self.assertRaises(RequestError) as context:
+            self._send(ERROR_RESPONSE, PostagePriceParser())
+        self.assertEqual(unicode(context.exception), 'Invalid weight')
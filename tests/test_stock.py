@@ -5,8 +5,62 @@
     Test USPS Integration via Endicia.
 
 """
-from trytond.tests.test_tryton import with_transaction
-from tests.test_endicia import BaseTestCase
+import base64
+import unittest
+from datetime import datetime, time, timedelta
+
+from trytond import backend
+from trytond.tests.test_tryton import with_transaction, POOL
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from tests.test_endicia import BaseTestCase, patch
+
+from endicia.exceptions import RequestError
+
+from trytond.modules.shipping_endicia import stock, shipment_bag
+from tests.test_endicia import shared_transactions
+from tests.test_print_batch import make_png
+
+LABEL_RESPONSE = '''<?xml version="1.0" encoding="utf-8"?>
+<LabelRequestResponse xmlns="www.envmgr.com/LabelService">
+  <Status>0</Status>
+  <Base64LabelImage>%(image)s</Base64LabelImage>
+  <TrackingNumber>%(tracking_number)s</TrackingNumber>
+  <FinalPostage>%(postage)s</FinalPostage>
+  <PostageBalance>%(balance)s</PostageBalance>
+</LabelRequestResponse>'''
+
+REFUND_RESPONSE = '''<?xml version="1.0" encoding="utf-8"?>
+<RefundResponse xmlns="www.envmgr.com/LabelService">
+  <RefundList>
+    <PICNumber>%s
+      <IsApproved>YES</IsApproved>
+      <ErrorMsg>Approved - Less than 10 days.</ErrorMsg>
+    </PICNumber>
+    <PICNumber>%s
+      <IsApproved>NO</IsApproved>
+      <ErrorMsg>Label was already used.</ErrorMsg>
+    </PICNumber>
+  </RefundList>
+</RefundResponse>'''
+
+SCAN_RESPONSE = '''<?xml version="1.0" encoding="utf-8"?>
+<SCANResponse xmlns="www.envmgr.com/LabelService">
+  <SubmissionID>%s</SubmissionID>
+  <SCANForm>%s</SCANForm>
+</SCANResponse>'''
+
+
+def label_response(tracking_number, postage='6.45', balance='93.55'):
+    """
+    Returns a ShippingLabelAPI response with a single label image
+    """
+    return LABEL_RESPONSE % {
+        'image': base64.b64encode(make_png(['10', '01'], 2)),
+        'tracking_number': tracking_number,
+        'postage': postage,
+        'balance': balance,
+    }
 
 
 class ShipmentTestCase(BaseTestCase):
@@ -14,6 +68,42 @@ class ShipmentTestCase(BaseTestCase):
     Test model classes in stock.py.
     """
 
+    def setUp(self):
+        super(ShipmentTestCase, self).setUp()
+        self.Package = POOL.get('stock.package')
+        self.Tracking = POOL.get('shipment.tracking')
+
+    def setup_packages(self, count=2):
+        """
+        Pack the moves of the shipment of the sale in the first of count
+        packages
+
+        :return: Tuple of the packed shipment and its packages
+        """
+        shipment, = self.StockShipmentOut.search([])
+        with Transaction().set_context(company=self.company.id):
+            packages = self.Package.create([{
+                'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+                'moves': [
+                    ('add', map(int, shipment.outgoing_moves)),
+                ] if not index else [],
+            } for index in range(count)])
+        self.StockShipmentOut.write([shipment], {'state': 'packed'})
+        return shipment, packages
+
+    def set_tracking_numbers(self, shipments):
+        """
+        Give a tracking number to each shipment, as their labels would
+        """
+        for shipment in shipments:
+            tracking, = self.Tracking.create([{
+                'carrier': shipment.carrier.id,
+                'tracking_number': '9400100000000000%d' % shipment.id,
+            }])
+            self.StockShipmentOut.write([shipment], {
+                'tracking_number': tracking.id,
+            })
+
     @with_transaction()
     def test_carrier_change(self):
         """
@@ -36,3 +126,337 @@ class ShipmentTestCase(BaseTestCase):
         self.assertEquals(shipment.on_change_carrier(), {
             'is_endicia_shipping': None
         })
+
+    @with_transaction()
+    def test_0010_label_requests_of_root_packages(self):
+        """
+        Check a label is requested for each outer package only, with the
+        content of the packages it contains
+        """
+        Shipment = self.StockShipmentOut
+
+        self.setup_defaults()
+        shipment, (outer, inner, other) = self.setup_packages(3)
+        self.Package.write([inner], {'parent': outer.id})
+        self.Package.write([outer], {'moves': [('remove', [
+            move.id for move in shipment.outgoing_moves
+        ])]})
+        self.Package.write([inner], {'moves': [('add', [
+            move.id for move in shipment.outgoing_moves
+        ])]})
+        shipment = Shipment(shipment.id)
+
+        with patch(Shipment, '_get_endicia_label_request',
+                lambda self, package: package.id):
+            self.assertEqual(shipment._get_endicia_label_requests(), [
+                (outer, outer.id), (other, other.id),
+            ])
+        self.assertEqual(
+            shipment._get_endicia_package_moves(outer),
+            list(shipment.outgoing_moves)
+        )
+
+    @with_transaction()
+    def test_0015_unpacked_international_moves(self):
+        """
+        Check a multi-piece international shipment with moves outside of
+        the packages is rejected
+        """
+        Shipment = self.StockShipmentOut
+
+        self.setup_defaults()
+        shipment, packages = self.setup_packages()
+        address_at, = self.PartyAddress.search([
+            ('country.code', '=', 'AT'),
+        ])
+        Shipment.write([shipment], {'delivery_address': address_at.id})
+
+        with patch(Shipment, '_get_endicia_label_request',
+                lambda self, package: package.id):
+            self.assertEqual(
+                len(Shipment(shipment.id)._get_endicia_label_requests()), 2
+            )
+
+            self.Package.write([packages[0]], {'moves': [('remove', [
+                move.id for move in shipment.outgoing_moves
+            ])]})
+            with self.assertRaises(UserError):
+                Shipment(shipment.id)._get_endicia_label_requests()
+
+    @with_transaction()
+    def test_0017_label_format_of_warehouse(self):
+        """
+        Check the label size follows the format the warehouse overrides
+        """
+        self.setup_defaults()
+        shipment, = self.StockShipmentOut.search([])
+        self.assertEqual(shipment._get_endicia_label_format(), {
+            'ImageFormat': 'PNG',
+            'LabelSize': '6x4',
+            'ImageResolution': '203',
+            'ImageRotation': 'Rotate270',
+        })
+
+        self.StockLocation.write([shipment.warehouse], {
+            'endicia_image_format': 'ZPLII',
+            'endicia_image_resolution': '300',
+        })
+        shipment = self.StockShipmentOut(shipment.id)
+        self.assertEqual(shipment._get_endicia_label_format(), {
+            'ImageFormat': 'ZPLII',
+            'LabelSize': '4x6',
+            'ImageResolution': '300',
+            'ImageRotation': 'Rotate270',
+        })
+
+        # Other sizes are kept
+        self.Carrier.write([self.carrier], {'endicia_label_size': '4x5'})
+        shipment = self.StockShipmentOut(shipment.id)
+        self.assertEqual(
+            shipment._get_endicia_label_format()['LabelSize'], '4x5'
+        )
+
+    @unittest.skipIf(
+        backend.name() == 'sqlite', 'SQLite can not roll back to a savepoint'
+    )
+    @with_transaction()
+    def test_0020_generate_labels_rollback(self):
+        """
+        Check the records of a shipment whose labels fail to be saved are
+        rolled back, so that saving them again does not duplicate them
+        """
+        Shipment = self.StockShipmentOut
+
+        self.setup_defaults()
+        shipment, packages = self.setup_packages()
+        results = [[
+            (package, label_response('9400100000000000%d' % package.id), None)
+            for package in packages
+        ]]
+        save_label = Shipment._save_endicia_label
+
+        def fail_last_label(self, package, response, is_master=False):
+            if package == packages[-1]:
+                self.raise_user_error('no_packages')
+            return save_label(self, package, response, is_master)
+
+        with patch(Shipment, '_get_endicia_label_requests',
+                    lambda self: [(package, None) for package in packages]), \
+                patch(Shipment, '_send_endicia_label_requests',
+                    staticmethod(lambda label_requests: results)):
+            with patch(Shipment, '_save_endicia_label', fail_last_label):
+                errors = Shipment.generate_endicia_labels([shipment])
+            self.assertTrue(errors[shipment.id])
+            self.assertEqual(self.Tracking.search([], count=True), 0)
+            self.assertEqual(self.IrAttachment.search([], count=True), 0)
+
+            errors = Shipment.generate_endicia_labels([shipment])
+
+        self.assertEqual(errors, {shipment.id: None})
+        self.assertEqual(self.Tracking.search([], count=True), 2)
+        self.assertTrue(Shipment(shipment.id).tracking_number)
+
+    @with_transaction()
+    def test_0030_done_assigns_manifests(self):
+        """
+        Check done shipments are added to the open manifest of their carrier
+        and warehouse, which is opened once
+        """
+        Manifest = POOL.get('shipping.manifest')
+
+        self.setup_defaults()
+        shipment, _ = self.setup_packages(1)
+        key = (shipment.carrier, shipment.warehouse)
+        self.set_tracking_numbers([shipment])
+
+        self.StockShipmentOut.done([shipment])
+
+        shipment = self.StockShipmentOut(shipment.id)
+        manifest = shipment.shipping_manifest
+        self.assertEqual(manifest.state, 'open')
+        self.assertEqual((manifest.carrier, manifest.warehouse), key)
+        self.assertEqual(Manifest.get_manifests([key]), {key: manifest})
+        self.assertEqual(Manifest.search([], count=True), 1)
+
+        Manifest.write([manifest], {'state': 'closed'})
+        opened = Manifest.get_manifests([key])[key]
+        self.assertNotEqual(opened, manifest)
+        self.assertEqual(opened.state, 'open')
+
+    def test_0040_parse_refund(self):
+        """
+        Check the result of each PIC number of a refund response is read
+        """
+        self.assertEqual(
+            self.StockShipmentOut._parse_endicia_refund(
+                REFUND_RESPONSE % ('94001', '94002')
+            ), {
+                '94001': (True, 'Approved - Less than 10 days.'),
+                '94002': (False, 'Label was already used.'),
+            }
+        )
+
+    @with_transaction()
+    def test_0050_refund_labels(self):
+        """
+        Check only the shipments whose refund is approved are refunded, and
+        a failed request rejects the refund of all its shipments
+        """
+        Shipment = self.StockShipmentOut
+
+        self.setup_defaults()
+        shipment, = Shipment.search([])
+        shipments = [shipment] + Shipment.copy([shipment])
+        self.set_tracking_numbers(shipments)
+        approved, rejected = Shipment.browse(shipments)
+        pics = [str(s.tracking_number.tracking_number) for s in shipments]
+        requests = []
+
+        def send_requests(api_requests):
+            requests.extend(api_requests)
+            return results
+
+        with patch(stock, 'send_requests', send_requests):
+            results = [(REFUND_RESPONSE % tuple(pics), None)]
+            self.assertEqual(Shipment.refund_endicia_labels(shipments), {
+                approved: (True, 'Approved - Less than 10 days.'),
+                rejected: (False, 'Label was already used.'),
+            })
+            self.assertEqual(len(requests), 1)
+            self.assertEqual(
+                map(bool, [s.endicia_refunded for s in Shipment.browse(
+                    shipments)]),
+                [True, False]
+            )
+
+            results = [(None, RequestError('Invalid passphrase'))]
+            self.assertEqual(Shipment.refund_endicia_labels([rejected]), {
+                rejected: (False, 'Invalid passphrase'),
+            })
+            self.assertFalse(Shipment(rejected.id).endicia_refunded)
+
+    @with_transaction()
+    def test_0060_manifest_cron(self):
+        """
+        Check the cron closes the manifests past their cutoff and generates
+        their SCAN Forms
+        """
+        Manifest = POOL.get('shipping.manifest')
+
+        self.setup_defaults()
+        shipment, _ = self.setup_packages(1)
+        self.set_tracking_numbers([shipment])
+        self.StockShipmentOut.done([shipment])
+        manifest = self.StockShipmentOut(shipment.id).shipping_manifest
+        self.StockLocation.write([manifest.warehouse], {
+            'endicia_manifest_cutoff': time(0, 0),
+        })
+        table = Manifest.__table__()
+        Transaction().connection.cursor().execute(*table.update(
+            [table.create_date], [datetime(2016, 1, 1)]
+        ))
+        requests = []
+
+        def iter_requests(api_requests):
+            requests.extend(api_requests)
+            for index, _ in enumerate(api_requests):
+                yield index, SCAN_RESPONSE % (
+                    index, base64.b64encode(make_png(['10'], 1))
+                ), None
+
+        with shared_transactions(), \
+                patch(shipment_bag, 'iter_requests', iter_requests):
+            Manifest.process_endicia_manifests()
+
+        manifest = Manifest(manifest.id)
+        self.assertEqual(manifest.state, 'closed')
+        self.assertEqual(manifest.endicia_scan_state, 'done')
+        self.assertEqual(len(requests), 1)
+        attachment, = self.IrAttachment.search([
+            ('resource', '=', str(manifest)),
+        ])
+        self.assertEqual(attachment.name, 'SCAN0.png')
+
+    @with_transaction()
+    def test_0070_reclaim_abandoned_scan_forms(self):
+        """
+        Check manifests left processing by a stopped worker are queued again
+        """
+        Manifest = POOL.get('shipping.manifest')
+
+        self.setup_defaults()
+        shipment, = self.StockShipmentOut.search([])
+        manifest, = Manifest.create([{
+            'carrier': shipment.carrier.id,
+            'warehouse': shipment.warehouse.id,
+            'state': 'closed',
+            'endicia_scan_state': 'pending',
+        }])
+
+        with shared_transactions():
+            self.assertEqual(
+                Manifest._claim_endicia_scan_forms(10), [manifest.id]
+            )
+            # The worker may still be running
+            self.assertEqual(Manifest._reclaim_endicia_scan_forms(), [])
+            self.assertRaises(
+                UserError, Manifest.retry_endicia_scan_forms, [manifest]
+            )
+
+            Manifest.write([manifest], {
+                'endicia_scan_claimed_at': datetime.utcnow() - timedelta(
+                    seconds=shipment_bag.SCAN_CLAIM_TIMEOUT + 60),
+            })
+            self.assertEqual(
+                Manifest._reclaim_endicia_scan_forms(), [manifest.id]
+            )
+
+        manifest = Manifest(manifest.id)
+        self.assertEqual(manifest.endicia_scan_state, 'pending')
+        self.assertEqual(manifest.endicia_scan_error, 'Abandoned by its worker')
+
+        # An abandoned manifest can also be queued again by hand
+        Manifest.write([manifest], {
+            'endicia_scan_state': 'processing',
+            'endicia_scan_claimed_at': None,
+        })
+        Manifest.retry_endicia_scan_forms([manifest])
+        self.assertEqual(manifest.endicia_scan_state, 'pending')
+
+    @with_transaction()
+    def test_0080_scan_forms_committed_by_chunk(self):
+        """
+        Check the SCAN Forms received are kept when a later request fails
+        """
+        Manifest = POOL.get('shipping.manifest')
+
+        self.setup_defaults()
+        shipment, = self.StockShipmentOut.search([])
+        pics = ['9400100000000000000001', '9400100000000000000002']
+        manifest, = Manifest.create([{
+            'carrier': shipment.carrier.id,
+            'warehouse': shipment.warehouse.id,
+            'state': 'closed',
+            'endicia_scan_state': 'pending',
+            'endicia_scan_failed_pics': '\n'.join(pics),
+        }])
+
+        def iter_requests(api_requests):
+            yield 0, SCAN_RESPONSE % (
+                0, base64.b64encode(make_png(['10'], 1))
+            ), None
+            raise ValueError('Worker stopped')
+
+        with shared_transactions(), \
+                patch(shipment_bag, 'SCAN_CHUNK_SIZE', 1), \
+                patch(shipment_bag, 'iter_requests', iter_requests):
+            Manifest.process_endicia_scan_forms()
+
+        manifest = Manifest(manifest.id)
+        self.assertEqual(manifest.endicia_scan_state, 'failed')
+        # Only the PIC numbers without a form are sent again
+        self.assertEqual(manifest.endicia_scan_failed_pics, pics[1])
+        attachment, = self.IrAttachment.search([
+            ('resource', '=', str(manifest)),
+        ])
+        self.assertEqual(attachment.name, 'SCAN0.png')
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+    tracking.py
+
+"""
+from trytond.pool import PoolMeta
+from trytond.model import fields
+
+__metaclass__ = PoolMeta
+__all__ = ['ShipmentTracking']
+
+
+class ShipmentTracking:
+    __name__ = 'shipment.tracking'
+
+    endicia_response_size = fields.Integer(
+        'Endicia Response Size', readonly=True,
+        help='Size in bytes of the label response of Endicia'
+    )
+    endicia_label_size = fields.Integer(
+        'Endicia Label Size', readonly=True,
+        help='Size in bytes of the label images once decoded'
+    )
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+    transport
+
+    HTTP transport of the requests to Endicia.
+
+    Connections are kept alive and reused by all the requests of the
+    process, whatever their transaction, so that a TLS handshake is not paid
+    on every call. A request is sent again on a new connection only if its
+    reused connection failed before the request was sent, as the requests
+    buying postage must never be sent twice.
+
+    Like urllib2, the requests go through the proxies of the `http_proxy`
+    and `https_proxy` environment variables, except for the hosts of
+    `no_proxy`.
+
+    The options of the `shipping_endicia` section of the configuration are:
+
+    pool_size
+        Number of idle connections kept per host
+    endpoint_url
+        URL of a server receiving the requests instead of Endicia, for
+        example a local stand-in server for tests and benchmarks
+
+"""
+import base64
+import httplib
+import select
+import socket
+import threading
+import urllib
+import urllib2
+from urlparse import urlparse, unquote
+
+from trytond.config import config
+
+__all__ = ['ConnectionPool', 'get_transport', 'set_transport']
+
+POOL_SIZE = config.getint('shipping_endicia', 'pool_size', default=8)
+ENDPOINT_URL = config.get('shipping_endicia', 'endpoint_url')
+
+CONNECTIONS = {
+    'http': httplib.HTTPConnection,
+    'https': httplib.HTTPSConnection,
+}
+
+
+def _is_dropped(connection):
+    """
+    Returns True if the idle connection was closed by the server, its socket
+    being readable while no response is expected
+    """
+    if connection.sock is None:
+        return False
+    readable, _, _ = select.select([connection.sock], [], [], 0)
+    return bool(readable)
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of keep-alive connections, at most `size` idle
+    connections being kept per host.
+
+    :param base_url: If set, requests are sent to its host instead of the
+                     one of their URL
+    :param proxies: Dictionary mapping a scheme to the URL of its proxy, by
+                    default the proxies of the environment
+    """
+
+    def __init__(self, size=POOL_SIZE, base_url=None, proxies=None):
+        self.size = size
+        self.base_url = base_url
+        if proxies is None:
+            proxies = urllib.getproxies()
+        self.proxies = proxies
+        self.created = 0
+        self.reused = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get_connection(self, key, timeout):
+        """
+        Returns an idle connection to the host of key or a new one, and
+        whether it was reused
+        """
+        connection = None
+        while connection is None:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    self.created += 1
+                    break
+                connection = idle.pop()
+            if _is_dropped(connection):
+                connection.close()
+                connection = None
+            else:
+                self.reused += 1
+        if connection is None:
+            return self._connect(key, timeout), False
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def _connect(self, key, timeout):
+        """
+        Returns a new connection to the host of key, through its proxy if
+        any
+        """
+        scheme, host, port, proxy = key
+        if proxy is None:
+            return CONNECTIONS[scheme](host, port, timeout=timeout)
+        connection = CONNECTIONS[proxy.scheme](
+            proxy.hostname, proxy.port, timeout=timeout
+        )
+        if scheme == 'https':
+            connection.set_tunnel(host, port, self._get_proxy_headers(proxy))
+        return connection
+
+    def _get_proxy(self, scheme, host):
+        """
+        Returns the parsed URL of the proxy of the requests to host or None
+        """
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return urlparse(proxy)
+
+    @staticmethod
+    def _get_proxy_headers(proxy):
+        if not proxy.username:
+            return {}
+        credentials = '%s:%s' % (
+            unquote(proxy.username), unquote(proxy.password or '')
+        )
+        return {
+            'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials),
+        }
+
+    def _release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """
+        Close all the idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+    def post(self, url, data, timeout=None):
+        """
+        Post the form encoded data to url
+
+        :return: The body of the response
+        """
+        parsed = urlparse(url)
+        host = urlparse(self.base_url) if self.base_url else parsed
+        proxy = self._get_proxy(host.scheme, host.hostname)
+        key = (host.scheme, host.hostname, host.port, proxy)
+        path = parsed.path + (parsed.query and '?' + parsed.query)
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Connection': 'keep-alive',
+        }
+        if proxy is not None and host.scheme == 'http':
+            # The proxy forwards the request to the host of its full URL
+            path = '%s://%s%s' % (host.scheme, host.netloc, path)
+            headers.update(self._get_proxy_headers(proxy))
+        while True:
+            connection, reused = self._get_connection(key, timeout)
+            try:
+                connection.request('POST', path, data, headers)
+            except (httplib.HTTPException, socket.error), error:
+                connection.close()
+                # An idle connection may have been closed by the server
+                # before the request was sent, it is then sent again on a
+                # new connection
+                if reused and not isinstance(error, socket.timeout):
+                    continue
+                raise
+            try:
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                # The request may have been processed, it is not sent again
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(key, connection)
+            if response.status >= 400:
+                raise urllib2.HTTPError(
+                    url, response.status, response.reason, response.msg, None
+                )
+            return body
+
+
+_transport = []
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    Returns the transport of the process, an object with the interface of
+    ConnectionPool.post
+    """
+    if not _transport:
+        with _transport_lock:
+            if not _transport:
+                _transport.append(ConnectionPool(base_url=ENDPOINT_URL))
+    return _transport[0]
+
+
+def set_transport(transport):
+    """
+    Replace the transport of the process
+
+    :return: The previous transport
+    """
+    with _transport_lock:
+        previous = _transport and _transport[0] or None
+        _transport[:] = [transport]
+    return previous